@@ -20,7 +20,9 @@ class Job:
     Attributes:
         name: Job name (used for output/error file names).
         time: Maximum job time in seconds.
-        n_cpu: Number of CPUs to allocate.
+        n_cpu: Number of CPUs to allocate per task.
+        n_tasks: Number of MPI tasks. Multi-bunch runs use n_tasks ranks
+            with n_cpu threads each.
         partition: HPC partition to use.
         err_folder: Folder for error logs.
         out_folder: Folder for output logs.
@@ -35,6 +37,7 @@ class Job:
     name: str = "job"
     time: int = 86000
     n_cpu: int = 24
+    n_tasks: int = 1
     partition: str = "milan"
     err_folder: str = "/ccc/work/cont003/soleil/gubaiduv/err/"
     out_folder: str = "/ccc/work/cont003/soleil/gubaiduv/out/"
@@ -68,6 +71,7 @@ class Job:
             name=job_config.get('name', 'job'),
             time=job_config.get('time', 86000),
             n_cpu=job_config.get('n_cpu', 24),
+            n_tasks=job_config.get('n_tasks', 1),
             partition=job_config.get('partition', 'milan'),
             err_folder=job_config.get('err_folder', '/ccc/work/cont003/soleil/gubaiduv/err/'),
             out_folder=job_config.get('out_folder', '/ccc/work/cont003/soleil/gubaiduv/out/'),
@@ -99,6 +103,7 @@ class Job:
             name=job_config.get('name', 'job'),
             time=job_config.get('time', 86000),
             n_cpu=job_config.get('n_cpu', 24),
+            n_tasks=job_config.get('n_tasks', 1),
             partition=job_config.get('partition', 'milan'),
             err_folder=job_config.get('err_folder', '/ccc/work/cont003/soleil/gubaiduv/err/'),
             out_folder=job_config.get('out_folder', '/ccc/work/cont003/soleil/gubaiduv/out/'),
@@ -165,7 +170,7 @@ class Submitter:
                 else:
                     f.write(f"#MSUB -q {job.partition}\n")
                 f.write("#MSUB -Q long\n")
-                f.write("#MSUB -n 1\n")
+                f.write(f"#MSUB -n {job.n_tasks}\n")
                 f.write(f"#MSUB -c {job.n_cpu}\n")
                 f.write(f"#MSUB -T {job.time}\n")
                 f.write("#MSUB -A soldai\n")
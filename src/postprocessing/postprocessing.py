@@ -46,8 +46,13 @@ def plot_offset(ax,
                 Qp_y,
                 n_bunches=416,
                 n_sampling=1,
+                turns=None,
+                envelope=None,
                 **matplotlib_kwargs):
-    turns = np.linspace(0, len(m) / n_bunches * n_sampling, len(m))
+    # turns: turn of each sample of m, for decimated monitors. envelope:
+    # offset amplitude over std on every turn, fitted instead of m and mp.
+    if turns is None:
+        turns = np.linspace(0, len(m) / n_bunches * n_sampling, len(m))
     ax.plot(turns, m / std, **matplotlib_kwargs)
     min_level = 0.15
     m = np.trim_zeros(m, trim='b')
@@ -60,6 +65,8 @@ def plot_offset(ax,
     signal = np.sqrt(
         m**2 +
         (BETA_Y_SMOOTH * mp)**2) / std
+    if envelope is not None:
+        signal = envelope
     smoothing_window_size = 100
     risetime = fit_risetime(
         signal,
@@ -85,9 +92,12 @@ def plot_offset(ax,
 
 
 def post_mwi(m, std, n_macroparticles, n_turns, n_bin, bunch_current, Qp_x,
-             Qp_y):
+             Qp_y, turns=None):
     fig, ax = plt.subplots(1, 1)
-    ax.plot(std[5, :] * 100)
+    if turns is None:
+        ax.plot(std[5, :] * 100)
+    else:
+        ax.plot(turns, std[5, :] * 100)
     ax.set_xlabel('Turns (time)')
     ax.set_ylabel('Energy offset, $\sigma_\delta$ (\%)')
     ax.title.set_text('Energy offset, $I_b={:.1f}$ (mA)'.format(bunch_current *
@@ -97,17 +107,23 @@ def post_mwi(m, std, n_macroparticles, n_turns, n_bin, bunch_current, Qp_x,
         'energy_offset(n_mp={:.1e},n_turns={:.1e},n_bin={:},bunch_current={:.1e},Qp_x={:.2f},Qp_y={:.2f}).pdf'
         .format(n_macroparticles, n_turns, n_bin, bunch_current, Qp_x, Qp_y))
     plt.close()
-    final_energy_offset = np.nanmean(
-        np.trim_zeros(std[5, :], trim='b')[-5000:])
-    max_energy_offset = np.nanmax(np.trim_zeros(std[5, :], trim='b')[-5000:])
-    min_energy_offset = np.nanmin(np.trim_zeros(std[5, :], trim='b')[-5000:])
+    sigma_delta = np.trim_zeros(std[5, :], trim='b')[-5000:]
+    if turns is not None:
+        # Samples of the last 5000 turns of a decimated monitor.
+        sigma_delta = std[5, turns > turns[-1] - 5000]
+    final_energy_offset = np.nanmean(sigma_delta)
+    max_energy_offset = np.nanmax(sigma_delta)
+    min_energy_offset = np.nanmin(sigma_delta)
     return final_energy_offset, max_energy_offset, min_energy_offset
 
 
 def post_bunch_length(m, std, n_macroparticles, n_turns, n_bin, bunch_current,
-                      Qp_x, Qp_y):
+                      Qp_x, Qp_y, turns=None):
     fig, ax = plt.subplots(1, 1)
-    ax.plot(std[4, :] / 1e-12)
+    if turns is None:
+        ax.plot(std[4, :] / 1e-12)
+    else:
+        ax.plot(turns, std[4, :] / 1e-12)
     ax.set_xlabel('Turns (time)')
     ax.set_ylabel('Bunch length, $\sigma_z$ (ps)')
     ax.title.set_text('Bunch length, $I_b={:.1f}$ (mA)'.format(bunch_current *
@@ -117,11 +133,31 @@ def post_bunch_length(m, std, n_macroparticles, n_turns, n_bin, bunch_current,
         'bunch_length(n_mp={:.1e},n_turns={:.1e},n_bin={:},bunch_current={:.1e},Qp_x={:.2f},Qp_y={:.2f}).pdf'
         .format(n_macroparticles, n_turns, n_bin, bunch_current, Qp_x, Qp_y))
     plt.close()
-    final_bunch_length = np.nanmean(
-        np.trim_zeros(std[4, :], trim='b')[-10000:])
+    sigma_z = np.trim_zeros(std[4, :], trim='b')[-10000:]
+    if turns is not None:
+        # Samples of the last 10000 turns of a decimated monitor.
+        sigma_z = std[4, turns > turns[-1] - 10000]
+    final_bunch_length = np.nanmean(sigma_z)
     return final_bunch_length
 
 
+def full_resolution(turns, windows):
+    # Samples of a decimated monitor saved every turn, i.e. in its windows.
+    full = np.zeros(len(turns), dtype=bool)
+    for start, stop in windows:
+        full |= (turns >= start) & (turns < stop)
+    return full
+
+
+def decimated_envelope(turns, full, y, yp, y_min, y_max):
+    # Amplitude of the vertical offset on every turn from the samples of a
+    # decimated monitor: the amplitude of (y, yp) for samples of one turn, as
+    # in plot_offset, and the largest |<y>| of the block for block samples.
+    amplitude = np.sqrt(y**2 + (BETA_Y_SMOOTH * yp)**2)
+    amplitude[~full] = np.maximum(np.abs(y_min[~full]), np.abs(y_max[~full]))
+    return np.interp(np.arange(turns[0], turns[-1] + 1), turns, amplitude)
+
+
 def plot_Qb(m, n_macroparticles, n_turns, n_bin, bunch_current, Qp_x, Qp_y):
     fig, ax = plt.subplots(1, 1)
     fftfreqy, ffty = periodogram(m[2, :], )
@@ -188,25 +224,65 @@ def post_single(n_macroparticles=1e6,
                 cavity='False',
                 max_kick=0.0,
                 sc='False',
-               ibs='True'):
-    filename = FOLDER + 'monitors(n_mp={:.1e},n_turns={:.1e},n_bin={:},bunch_current={:.2e},Qp_x={:.2f},Qp_y={:.2f},id_state={},Zlong={},cavity={:},max_kick={:.1e},sc={:},ibs={:},Qpp)'.format(
-        n_macroparticles, n_turns, n_bin, bunch_current, Qp_x, Qp_y, ID_state,
-        Zlong, cavity, max_kick, sc, ibs)
+               ibs='True',
+               member=0,
+               filename=None):
+    # member: index of the bunch in the monitor file, e.g. of an ensemble
+    # member of track_TI.run_ensemble (BunchData_k, WakePotentialData_k).
+    # filename: monitor file without extension, for files not named after
+    # the parameters such as monitors_ensemble(...) files.
+    bunch_data = 'BunchData_{:}'.format(member)
+    wake_data = 'WakePotentialData_{:}'.format(member)
+    if filename is None:
+        filename = FOLDER + 'monitors(n_mp={:.1e},n_turns={:.1e},n_bin={:},bunch_current={:.2e},Qp_x={:.2f},Qp_y={:.2f},id_state={},Zlong={},cavity={:},max_kick={:.1e},sc={:},ibs={:},Qpp)'.format(
+            n_macroparticles, n_turns, n_bin, bunch_current, Qp_x, Qp_y, ID_state,
+            Zlong, cavity, max_kick, sc, ibs)
     with hp.File(filename + '.hdf5') as f:
-        m = f['BunchData_0']['mean'][:]
-        std = f['BunchData_0']['std'][:]
-        J = f['BunchData_0']['cs_invariant'][:]
-        emit = f['BunchData_0']['emit'][:]
-
-    plot_Q_s(m, n_macroparticles, n_turns, n_bin, bunch_current, Qp_x, Qp_y)
+        m = f[bunch_data]['mean'][:]
+        std = f[bunch_data]['std'][:]
+        J = f[bunch_data]['cs_invariant'][:]
+        emit = f[bunch_data]['emit'][:]
+        # Decimated monitors (decimating_monitor) save every turn only in
+        # their windows, and outside the mean, min and max of blocks of
+        # turns, with the first turn of each sample in time.
+        decimated = 'mean_min' in f[bunch_data]
+        if decimated:
+            turns = f[bunch_data]['time'][:]
+            m_min = f[bunch_data]['mean_min'][:]
+            m_max = f[bunch_data]['mean_max'][:]
+            windows = f[bunch_data].attrs['windows']
+
+    turns_offset, envelope = None, None
+    if decimated:
+        # Drop the samples not saved before an interruption.
+        n = np.flatnonzero(turns)[-1] + 1 if turns.any() else 1
+        m, std, m_min, m_max = m[:, :n], std[:, :n], m_min[:, :n], m_max[:, :n]
+        turns = turns[:n]
+        full = full_resolution(turns, windows)
+        # The tunes are taken from the longest window saved every turn.
+        if len(windows) > 0:
+            start, stop = max(windows, key=lambda window: window[1] - window[0])
+            m_tunes = m[:, (turns >= start) & (turns < stop)]
+        else:
+            m_tunes = m
+        kept = np.abs(m[2, :]) < 1e10
+        y, yp = m[2, kept], m[3, kept]
+        turns_offset = turns[kept]
+        envelope = decimated_envelope(turns_offset, full[kept], y, yp,
+                                      m_min[2, kept], m_max[2, kept]) / std[2, 0]
+    else:
+        turns = None
+        m_tunes = m
+        y = np.trim_zeros(m[2, :], trim='b')
+        yp = np.trim_zeros(m[3, :], trim='b')
+
+        yp = yp[np.abs(y) < 1e10]
+        y = y[np.abs(y) < 1e10]
+
+    plot_Q_s(m_tunes, n_macroparticles, n_turns, n_bin, bunch_current, Qp_x,
+             Qp_y)
     fig, ax = plt.subplots(1, 1)
 
-    y = np.trim_zeros(m[2, :], trim='b')
-    yp = np.trim_zeros(m[3, :], trim='b')
-
-    yp = yp[np.abs(y) < 1e10]
-    y = y[np.abs(y) < 1e10]
-
     risetime = plot_offset(ax,
                            y,
                            yp,
@@ -218,18 +294,22 @@ def post_single(n_macroparticles=1e6,
                            Qp_x,
                            Qp_y,
                            n_bunches=1,
-                           n_sampling=1)
+                           n_sampling=1,
+                           turns=turns_offset,
+                           envelope=envelope)
 
-    peak_freqs, peak_amps = plot_Qb(m, n_macroparticles, n_turns, n_bin,
+    peak_freqs, peak_amps = plot_Qb(m_tunes, n_macroparticles, n_turns, n_bin,
                                     bunch_current, Qp_x, Qp_y)
     final_energy_offset, max_energy_offset, min_energy_offset = post_mwi(
-        m, std, n_macroparticles, n_turns, n_bin, bunch_current, Qp_x, Qp_y)
+        m, std, n_macroparticles, n_turns, n_bin, bunch_current, Qp_x, Qp_y,
+        turns)
     final_bunch_length = post_bunch_length(m, std, n_macroparticles, n_turns,
-                                           n_bin, bunch_current, Qp_x, Qp_y)
+                                           n_bin, bunch_current, Qp_x, Qp_y,
+                                           turns)
     with hp.File(filename + '.hdf5') as f:
-        dip_y = f['WakePotentialData_0']['dipole_Wydip'][:]
-        profile_y = f['WakePotentialData_0']['profile_Wydip'][:]
-        tau_y = f['WakePotentialData_0']['tau_Wydip'][:]
+        dip_y = f[wake_data]['dipole_Wydip'][:]
+        profile_y = f[wake_data]['profile_Wydip'][:]
+        tau_y = f[wake_data]['tau_Wydip'][:]
     plot_intrabunch(dip_y, tau_y, profile_y, n_macroparticles, n_turns, n_bin,
                     bunch_current, Qp_x, Qp_y)
     return risetime, peak_freqs, peak_amps, final_energy_offset, max_energy_offset, min_energy_offset, final_bunch_length
@@ -0,0 +1,181 @@
+"""
+Vectorised beam loading and RF feedback for multi-bunch tracking.
+
+CavityResonator.track advances the beam phasor bucket by bucket in Python,
+and bin by bin for the bunches tracked by the process. Between two bunches
+the phasor only decays, and the passage of a bunch adds the voltage induced
+by its profile, so over a turn the phasor follows the linear recursion
+
+    R_b = exp(s T1) R_{b-1} + I_b,    s = -1/filling_time + i wr,
+
+where R_b is beam_phasor_record[b] and I_b the contribution of bunch b,
+referred to its t=0. As the bins of a profile are uniform, the passage of a
+bunch advances the phasor by T1 in total, like an empty bucket. The I_b of
+all buckets are computed at once from the shared profiles, and the
+recursion and the bin-by-bin voltage seen by the tracked bunches are
+evaluated with scipy lfilter.
+
+The generator voltage update of ProportionalIntegralLoop and DirectFeedback
+multiplies the generator current by an (h, h) lower-triangular Toeplitz
+matrix every turn. VectorisedDirectFeedback evaluates the same product as
+the first-order recursion it represents, in O(h).
+
+Both classes give the results of mbtrack2 up to rounding.
+
+Usage:
+    from beam_loading import VectorisedCavityResonator, VectorisedDirectFeedback
+
+    rf = VectorisedCavityResonator(ring, m, Rs, Q, QL, detune, Ncav=Ncav)
+    dfb = VectorisedDirectFeedback(ring=ring, cav_res=rf, ...)
+    rf.feedback.append(dfb)
+"""
+
+import numpy as np
+from mbtrack2.tracking import CavityResonator
+from mbtrack2.tracking.rf import DirectFeedback
+from scipy.signal import lfilter
+
+
+class VectorisedCavityResonator(CavityResonator):
+    """CavityResonator with the beam loading of a turn computed at once.
+
+    Parameters are those of CavityResonator.
+    """
+
+    def _profiles(self, beam) -> tuple:
+        """Gather the profiles of the filled buckets.
+
+        With MPI, the profiles are those shared by beam.mpi, whose number of
+        bins may differ from self.n_bin.
+
+        Returns:
+            Tuple (buckets, center, profile, bin_length, charge_per_mp,
+            sorted_index), with sorted_index a dict over the tracked bunches.
+        """
+        buckets, center, profile, bin_length, charge_per_mp = [], [], [], [], []
+        sorted_index = {}
+        for index in range(self.ring.h):
+            if not beam.filling_pattern[index]:
+                continue
+            if beam.mpi_switch:
+                center.append(beam.mpi.tau_center[index])
+                profile.append(beam.mpi.tau_profile[index])
+                bin_length.append(beam.mpi.tau_bin_length[index])
+                charge_per_mp.append(beam.mpi.charge_per_mp_all[index])
+                if index in self.bunch_indices:
+                    sorted_index[index] = beam.mpi.tau_sorted_index[index]
+            else:
+                bunch = beam[index]
+                if bunch.is_empty:
+                    beam.update_filling_pattern()
+                    beam.update_distance_between_bunches()
+                    continue
+                bins, sorted_index[index], bunch_profile, bunch_center = (
+                    bunch.binning(n_bin=self.n_bin))
+                center.append(bunch_center)
+                profile.append(bunch_profile)
+                bin_length.append(bins[1] - bins[0])
+                charge_per_mp.append(bunch.charge_per_mp)
+            buckets.append(index)
+        n_bin = len(center[0]) if center else self.n_bin
+        return (np.array(buckets, dtype=int),
+                np.reshape(center, (len(buckets), n_bin)),
+                np.reshape(profile, (len(buckets), n_bin)),
+                np.array(bin_length, dtype=float),
+                np.array(charge_per_mp, dtype=float), sorted_index)
+
+    def track(self, beam):
+        """
+        Track a Beam object through the CavityResonator object.
+
+        Can be used with or without mpi. If used with mpi,
+        beam.mpi.share_distributions must be called before.
+
+        Parameters
+        ----------
+        beam : Beam object
+        """
+        if self.tracking is False:
+            self.init_tracking(beam)
+        ring = self.ring
+        rate = -1 / self.filling_time + 1j * self.wr
+        bucket_decay = np.exp(rate * ring.T1)
+        (buckets, center, profile, bin_length, charge_per_mp,
+         sorted_index) = self._profiles(beam)
+        n_bin = profile.shape[1]
+        k = np.arange(n_bin)
+
+        # Phasor induced by each bunch, at its t=0 after the passage.
+        induced = np.zeros(ring.h, dtype=complex)
+        induced[buckets] = (
+            -2 * self.loss_factor * charge_per_mp *
+            np.sum(profile * np.exp(rate * np.outer(bin_length, n_bin - k)),
+                   axis=1) *
+            np.exp(-rate * (center[:, -1] + bin_length/2)))
+        start = self.beam_phasor
+        record = lfilter([1], [1, -bucket_decay], induced,
+                         zi=[start])[0]
+        # Phasor at t=0 of each bucket before the passage.
+        before = np.empty(ring.h, dtype=complex)
+        before[0] = start
+        before[1:] = record[:-1] * bucket_decay
+
+        for j, index in enumerate(buckets):
+            if index not in sorted_index:
+                continue
+            mp_per_bin = profile[j]
+            charge = charge_per_mp[j]
+            length = bin_length[j]
+            bin_decay = np.exp(rate * length)
+            # Beam phasor at the passage of each bin, before its own charge.
+            passed = lfilter([0, bin_decay], [1, -bin_decay], mp_per_bin)
+            beam_phasor = (
+                before[index] *
+                np.exp(rate * (center[j, 0] - length/2 + k*length)) -
+                2 * charge * self.loss_factor * passed)
+            phase = self.m * ring.omega1 * (
+                center[j] + ring.T1 * (index + ring.h * self.nturn))
+            Vgene = np.real(self.generator_phasor_record[index] *
+                            np.exp(1j * phase))
+            Vtot = (Vgene + np.real(beam_phasor) -
+                    charge * self.loss_factor * mp_per_bin)
+            bunch = beam[index]
+            bunch["delta"] += Vtot[sorted_index[index]] / ring.E0
+
+        self.beam_phasor_record = record
+        self.beam_phasor = record[-1] * bucket_decay
+        # apply different kind of RF feedback
+        for fb in self.feedback:
+            fb.track()
+        self.nturn += 1
+
+
+class VectorisedDirectFeedback(DirectFeedback):
+    """DirectFeedback with the generator voltage computed by recursion.
+
+    Parameters are those of DirectFeedback.
+    """
+
+    def init_Ig2Vg_matrix(self):
+        """
+        Initialize the recursion used by Ig2Vg_matrix.
+
+        Shoud be called before first use of Ig2Vg_matrix and after each
+        cavity parameter change.
+        """
+        k = np.arange(0, self.ring.h)
+        self.Ig2Vg_ratio = np.exp(-1 / self.cav_res.filling_time *
+                                  (1 - 1j * np.tan(self.cav_res.psi)) *
+                                  self.ring.T1)
+        self.Ig2Vg_vec = self.Ig2Vg_ratio**(k+1)
+
+    def Ig2Vg_matrix(self):
+        """
+        Return Vg from Ig, with the matrix product as a recursion.
+
+        Warning: self.init_Ig2Vg_matrix should be called after each
+        CavityResonator parameter change.
+        """
+        ig_sum = lfilter([1], [1, -self.Ig2Vg_ratio], self.ig_phasor_record)
+        return (self.Ig2Vg_vec * self.cav_res.generator_phasor_record[-1] +
+                ig_sum * self.cav_res.loss_factor * self.ring.T1)
@@ -0,0 +1,151 @@
+"""
+Thread-parallel tracking of the bunches owned by an MPI rank.
+
+With BalancedMpi each rank owns a contiguous block of bunches, which the
+@Element.parallel elements of mbtrack2 track one after the other. The NumPy
+kernels of these elements release the GIL on macroparticle arrays, so the
+bunches of a rank can be tracked concurrently by a thread pool. A run then
+uses n_ranks x n_threads cores with n_ranks MPI processes, which reduces the
+number of participants in the per-turn collectives.
+
+Only per-bunch elements are dispatched to the pool:
+
+    - stateless elements (maps, synchrotron radiation, exponential damper)
+      are shared by all threads,
+    - elements keeping working arrays on the instance (WakePotential, space
+      charge, IBS, OneTurnMap) are tracked by one private copy per thread.
+      The per-bunch wake data cached by WakePotential for the monitors is
+      merged back into the original element.
+
+Elements with bunch-to-bunch interaction or turn-to-turn state (cavities,
+long-range wakes, FIR damper, monitors) are tracked by the calling thread.
+
+Note:
+    Elements drawing random numbers (synchrotron radiation, IBS) share the
+    global NumPy generator. Draws are thread-safe, but their order across
+    bunches is not reproducible with more than one thread, unless the
+    elements draw from per-bunch RandomStreams (see random_streams), which
+    serialises their bunches.
+
+Usage:
+    from bunch_threads import BunchThreadPool
+
+    pool = BunchThreadPool(beam, n_threads=8)
+    for el in elements:
+        pool.track(el, beam)
+    pool.close()
+"""
+
+import copy
+import queue
+from concurrent.futures import ThreadPoolExecutor
+
+from mbtrack2.tracking import (LongitudinalMap, SynchrotronRadiation,
+                               TransverseMap, WakePotential)
+from mbtrack2.tracking.feedback import TransverseExponentialDamper
+from mbtrack2.tracking.ibs import IntrabeamScattering
+from mbtrack2.tracking.spacecharge import TransverseSpaceCharge
+
+from one_turn_map import OneTurnMap
+
+# Per-bunch elements without state written during tracking.
+SHARED_ELEMENTS = (TransverseMap, LongitudinalMap, SynchrotronRadiation,
+                   TransverseExponentialDamper)
+
+# Per-bunch elements writing working arrays on the instance.
+PER_THREAD_ELEMENTS = (WakePotential, TransverseSpaceCharge,
+                       IntrabeamScattering, OneTurnMap)
+
+# Large read-only attributes shared between an element and its copies.
+SHARED_ATTRIBUTES = ("ring", "wakefield", "streams")
+
+
+def copy_element(element):
+    """Return a deep copy of element sharing its read-only attributes."""
+    memo = {}
+    for name in SHARED_ATTRIBUTES:
+        if hasattr(element, name):
+            value = getattr(element, name)
+            memo[id(value)] = value
+    return copy.deepcopy(element, memo)
+
+
+class BunchThreadPool:
+    """Track the bunches of the local rank with a pool of threads.
+
+    Args:
+        beam: Beam object, with MPI switched on or not.
+        n_threads: Number of threads. With 1 thread, elements are tracked
+            exactly as by element.track(beam).
+    """
+
+    def __init__(self, beam, n_threads: int = 1):
+        self.beam = beam
+        self.n_threads = max(int(n_threads), 1)
+        self.executor = (ThreadPoolExecutor(self.n_threads)
+                         if self.n_threads > 1 else None)
+        self._copies = {}
+
+    @property
+    def bunch_numbers(self) -> list:
+        """Bunches tracked by this rank."""
+        beam = self.beam
+        if beam.mpi_switch:
+            return beam.mpi.bunch_numbers
+        return [int(bn) for bn in beam.bunch_index]
+
+    def threaded(self, element) -> bool:
+        """True if element is tracked bunch by bunch in the pool."""
+        return (self.executor is not None
+                and isinstance(element, SHARED_ELEMENTS + PER_THREAD_ELEMENTS))
+
+    def _element_copies(self, element) -> queue.SimpleQueue:
+        copies = self._copies.get(id(element))
+        if copies is None:
+            copies = queue.SimpleQueue()
+            for _ in range(self.n_threads):
+                copies.put(copy_element(element))
+            self._copies[id(element)] = copies
+        return copies
+
+    def track(self, element, beam) -> None:
+        """Track beam through element, in parallel over bunches if possible."""
+        if not self.threaded(element):
+            element.track(beam)
+            return
+        bunches = [beam[bn] for bn in self.bunch_numbers]
+        if isinstance(element, SHARED_ELEMENTS):
+            futures = [
+                self.executor.submit(element.track, bunch)
+                for bunch in bunches
+            ]
+            for future in futures:
+                future.result()
+            return
+
+        copies = self._element_copies(element)
+
+        def track_with_copy(bunch):
+            local = copies.get()
+            try:
+                local.track(bunch)
+            finally:
+                copies.put(local)
+
+        futures = [
+            self.executor.submit(track_with_copy, bunch) for bunch in bunches
+        ]
+        for future in futures:
+            future.result()
+        if hasattr(element, "_bunch_wake_state"):
+            for _ in range(self.n_threads):
+                local = copies.get()
+                element._bunch_wake_state.update(local._bunch_wake_state)
+                local._bunch_wake_state.clear()
+                copies.put(local)
+
+    def close(self) -> None:
+        """Shut the thread pool down."""
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
@@ -0,0 +1,180 @@
+"""
+Online coupled-bunch mode decomposition of the beam.
+
+For coupled-bunch instability studies, the centroids of all bunches are
+usually reduced to the amplitudes of the h coupled-bunch modes in
+postprocessing. CoupledBunchModeMonitor does this reduction while tracking:
+every save_every turns, the complex centroid of each bucket,
+
+    z_b = x_b - i (alpha x_b + beta x'_b),
+
+is Fourier transformed over the bucket index,
+
+    Z_mu = 1/h sum_b z_b exp(-2 i pi mu b / h),
+
+and the amplitude |Z_mu| in [m] and phase arg(Z_mu) of each mode mu are
+saved for both planes. Empty buckets contribute zero. A rigid offset of all
+bunches is mode 0; a bunch-to-bunch phase advance of 2 pi mu / h is mode mu.
+
+The "CBModes" group holds the datasets amplitude and phase of shape
+(2, h, n_samples), for x and y, and time. mode_growth_rates fits the growth
+rate of each mode from the file.
+
+Usage:
+    from cb_mode_monitor import CoupledBunchModeMonitor, mode_growth_rates
+
+    cb_monitor = CoupledBunchModeMonitor(ring, save_every=10,
+                                         buffer_size=1000, total_size=10000)
+    ...
+    cb_monitor.track(beam)  # every turn, with beam.mpi.mean_all up to date
+    ...
+    rates = mode_growth_rates(file_name, ring, "y", start_turn=25_000)
+"""
+
+import h5py
+import numpy as np
+from mbtrack2.tracking.monitors import Monitor
+
+
+class CoupledBunchModeMonitor(Monitor):
+    """Save the coupled-bunch mode spectrum of the beam centroids.
+
+    With MPI, the bunch means are read from beam.mpi.mean_all, which must
+    be up to date on the saving turns (see Mpi.share_means). All ranks then
+    compute the same spectrum.
+
+    Args:
+        ring: Synchrotron object. Local optics are used.
+        save_every: Number of turns between two samples.
+        buffer_size: Size of the save buffer.
+        total_size: Total number of samples, multiple of buffer_size.
+        file_name: Name of the HDF5 file, see mbtrack2 Monitor.
+        mpi_mode: Open the HDF5 file in parallel mode.
+        write_data: If False, the buffers are filled but only the file
+            metadata is written, e.g. on the MPI ranks other than 0, as
+            all ranks hold the same data.
+    """
+
+    def __init__(self,
+                 ring,
+                 save_every: int,
+                 buffer_size: int,
+                 total_size: int,
+                 file_name: str | None = None,
+                 mpi_mode: bool = False,
+                 write_data: bool = True):
+        self.ring = ring
+        self.write_data = write_data
+        dict_buffer = {
+            "amplitude": (2, ring.h, buffer_size),
+            "phase": (2, ring.h, buffer_size),
+        }
+        dict_file = {
+            "amplitude": (2, ring.h, total_size),
+            "phase": (2, ring.h, total_size),
+        }
+        self.monitor_init("CBModes", save_every, buffer_size, total_size,
+                          dict_buffer, dict_file, file_name, mpi_mode)
+        self.dict_buffer = dict_buffer
+        self.dict_file = dict_file
+        self.alpha = ring.optics.local_alpha
+        self.beta = ring.optics.local_beta
+
+    def due(self) -> bool:
+        """True if the next call to track saves a sample."""
+        return self.track_count % self.save_every == 0
+
+    def spectrum(self, means: np.ndarray) -> np.ndarray:
+        """Return the complex mode spectrum.
+
+        Args:
+            means: Mean of each bucket, shape (6, h).
+
+        Returns:
+            Array of shape (2, h) with the x and y spectra.
+        """
+        spectra = np.empty((2, self.ring.h), dtype=complex)
+        for plane in range(2):
+            u, up = means[2 * plane], means[2*plane + 1]
+            z = u - 1j * (self.alpha[plane] * u + self.beta[plane] * up)
+            spectra[plane] = np.fft.fft(z) / self.ring.h
+        return spectra
+
+    def track(self, beam):
+        """
+        Save data.
+
+        Parameters
+        ----------
+        beam : Beam object
+        """
+        if self.due():
+            if beam.mpi_switch:
+                means = np.zeros((6, self.ring.h))
+                for bunch_num, mean in beam.mpi.mean_all.items():
+                    means[:, bunch_num] = mean
+            else:
+                means = beam.bunch_mean
+            self.to_buffer(means)
+        self.track_count += 1
+
+    def to_buffer(self, means: np.ndarray):
+        """
+        Save the spectrum of the bunch means to buffer.
+
+        Parameters
+        ----------
+        means : array of shape (6, h)
+        """
+        spectra = self.spectrum(means)
+        self.time[self.buffer_count] = self.track_count
+        self.amplitude[:, :, self.buffer_count] = np.abs(spectra)
+        self.phase[:, :, self.buffer_count] = np.angle(spectra)
+        self.buffer_count += 1
+        if self.buffer_count == self.buffer_size:
+            self.write()
+            self.buffer_count = 0
+
+    def write(self):
+        """Write data from buffer to the HDF5 file."""
+        sl = slice(self.write_count * self.buffer_size,
+                   (self.write_count + 1) * self.buffer_size)
+        if self.write_data:
+            group = self.file[self.group_name]
+            group["time"][sl] = self.time
+            group["amplitude"][:, :, sl] = self.amplitude
+            group["phase"][:, :, sl] = self.phase
+        self.file.flush()
+        self.write_count += 1
+
+
+def mode_growth_rates(file_name: str,
+                      ring,
+                      plane: str,
+                      start_turn: int = 0) -> np.ndarray:
+    """Fit the growth rate of each coupled-bunch mode.
+
+    The log of the mode amplitude is fitted by a line over the second half
+    of the samples after start_turn.
+
+    Args:
+        file_name: HDF5 file with a "CBModes" group.
+        ring: Synchrotron object.
+        plane: "x" or "y".
+        start_turn: First turn with the wakes on.
+
+    Returns:
+        Growth rate of each mode in [1/s], shape (h,).
+    """
+    with h5py.File(file_name, "r") as f:
+        time = f["CBModes"]["time"][:]
+        amplitude = f["CBModes"]["amplitude"][0 if plane == "x" else 1]
+    # Samples of an unfinished or stopped run are left at zero.
+    n = np.argmax(np.append(np.diff(time) <= 0, True)) + 1
+    time, amplitude = time[:n], amplitude[:, :n]
+    selected = time >= start_turn
+    time, amplitude = time[selected], amplitude[:, selected]
+    time, amplitude = time[time.size // 2:], amplitude[:, time.size // 2:]
+    log_amplitude = np.log(np.maximum(amplitude, np.finfo(float).tiny))
+    slopes = np.polyfit(time, log_amplitude.T, 1)[0]
+    return slopes / ring.T0
@@ -0,0 +1,278 @@
+"""
+Checkpoint/restart utilities for the tracking loops.
+
+A checkpoint is a single HDF5 file holding everything needed to continue a
+run from a given turn: the macroparticle phase space, the global numpy RNG
+state, the turn-to-turn state of feedback elements, the counters and unflushed
+buffers of the monitors and a small dictionary of loop variables.
+
+Checkpoints are written to a temporary file and atomically moved into place,
+so a job killed while writing never leaves a corrupted checkpoint behind.
+
+Usage:
+    from checkpoint import (CheckpointSignalHandler, load_checkpoint,
+                            save_checkpoint)
+
+    handler = CheckpointSignalHandler()
+    start_turn, loop_state = load_checkpoint(path, bunch, monitors, elements)
+    ...
+    save_checkpoint(path, turn, bunch, monitors, elements, loop_state)
+"""
+
+import os
+import signal
+
+import h5py
+import numpy as np
+
+# Signals sent by the batch scheduler (SLURM/CCRT) before a job is killed.
+CHECKPOINT_SIGNALS = (signal.SIGTERM, signal.SIGUSR1, signal.SIGUSR2)
+
+# Attributes carrying turn-to-turn state of tracking elements
+# (FIR feedback history, cavity phasors, random streams).
+ELEMENT_STATE_ATTRIBUTES = ("pos", "kick", "head", "beam_phasor",
+                            "beam_phasor_record", "generator_phasor_record",
+                            "stream_states")
+
+
+class CheckpointSignalHandler:
+    """Record termination signals so that the loop can checkpoint and stop.
+
+    The handler only sets a flag: the HDF5 files are never touched from
+    inside the signal handler itself. The tracking loop polls ``requested``
+    once per turn.
+
+    Args:
+        signals: Signals to intercept.
+    """
+
+    def __init__(self, signals: tuple = CHECKPOINT_SIGNALS):
+        self.requested = False
+        self.signum = None
+        for signum in signals:
+            signal.signal(signum, self._handle)
+
+    def _handle(self, signum, frame) -> None:
+        self.requested = True
+        self.signum = signum
+
+
+def default_checkpoint_file(monitor_filename: str) -> str:
+    """Return the checkpoint path associated with a monitor file name."""
+    return monitor_filename + ".checkpoint.hdf5"
+
+
+def flush_monitor(monitor, bunch_numbers: list | None = None) -> None:
+    """Write the partially filled buffer of a monitor to its HDF5 file.
+
+    Monitor counters are left untouched, so the buffer keeps filling as
+    usual and the same slice is overwritten by the next regular write.
+
+    Args:
+        monitor: An mbtrack2 Monitor (BunchMonitor, WakePotentialMonitor...).
+        bunch_numbers: For a BeamMonitor in MPI mode, the bunches owned by
+            this rank. Only their rows are written.
+    """
+    n = monitor.buffer_count
+    if n == 0:
+        return
+    sl = slice(monitor.write_count * monitor.buffer_size,
+               monitor.write_count * monitor.buffer_size + n)
+    group = monitor.file[monitor.group_name]
+    for key in ["time"] + list(monitor.dict_buffer):
+        buffer = getattr(monitor, key)
+        if bunch_numbers is None or key == "time":
+            group[key][..., sl] = buffer[..., :n]
+        else:
+            for b in bunch_numbers:
+                group[key][..., b, sl] = buffer[..., b, :n]
+    monitor.file.flush()
+
+
+def restore_monitor(monitor, counters: dict) -> None:
+    """Restore monitor counters and refill its buffer from the HDF5 file.
+
+    Args:
+        monitor: An mbtrack2 Monitor opened on the file of the previous run.
+        counters: Dictionary with track_count, buffer_count and write_count.
+    """
+    for key in ("track_count", "buffer_count", "write_count"):
+        setattr(monitor, key, int(counters[key]))
+    n = monitor.buffer_count
+    if n == 0:
+        return
+    start = monitor.write_count * monitor.buffer_size
+    group = monitor.file[monitor.group_name]
+    for key in ["time"] + list(monitor.dict_buffer):
+        getattr(monitor, key)[..., :n] = group[key][..., start:start + n]
+
+
+def skip_monitor(monitor, n_calls: int) -> None:
+    """Advance monitor counters as if it had been tracked n_calls times.
+
+    Used when the first turns are not tracked, e.g. when the warm-up is read
+    from a cache. The rows of the skipped turns are left empty in the file.
+
+    Args:
+        monitor: A fresh mbtrack2 Monitor.
+        n_calls: Number of skipped calls to monitor.track.
+    """
+    if hasattr(monitor, "skip"):
+        monitor.skip(n_calls)
+        return
+    n_saves = -(-n_calls // monitor.save_every)
+    monitor.track_count = n_calls
+    monitor.write_count, monitor.buffer_count = divmod(n_saves,
+                                                       monitor.buffer_size)
+
+
+def element_state(elements: dict) -> dict:
+    """Return the state attributes of tracking elements as flat arrays.
+
+    Args:
+        elements: Stateful tracking elements, keyed by a stable name.
+
+    Returns:
+        Dictionary keyed by "<name>.<attribute>", e.g. for a cache entry.
+    """
+    state = {}
+    for name, element in elements.items():
+        for key in ELEMENT_STATE_ATTRIBUTES:
+            if hasattr(element, key):
+                state[f"{name}.{key}"] = np.asarray(getattr(element, key))
+    return state
+
+
+def restore_element_state(elements: dict, state: dict) -> None:
+    """Restore the element attributes returned by element_state."""
+    for name, element in elements.items():
+        for key in ELEMENT_STATE_ATTRIBUTES:
+            if f"{name}.{key}" in state:
+                setattr(element, key, state[f"{name}.{key}"])
+
+
+def _write_rng_state(group: h5py.Group) -> None:
+    name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    group.create_dataset("keys", data=keys)
+    group.attrs["name"] = name
+    group.attrs["pos"] = pos
+    group.attrs["has_gauss"] = has_gauss
+    group.attrs["cached_gaussian"] = cached_gaussian
+
+
+def _read_rng_state(group: h5py.Group) -> None:
+    np.random.set_state((str(group.attrs["name"]), group["keys"][:],
+                         int(group.attrs["pos"]), int(group.attrs["has_gauss"]),
+                         float(group.attrs["cached_gaussian"])))
+
+
+def save_checkpoint(path: str,
+                    turn: int,
+                    bunch,
+                    monitors: dict | None = None,
+                    elements: dict | None = None,
+                    loop_state: dict | None = None) -> None:
+    """Write a checkpoint atomically.
+
+    Args:
+        path: Checkpoint file path.
+        turn: Index of the next turn to track when resuming.
+        bunch: Bunch to save.
+        monitors: Monitors to flush, keyed by a stable name.
+        elements: Stateful tracking elements, keyed by a stable name.
+        loop_state: Scalar loop variables (stored as HDF5 attributes).
+    """
+    monitors = monitors or {}
+    elements = elements or {}
+    loop_state = loop_state or {}
+
+    for monitor in monitors.values():
+        flush_monitor(monitor)
+
+    tmp_path = path + ".tmp"
+    with h5py.File(tmp_path, "w") as f:
+        f.attrs["turn"] = turn
+
+        g = f.create_group("bunch")
+        for key, value in bunch.particles.items():
+            g.create_dataset(key, data=value)
+        g.create_dataset("alive", data=bunch.alive)
+        g.attrs["charge_per_mp"] = bunch.charge_per_mp
+        g.attrs["track_alive"] = bunch.track_alive
+
+        _write_rng_state(f.create_group("rng"))
+
+        g = f.create_group("monitors")
+        for name, monitor in monitors.items():
+            m = g.create_group(name)
+            for key in ("track_count", "buffer_count", "write_count"):
+                m.attrs[key] = getattr(monitor, key)
+
+        g = f.create_group("elements")
+        for name, element in elements.items():
+            e = g.create_group(name)
+            for key in ELEMENT_STATE_ATTRIBUTES:
+                if hasattr(element, key):
+                    e.create_dataset(key, data=getattr(element, key))
+
+        g = f.create_group("loop_state")
+        for key, value in loop_state.items():
+            g.attrs[key] = value
+
+    os.replace(tmp_path, path)
+
+
+def load_checkpoint(path: str,
+                    bunch,
+                    monitors: dict | None = None,
+                    elements: dict | None = None) -> tuple[int, dict]:
+    """Restore tracking state from a checkpoint written by save_checkpoint.
+
+    Args:
+        path: Checkpoint file path.
+        bunch: Bunch whose phase space is overwritten.
+        monitors: Monitors to restore, keyed as when saving.
+        elements: Stateful tracking elements, keyed as when saving.
+
+    Returns:
+        Tuple (turn, loop_state) with the next turn to track and the saved
+        loop variables.
+
+    Raises:
+        FileNotFoundError: If the checkpoint file does not exist.
+    """
+    monitors = monitors or {}
+    elements = elements or {}
+
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"Checkpoint file '{path}' not found.")
+
+    with h5py.File(path, "r") as f:
+        turn = int(f.attrs["turn"])
+
+        g = f["bunch"]
+        # Setting Bunch.mp_number re-runs Bunch.__init__, which resets
+        # track_alive and bunch_number: the arrays are replaced directly.
+        bunch._mp_number = len(g["alive"])
+        for key in bunch.particles:
+            bunch.particles[key] = g[key][:]
+        bunch.alive = g["alive"][:]
+        bunch.charge_per_mp = float(g.attrs["charge_per_mp"])
+        bunch.track_alive = bool(g.attrs.get("track_alive",
+                                             bunch.track_alive))
+
+        _read_rng_state(f["rng"])
+
+        for name, monitor in monitors.items():
+            restore_monitor(monitor, dict(f["monitors"][name].attrs))
+
+        for name, element in elements.items():
+            for key, dataset in f["elements"][name].items():
+                setattr(element, key, dataset[()])
+
+        loop_state = {
+            key: value.item() if isinstance(value, np.generic) else value
+            for key, value in f["loop_state"].attrs.items()
+        }
+
+    return turn, loop_state
@@ -0,0 +1,207 @@
+"""
+Demand-driven, non-blocking MPI collectives for the multi-bunch turn loop.
+
+The Mpi.share_* methods of mbtrack2 compute per-bunch data locally and
+gather them with blocking Allgatherv calls. The multi-bunch loop used to call
+all of them every turn, although in a given turn only some elements consume
+the shared data:
+
+    - bunch profiles (share_distributions): CavityResonator with beam
+      loading,
+    - bunch means (share_means): LongRangeResistiveWall, which shares them
+      itself, and the stop policy / wake monitor triggers,
+    - bunch standard deviations (share_stds): not used by any element.
+
+CollectiveScheduler issues only the requested collectives. The local part
+(binning, means) is computed in start() and the gathers are posted as
+non-blocking Iallgatherv calls, so that elements not consuming the data can
+be tracked while the communication is in flight. wait() completes the
+requests and publishes the results in the same attributes of beam.mpi as the
+Mpi.share_* methods.
+
+Usage:
+    from collectives import CollectiveScheduler, required_collectives
+
+    collectives = CollectiveScheduler(beam, n_bin)
+    needs = required_collectives(elements)
+    collectives.start(needs)
+    for el in elements:
+        if collectives.consumes(el):
+            collectives.wait()
+        el.track(beam)
+    collectives.wait()
+"""
+
+import contextlib
+
+import numpy as np
+from mbtrack2.tracking import CavityResonator
+
+DISTRIBUTIONS = "distributions"
+MEANS = "means"
+STDS = "stds"
+
+# Shared data read by tracking elements, by element type.
+CONSUMERS = {
+    CavityResonator: {DISTRIBUTIONS},
+}
+
+
+def required_collectives(elements: list) -> set:
+    """Return the collective data consumed by a list of elements."""
+    needs = set()
+    for el in elements:
+        for element_type, data in CONSUMERS.items():
+            if isinstance(el, element_type):
+                needs |= data
+    return needs
+
+
+class CollectiveScheduler:
+    """Issue the requested Mpi collectives as non-blocking gathers.
+
+    Args:
+        beam: Beam object with MPI switched on.
+        n_bin: Number of bins of the shared longitudinal profiles.
+        profiler: Optional TrackingProfiler. Time spent in start() and wait()
+            is reported under the name of each collective.
+    """
+
+    def __init__(self, beam, n_bin: int = 75, profiler=None):
+        self.beam = beam
+        self.mpi = beam.mpi
+        self.n_bin = int(n_bin)
+        self.profiler = profiler
+        self._requests = []
+        self._send_buffers = []
+        self._finalize = []
+
+    def consumes(self, element) -> bool:
+        """True if element reads shared data, i.e. wait() must come first."""
+        return bool(required_collectives([element]))
+
+    def _section(self, name: str):
+        if self.profiler is None:
+            return contextlib.nullcontext()
+        return self.profiler.section(name)
+
+    def _iallgatherv(self, local: np.ndarray, inner_size: int, dtype,
+                     mpi_dtype) -> np.ndarray:
+        """Post a non-blocking Mpi._allgatherv and return its result buffer."""
+        mpi = self.mpi
+        result = np.empty((mpi.bunch_index.size, inner_size), dtype=dtype)
+        local = np.ascontiguousarray(local, dtype=dtype)
+        sendbuf = [local, mpi.local_count * inner_size, mpi_dtype]
+        recvbuf = [
+            result,
+            (mpi.counts * inner_size).astype(int),
+            (mpi.displacements * inner_size).astype(int),
+            mpi_dtype,
+        ]
+        self._requests.append(mpi.comm.Iallgatherv(sendbuf, recvbuf))
+        # Keep the send buffer alive until the request completes.
+        self._send_buffers.append(local)
+        return result
+
+    def _by_bunch(self, arr: np.ndarray) -> dict:
+        return {
+            int(self.mpi.bunch_index[j]): arr[j]
+            for j in range(self.mpi.bunch_index.size)
+        }
+
+    def _start_distributions(self):
+        mpi, beam, n = self.mpi, self.beam, self.n_bin
+        double = mpi.MPI.DOUBLE
+        local_charge = np.array(
+            [beam[bn].charge_per_mp for bn in mpi.bunch_numbers],
+            dtype=np.float64).reshape(mpi.local_count, 1)
+        local_profile = np.zeros((mpi.local_count, n), dtype=np.int64)
+        local_center = np.zeros((mpi.local_count, n), dtype=np.float64)
+        local_bin_length = np.zeros((mpi.local_count, 1), dtype=np.float64)
+        sorted_index_map = {}
+        for k, bn in enumerate(mpi.bunch_numbers):
+            bunch = beam[bn]
+            if not bunch.is_empty:
+                bins, sorted_index, profile, center = bunch.binning(
+                    dimension="tau", n_bin=n)
+                local_profile[k, :] = profile
+                local_center[k, :] = center
+                local_bin_length[k, 0] = bins[1] - bins[0]
+                sorted_index_map[bn] = sorted_index
+            else:
+                sorted_index_map[bn] = None
+                if beam.filling_pattern[bn]:
+                    beam.update_filling_pattern()
+                    beam.update_distance_between_bunches()
+
+        charge = self._iallgatherv(local_charge, 1, np.float64, double)
+        center = self._iallgatherv(local_center, n, np.float64, double)
+        profile = self._iallgatherv(local_profile, n, np.int64,
+                                    mpi.MPI.INT64_T)
+        bin_length = self._iallgatherv(local_bin_length, 1, np.float64, double)
+
+        def finalize():
+            mpi.charge_per_mp_all = {
+                bn: float(value)
+                for bn, value in self._by_bunch(charge.reshape(-1)).items()
+            }
+            mpi.tau_center = self._by_bunch(center)
+            mpi.tau_profile = self._by_bunch(profile)
+            mpi.tau_bin_length = {
+                bn: float(value)
+                for bn, value in self._by_bunch(bin_length.reshape(-1)).items()
+            }
+            mpi.tau_sorted_index = sorted_index_map
+
+        self._finalize.append(finalize)
+
+    def _start_moments(self, name: str):
+        mpi, beam = self.mpi, self.beam
+        double = mpi.MPI.DOUBLE
+        local_charge = np.array([beam[bn].charge for bn in mpi.bunch_numbers],
+                                dtype=np.float64).reshape(mpi.local_count, 1)
+        local = np.zeros((mpi.local_count, 6), dtype=np.float64)
+        for k, bn in enumerate(mpi.bunch_numbers):
+            bunch = beam[bn]
+            if not bunch.is_empty:
+                local[k, :] = bunch.mean if name == MEANS else bunch.std
+        charge = self._iallgatherv(local_charge, 1, np.float64, double)
+        moments = self._iallgatherv(local, 6, np.float64, double)
+        attribute = "mean_all" if name == MEANS else "std_all"
+
+        def finalize():
+            mpi.charge_all = {
+                bn: float(value)
+                for bn, value in self._by_bunch(charge.reshape(-1)).items()
+            }
+            setattr(mpi, attribute, self._by_bunch(moments))
+
+        self._finalize.append(finalize)
+
+    def start(self, needs: set) -> None:
+        """Compute the local data and post the gathers for needs."""
+        for name in (DISTRIBUTIONS, MEANS, STDS):
+            if name not in needs:
+                continue
+            with self._section("share_" + name):
+                if name == DISTRIBUTIONS:
+                    self._start_distributions()
+                else:
+                    self._start_moments(name)
+
+    def wait(self) -> None:
+        """Complete the pending gathers and publish the results."""
+        if not self._requests:
+            return
+        with self._section("collectives_wait"):
+            self.mpi.MPI.Request.Waitall(self._requests)
+            for finalize in self._finalize:
+                finalize()
+        self._requests = []
+        self._send_buffers = []
+        self._finalize = []
+
+    def share(self, needs: set) -> None:
+        """Blocking equivalent of start() followed by wait()."""
+        self.start(needs)
+        self.wait()
@@ -0,0 +1,329 @@
+"""
+Wake potentials from composite wake tables.
+
+mbtrack2 WakePotential handles each wake type separately: every turn and for
+each type, the wake function is cut to the bunch window, the profile is
+interpolated onto its time base, the convolution is computed and the wake
+potential is interpolated onto the particles.
+
+CompositeWakePotential tabulates all the wake types of a WakeField on one
+common time base at setup, as a composite table of shape (n_types, n_t),
+stored on disk next to the cached wake models. The components are grouped
+by the moment of the bunch they act on:
+
+    - charge profile: Wlong, Wxquad, Wyquad, Wxcst, Wycst,
+    - dipole moment: Wxdip, Wydip,
+
+and each turn the window, the profile interpolation and the interpolation
+onto the particles are done once, with one batched convolution per moment.
+The wake potentials are those of WakePotential when the wake functions
+share their time base, and otherwise differ by the linear resampling on the
+finest sampling. check() compares both paths on a bunch.
+
+Usage:
+    from composite_wake import CompositeWakePotential
+
+    wakefield_tr = CompositeWakePotential(ring, WakeField(wakemodels),
+                                          n_bin=100, cache_dir=cache_dir)
+    deviation = wakefield_tr.check(bunch)
+"""
+
+import copy
+import hashlib
+import os
+import shutil
+import tempfile
+
+import numpy as np
+from mbtrack2.impedance.wakefield import WakeField
+from mbtrack2.tracking import WakePotential
+from mbtrack2.tracking.element import Element
+from scipy.signal import fftconvolve
+
+from wake_cache import DEFAULT_CACHE_DIR, DEFAULT_MAX_SIZE, WakeCache
+
+# Moment of the bunch each wake type acts on.
+MOMENTS = {
+    "Wlong": "charge",
+    "Wxquad": "charge",
+    "Wyquad": "charge",
+    "Wxcst": "charge",
+    "Wycst": "charge",
+    "Wxdip": "dipole",
+    "Wydip": "dipole",
+}
+
+# Coordinate kicked by each wake type.
+KICKED = {
+    "Wlong": "delta",
+    "Wxdip": "xp",
+    "Wydip": "yp",
+    "Wxquad": "xp",
+    "Wyquad": "yp",
+    "Wxcst": "xp",
+    "Wycst": "yp",
+}
+
+
+def composite_table(wakefield: WakeField,
+                    types: list) -> tuple[np.ndarray, np.ndarray]:
+    """Tabulate wake functions on a common uniform time base.
+
+    The time base spans all the wake functions with the finest of their
+    samplings, and each wake function is zero outside of its own table.
+
+    Args:
+        wakefield: WakeField holding the wake types.
+        types: Wake types to tabulate.
+
+    Returns:
+        Time base in [s] of shape (n_t,) and wake functions of shape
+        (len(types), n_t).
+    """
+    bases = [
+        np.array(getattr(wakefield, wake_type).data.index) for wake_type in types
+    ]
+    dtau = min(base[1] - base[0] for base in bases)
+    start = min(base[0] for base in bases)
+    stop = max(base[-1] for base in bases)
+    tau = start + dtau * np.arange(int(np.round((stop - start) / dtau)) + 1)
+    table = np.empty((len(types), tau.size))
+    for k, (wake_type, base) in enumerate(zip(types, bases)):
+        wake = np.array(getattr(wakefield, wake_type).data["real"])
+        if base.size == tau.size and np.allclose(base, tau, rtol=0,
+                                                 atol=1e-3 * dtau):
+            table[k] = wake
+        else:
+            table[k] = np.interp(tau, base, wake, left=0, right=0)
+    return tau, table
+
+
+def cached_composite_table(
+        wakefield: WakeField,
+        types: list,
+        cache_dir: str | None = DEFAULT_CACHE_DIR,
+        max_size: int = DEFAULT_MAX_SIZE) -> tuple[np.ndarray, np.ndarray]:
+    """composite_table through the on-disk wake cache.
+
+    The entry is keyed by a hash of the wake function tables, and shares the
+    directory and size bound of the cached wake models.
+
+    Args:
+        wakefield: WakeField holding the wake types.
+        types: Wake types to tabulate.
+        cache_dir: Cache directory. If None or empty, the table is computed.
+        max_size: Maximum total size of the cache in bytes.
+
+    Returns:
+        See composite_table.
+    """
+    if not cache_dir:
+        return composite_table(wakefield, types)
+    digest = hashlib.sha256()
+    for wake_type in types:
+        data = getattr(wakefield, wake_type).data
+        digest.update(wake_type.encode())
+        digest.update(np.ascontiguousarray(data.index, dtype=float))
+        digest.update(np.ascontiguousarray(data["real"], dtype=float))
+    cache = WakeCache(cache_dir, max_size)
+    path = os.path.join(cache_dir, "composite_" + digest.hexdigest()[:32])
+    file = os.path.join(path, "table.npy")
+    if os.path.exists(file):
+        data = np.load(file, mmap_mode="r")
+        os.utime(path)
+        return np.array(data[0]), np.array(data[1:])
+
+    tau, table = composite_table(wakefield, types)
+    tmp_path = tempfile.mkdtemp(dir=cache_dir, prefix=".tmp_")
+    np.save(os.path.join(tmp_path, "table.npy"), np.vstack([tau, table]))
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # Another job stored the same entry in the meantime.
+        shutil.rmtree(tmp_path, ignore_errors=True)
+    cache.evict()
+    return tau, table
+
+
+class CompositeWakePotential(WakePotential):
+    """WakePotential convolving composite wake tables per bunch moment.
+
+    Args:
+        ring: Synchrotron object.
+        wakefield: WakeField with uniformly sampled wake functions. Wcsr is
+            not supported.
+        n_bin: Number of bins for the bunch profile.
+        cache_dir: Directory of the composite table cache. If None or empty,
+            the table is computed.
+
+    Raises:
+        ValueError: If a wake type is not supported.
+    """
+
+    def __init__(self,
+                 ring,
+                 wakefield: WakeField,
+                 n_bin: int = 128,
+                 cache_dir: str | None = DEFAULT_CACHE_DIR):
+        super().__init__(ring, wakefield, n_bin=n_bin)
+        unknown = [t for t in self.types if t not in MOMENTS]
+        if unknown:
+            raise ValueError(f"Wake types not supported: {unknown}.")
+        self.types = list(self.types)
+        self.table_tau, table = cached_composite_table(wakefield, self.types,
+                                                       cache_dir)
+        self.table_dtau = self.table_tau[1] - self.table_tau[0]
+        # Wlong enters the wake potential with a minus sign.
+        sign = np.array([-1 if t == "Wlong" else 1 for t in self.types])
+        self.table = table * sign[:, None]
+        self.groups = {
+            moment: [k for k, t in enumerate(self.types) if MOMENTS[t] == moment]
+            for moment in ("charge", "dipole")
+        }
+
+    def prepare_tables(self, tau: np.ndarray) -> tuple:
+        """
+        Restrict the composite table to the bunch profile time array.
+
+        Same as WakePotential.prepare_wakefunction, for all the wake types
+        at once.
+
+        Parameters
+        ----------
+        tau : array
+            Time domain array of the bunch profile in [s].
+
+        Returns
+        -------
+        tau0 : array
+            Time base of the wake functions in [s].
+        dtau0 : float
+            Difference between two points of the time base in [s].
+        W0 : array of shape (n_types, len(tau0))
+            Wake functions, with the sign of the wake potential.
+        """
+        tau0 = self.table_tau
+        dtau0 = self.table_dtau
+        W0 = self.table
+
+        # Keep only the wake function on the rho window
+        ind = (tau0 > min(tau[0], 0)) & (tau0 < max(tau[-1], 0))
+        tau0 = tau0[ind]
+        W0 = W0[:, ind]
+
+        # Check the wake function window for assymetry
+        assym = (np.abs(tau0[-1]) - np.abs(tau0[0])) / dtau0
+        n_assym = int(np.floor(assym))
+        if np.floor(assym) > 1:
+            if np.abs(tau0[-1]) > np.abs(tau0[0]):
+                tau0 = np.arange(tau0[0] - dtau0*n_assym, tau0[-1] + dtau0,
+                                 dtau0)
+                n_to_add = len(tau0) - W0.shape[1]
+                W0 = np.pad(W0, ((0, 0), (n_to_add, 0)))
+            elif np.abs(tau0[0]) > np.abs(tau0[-1]):
+                tau0 = np.arange(tau0[0], tau0[-1] + dtau0 * (n_assym+1),
+                                 dtau0)
+                n_to_add = len(tau0) - W0.shape[1]
+                W0 = np.pad(W0, ((0, 0), (0, n_to_add)))
+
+        # Check is the wf is shorter than rho then add zeros
+        if (tau0[0] > tau[0]) or (tau0[-1] < tau[-1]):
+            n = max(int(np.ceil((tau0[0] - tau[0]) / dtau0)),
+                    int(np.ceil((tau[-1] - tau0[-1]) / dtau0)))
+            tau0 = np.arange(tau0[0] - dtau0*n, tau0[-1] + dtau0 * (n+1),
+                             dtau0)
+            W0 = np.pad(W0, ((0, 0), (n, len(tau0) - W0.shape[1] - n)))
+
+        return tau0, dtau0, W0
+
+    @Element.parallel
+    @Element.track_bunch_if_non_empty
+    def track(self, bunch):
+        """
+        Tracking method for the element.
+        No bunch to bunch interaction, so written for Bunch objects and
+        @Element.parallel is used to handle Beam objects.
+
+        Parameters
+        ----------
+        bunch : Bunch or Beam object.
+
+        """
+        self.charge_density(bunch)
+        tau0, dtau0, W0 = self.prepare_tables(self.tau)
+        profile0 = self._interp_regular_numpy(tau0, np.min(self.tau),
+                                              self.dtau, self.rho)
+        Wp = np.empty_like(W0)
+        charge = self.groups["charge"]
+        if charge:
+            # "same" keeps the shape of the first argument.
+            sources = np.broadcast_to(profile0, (len(charge), len(tau0)))
+            Wp[charge] = fftconvolve(sources, W0[charge], mode="same",
+                                     axes=1) * dtau0
+        dipole = self.groups["dipole"]
+        if dipole:
+            sources = np.array([
+                profile0 * self.dipole_moment(bunch, self.types[k][1], tau0)
+                for k in dipole
+            ])
+            Wp[dipole] = fftconvolve(sources, W0[dipole], mode="same",
+                                     axes=1) * dtau0
+
+        # Linear interpolation onto the particles, shared by all types.
+        tau = bunch["tau"]
+        position = (tau - np.min(tau0 + self.tau_mean)) / dtau0
+        valid = (position >= 0) & (position <= len(tau0) - 1)
+        index = np.clip(position[valid].astype(int), 0, len(tau0) - 2)
+        weight = position[valid] - index
+        factor = bunch.charge / self.ring.E0
+        for k, wake_type in enumerate(self.types):
+            kick = np.zeros_like(tau)
+            kick[valid] = Wp[k, index] + weight * (Wp[k, index + 1] -
+                                                   Wp[k, index])
+            kick *= factor
+            if wake_type == "Wxquad":
+                kick *= bunch["x"]
+            elif wake_type == "Wyquad":
+                kick *= bunch["y"]
+            bunch[KICKED[wake_type]] += kick
+            setattr(self, "tau0_" + wake_type, tau0)
+            setattr(self, "profile0_" + wake_type, profile0)
+            setattr(self, wake_type, Wp[k])
+
+        self._cache_wake(bunch)
+
+    def check(self, bunch, rtol: float = 1e-3) -> float:
+        """Compare the kicks with those of WakePotential on a bunch.
+
+        Both paths are tracked on copies of bunch, which is not modified.
+
+        Args:
+            bunch: Bunch used for the comparison.
+            rtol: Tolerance on the deviation, relative to the largest kick
+                of each coordinate.
+
+        Returns:
+            Largest relative deviation over the kicked coordinates.
+
+        Raises:
+            ValueError: If the deviation exceeds rtol.
+        """
+        reference = copy.deepcopy(bunch)
+        composite = copy.deepcopy(bunch)
+        WakePotential(self.ring, self.wakefield,
+                      n_bin=self.n_bin).track(reference)
+        self.track(composite)
+
+        deviation = 0.0
+        for key in sorted(set(KICKED[t] for t in self.types)):
+            kick = reference[key] - bunch[key]
+            scale = np.max(np.abs(kick)) or 1.0
+            deviation = max(
+                deviation,
+                np.max(np.abs(composite[key] - reference[key])) / scale)
+        if deviation > rtol:
+            raise ValueError(
+                f"Composite wake tables deviate from the separate wake "
+                f"functions by {deviation:.2e} (relative), above tolerance "
+                f"{rtol:.1e}.")
+        return deviation
@@ -0,0 +1,216 @@
+"""
+Decimating, compressed bunch monitor.
+
+A BunchMonitor saving every turn writes ``n_turns`` samples per dataset, most
+of which are later averaged away in postprocessing. DecimatingBunchMonitor
+keeps full turn-by-turn resolution only inside windows of interest (e.g.
+around the wake switch-on and at the end of the run). Outside the windows,
+each block of ``decimation`` turns is reduced to one sample holding the
+block mean, with the block minimum and maximum saved alongside.
+
+The BunchData group keeps the layout of BunchMonitor (mean, std, emit,
+current, cs_invariant and time, with the sample index on the last axis), but
+samples are not turns: readers take the turn of each sample from the time
+dataset, which holds the first turn of the sample. For every key the
+``<key>_min`` and ``<key>_max`` datasets hold the block reductions.
+post_single of postprocessing takes the tunes from the longest window and
+fits the rise time on the offset envelope given by the block extrema. The
+datasets are chunked by buffer and compressed (shuffle + gzip by default).
+
+Usage:
+    from decimating_monitor import DecimatingBunchMonitor
+
+    bunch_monitor = DecimatingBunchMonitor(0, n_turns,
+                                           windows=[[25_000, 35_000]],
+                                           decimation=100,
+                                           file_name=monitor_filename)
+"""
+
+import numpy as np
+from mbtrack2.tracking.monitors import BunchMonitor
+
+from stopping import trim_monitor
+
+
+def sample_starts(total_turns: int, windows: list, decimation: int) -> np.ndarray:
+    """Return the first turn of each saved sample.
+
+    Args:
+        total_turns: Number of tracked turns.
+        windows: List of [start, stop) turn ranges saved at full resolution.
+        decimation: Number of turns per sample outside the windows.
+
+    Returns:
+        Increasing array of turns.
+    """
+    full = np.zeros(total_turns + 1, dtype=bool)
+    for start, stop in windows:
+        full[max(int(start), 0):min(int(stop), total_turns)] = True
+    starts = []
+    turn = 0
+    while turn < total_turns:
+        starts.append(turn)
+        if full[turn]:
+            turn += 1
+        else:
+            # The block ends after decimation turns or when a window begins.
+            block = full[turn:turn + decimation]
+            turn += int(np.argmax(block)) if block.any() else len(block)
+    return np.array(starts, dtype=int)
+
+
+class DecimatingBunchMonitor(BunchMonitor):
+    """BunchMonitor with decimation outside windows and compressed output.
+
+    Args:
+        bunch_number: Bunch to monitor.
+        total_turns: Number of turns the monitor is tracked.
+        windows: List of [start, stop) turn ranges saved at full resolution.
+        decimation: Number of turns reduced to one sample outside windows.
+        buffer_size: Number of samples per buffer, also the chunk length.
+        file_name: Name of the HDF5 file, see mbtrack2 Monitor.
+        mpi_mode: Open the HDF5 file in parallel mode. Compression needs
+            collective writes and is disabled in this mode.
+        compression: HDF5 compression filter, or None.
+        compression_opts: Options of the compression filter.
+        shuffle: Apply the byte-shuffle filter before compression.
+
+    Note:
+        The block accumulators are not part of checkpoints: a block
+        interrupted by a restart is reduced over the turns tracked after the
+        restart only.
+    """
+
+    KEYS = {
+        "mean": (6, ),
+        "std": (6, ),
+        "emit": (3, ),
+        "current": (),
+        "cs_invariant": (3, ),
+    }
+
+    def __init__(self,
+                 bunch_number: int,
+                 total_turns: int,
+                 windows: list = (),
+                 decimation: int = 100,
+                 buffer_size: int = 1000,
+                 file_name: str | None = None,
+                 mpi_mode: bool = False,
+                 compression: str | None = "gzip",
+                 compression_opts: int | None = 4,
+                 shuffle: bool = True):
+        self.bunch_number = bunch_number
+        self.windows = [list(window) for window in windows]
+        self.decimation = max(int(decimation), 1)
+        self.sample_starts = sample_starts(int(total_turns), self.windows,
+                                           self.decimation)
+        self.n_samples = len(self.sample_starts)
+        # Last turn of each sample; the sample is saved after this turn.
+        self.sample_ends = np.append(self.sample_starts[1:] - 1,
+                                     int(total_turns) - 1)
+        buffer_size = int(min(buffer_size, self.n_samples))
+        total_size = -(-self.n_samples // buffer_size) * buffer_size
+
+        dict_buffer, dict_file = {}, {}
+        for key, shape in self.KEYS.items():
+            for name in (key, key + "_min", key + "_max"):
+                dict_buffer[name] = shape + (buffer_size, )
+                dict_file[name] = shape + (total_size, )
+        group_name = "BunchData_" + str(self.bunch_number)
+        # Datasets are created below with chunking and compression.
+        self.monitor_init(group_name, 1, buffer_size, total_size, dict_buffer,
+                          {}, file_name, mpi_mode)
+        if mpi_mode:
+            compression, shuffle = None, False
+        filters = {}
+        if compression is not None:
+            filters = {"compression": compression,
+                       "compression_opts": compression_opts}
+        for key, shape in dict_file.items():
+            self.g.require_dataset(key,
+                                   shape,
+                                   dtype=float,
+                                   chunks=shape[:-1] + (buffer_size, ),
+                                   shuffle=shuffle,
+                                   **filters)
+        self.slice_dict = {
+            key: [slice(None)] * (len(shape) - 1)
+            for key, shape in dict_file.items()
+        }
+        self.dict_buffer = dict_buffer
+        self.dict_file = dict_file
+        self.g.attrs["windows"] = np.array(self.windows, dtype=int).reshape(-1, 2)
+        self.g.attrs["decimation"] = self.decimation
+        self.g.attrs["n_samples"] = self.n_samples
+
+        self._sum = {}
+        self._min = {}
+        self._max = {}
+        self._last = {}
+        self._count = 0
+
+    @property
+    def sample_count(self) -> int:
+        """Number of samples saved so far."""
+        return self.write_count * self.buffer_size + self.buffer_count
+
+    def latest(self, key: str) -> np.ndarray:
+        """Return the value of key saved in the last call, before reduction."""
+        return self._last[key]
+
+    def to_buffer(self, bunch):
+        """
+        Accumulate the bunch data of this turn and save completed samples.
+
+        Parameters
+        ----------
+        bunch : Bunch object
+        """
+        turn = self.track_count
+        for key in self.KEYS:
+            value = np.asarray(getattr(bunch, key), dtype=float)
+            self._last[key] = value
+            if self._count == 0:
+                self._sum[key] = value.copy()
+                self._min[key] = value.copy()
+                self._max[key] = value.copy()
+            else:
+                self._sum[key] += value
+                np.minimum(self._min[key], value, out=self._min[key])
+                np.maximum(self._max[key], value, out=self._max[key])
+        self._count += 1
+
+        sample = self.sample_count
+        if sample < self.n_samples and turn >= self.sample_ends[sample]:
+            self.time[self.buffer_count] = self.sample_starts[sample]
+            for key in self.KEYS:
+                index = tuple(self.slice_dict[key]) + (self.buffer_count, )
+                getattr(self, key)[index] = self._sum[key] / self._count
+                getattr(self, key + "_min")[index] = self._min[key]
+                getattr(self, key + "_max")[index] = self._max[key]
+            self._count = 0
+            self.buffer_count += 1
+            if self.buffer_count == self.buffer_size:
+                self.write()
+                self.buffer_count = 0
+
+    def skip(self, n_turns: int) -> None:
+        """Advance the monitor past the first n_turns turns without data."""
+        n_saves = int(np.searchsorted(self.sample_ends, n_turns))
+        self.track_count = n_turns
+        self.write_count, self.buffer_count = divmod(n_saves, self.buffer_size)
+        self._count = 0
+
+    def close(self):
+        """
+        Save the samples still in the buffer, drop the padding rows and
+        close the HDF5 file.
+
+        The file is shared by all monitors and may already have been closed
+        by another one, which empties the file storage of mbtrack2 Monitor.
+        There is then nothing left to save.
+        """
+        if self._file_storage:
+            trim_monitor(self)
+            super().close()
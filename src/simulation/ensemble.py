@@ -0,0 +1,164 @@
+"""
+Ensemble tracking of independent single-bunch configurations.
+
+An EnsembleBunch stacks the macroparticles of N independent bunches (members)
+into one Bunch so that single-particle elements (transverse and longitudinal
+maps, synchrotron radiation, RF cavities) are applied once per turn to the
+stacked arrays. Collective elements (wakes, feedback, IBS, space charge) and
+monitors are applied member by member on Bunch objects whose coordinates are
+views into the stacked arrays.
+
+Members may differ in bunch current, chromaticity and random seed.
+
+Usage:
+    from ensemble import EnsembleBunch, EnsembleTransverseMap
+
+    ensemble = EnsembleBunch(ring, members, mp_number)
+    trans_map = EnsembleTransverseMap(ring, ensemble.member_values('Qp_x'),
+                                      ensemble.member_values('Qp_y'),
+                                      mp_number)
+    ensemble.track([(trans_map, None), (monitor_k, k), ...])
+"""
+
+import numpy as np
+from mbtrack2.tracking import Bunch, TransverseMap
+
+
+class EnsembleTransverseMap(TransverseMap):
+    """One-turn transverse map with a chromaticity per ensemble member.
+
+    The first-order chromaticities are expanded to one value per
+    macroparticle of the stacked bunch, which mbtrack2's chromatic tune
+    advance broadcasts over.
+
+    Args:
+        ring: Synchrotron object.
+        chro_x: Horizontal chromaticity of each member.
+        chro_y: Vertical chromaticity of each member.
+        mp_number: Number of macroparticles per member.
+    """
+
+    def __init__(self, ring, chro_x: list, chro_y: list, mp_number: int):
+        super().__init__(ring)
+        self.chro_diff = [
+            np.repeat(np.asarray(chro_x, dtype=float), mp_number),
+            np.repeat(np.asarray(chro_y, dtype=float), mp_number),
+        ]
+
+
+class EnsembleBunch:
+    """Stacked bunch holding the macroparticles of all ensemble members.
+
+    Args:
+        ring: Synchrotron object.
+        members: List of member configurations. Keys used here are
+            bunch_current and seed.
+        mp_number: Number of macroparticles per member.
+        track_alive: Passed to the member Bunch objects.
+    """
+
+    def __init__(self, ring, members: list, mp_number: int,
+                 track_alive: bool = False):
+        self.ring = ring
+        self.config = members
+        self.mp_number = int(mp_number)
+        self.members = []
+        for k, member in enumerate(members):
+            bunch = Bunch(ring,
+                          mp_number=mp_number,
+                          current=member['bunch_current'],
+                          track_alive=track_alive)
+            np.random.seed(member.get('seed', 42))
+            bunch.init_gaussian()
+            bunch.bunch_number = k
+            self.members.append(bunch)
+
+        # A Bunch with no current is built empty, with one macroparticle and
+        # track_alive forced to True: the stacked bunch carries the summed
+        # current of the members.
+        self.stacked = Bunch(ring,
+                             mp_number=mp_number * len(members),
+                             current=sum(self.member_values('bunch_current')),
+                             track_alive=track_alive)
+        self.stacked.charge_per_mp = (
+            sum(bunch.charge for bunch in self.members) /
+            self.stacked.mp_number)
+        for key in self.stacked.particles:
+            self.stacked.particles[key] = np.concatenate(
+                [bunch.particles[key] for bunch in self.members])
+        self.stacked.alive = np.concatenate(
+            [bunch.alive for bunch in self.members])
+        self.slices = [
+            slice(k * self.mp_number, (k+1) * self.mp_number)
+            for k in range(len(members))
+        ]
+        self.to_members()
+
+    def __len__(self) -> int:
+        return len(self.members)
+
+    def __getitem__(self, k: int) -> Bunch:
+        return self.members[k]
+
+    def member_values(self, key: str) -> list:
+        """Return the value of a configuration key for every member."""
+        return [member[key] for member in self.config]
+
+    def to_members(self) -> None:
+        """Point the member coordinates to views of the stacked arrays.
+
+        Must be called after stacked elements, which rebind the arrays of
+        the stacked bunch.
+        """
+        for bunch, sl in zip(self.members, self.slices):
+            for key, value in self.stacked.particles.items():
+                bunch.particles[key] = value[sl]
+            bunch.alive = self.stacked.alive[sl]
+
+    def to_stacked(self) -> None:
+        """Copy member coordinates rebound by member elements back.
+
+        Coordinates updated in place are already views of the stacked arrays
+        and are not copied.
+        """
+        for bunch, sl in zip(self.members, self.slices):
+            for key, value in bunch.particles.items():
+                stacked = self.stacked.particles[key]
+                if value.base is not stacked:
+                    stacked[sl] = value
+                    bunch.particles[key] = stacked[sl]
+            if bunch.alive.base is not self.stacked.alive:
+                self.stacked.alive[sl] = bunch.alive
+                bunch.alive = self.stacked.alive[sl]
+
+    def track(self, elements: list, profiler=None) -> None:
+        """Track the ensemble through a list of elements for one turn.
+
+        Args:
+            elements: List of (element, member) pairs. member is None for
+                single-particle elements tracked on the stacked bunch, or the
+                index of the member the element applies to.
+            profiler: Optional TrackingProfiler.
+        """
+        stacked_phase = True
+        for element, member in elements:
+            name = type(element).__name__
+            if member is None:
+                if not stacked_phase:
+                    self.to_stacked()
+                    stacked_phase = True
+                bunch = self.stacked
+            else:
+                if stacked_phase:
+                    self.to_members()
+                    stacked_phase = False
+                bunch = self.members[member]
+            if profiler is None:
+                element.track(bunch)
+            else:
+                with profiler.section(name):
+                    element.track(bunch)
+        if stacked_phase:
+            self.to_members()
+        else:
+            self.to_stacked()
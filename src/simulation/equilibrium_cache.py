@@ -0,0 +1,336 @@
+"""
+On-disk memoisation of beam-loading equilibria for harmonic-cavity setups.
+
+Solving the BeamLoadingEquilibrium and initialising the cavity beam phasors
+is a serial computation repeated identically by most jobs of a scan. The
+results are small (a few scalars and arrays), so they are stored as ``.npz``
+files keyed by a hash of the ring and cavity parameters and of the current.
+
+Usage:
+    from equilibrium_cache import init_phasor_cached, memoize
+
+    result = memoize("active_cavity", params, compute, cache_dir)
+    init_phasor_cached(cavity, beam, bunch_current, cache_dir)
+
+A grid of equilibria can be computed once before submitting a scan with
+precompute_active_cavity_grid().
+
+The end state of the wake-free warm-up of a single bunch is cached the same
+way (warmup_params, bunch_state, restore_bunch_state): jobs of a scan that
+share the ring, current, number of macroparticles, longitudinal impedance,
+harmonic cavity, chromaticity, feedback and seed start directly from the
+equilibrated bunch.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+from wake_cache import ring_fingerprint
+
+DEFAULT_CACHE_DIR = os.environ.get(
+    "TI_EQUILIBRIUM_CACHE_DIR",
+    os.path.join(os.path.expanduser("~"), ".cache", "transverse_instabilities",
+                 "equilibria"))
+
+# Ring parameters entering the beam-loading equilibrium.
+RING_KEYS = ("h", "L", "E0", "ac", "U0", "sigma_delta", "sigma_0", "tau",
+             "tune")
+
+
+def _to_json(value):
+    if isinstance(value, complex):
+        return [value.real, value.imag]
+    if isinstance(value, np.ndarray) or isinstance(value, np.generic):
+        value = np.asarray(value)
+        if np.iscomplexobj(value):
+            return [value.real.tolist(), value.imag.tolist()]
+        return value.tolist()
+    raise TypeError(f"Cannot hash value of type {type(value).__name__}")
+
+
+def cache_key(kind: str, params: dict) -> str:
+    """Return the cache key for a computation kind and its parameters."""
+    text = json.dumps({"kind": kind, "params": params},
+                      sort_keys=True,
+                      default=_to_json)
+    return kind + "_" + hashlib.sha256(text.encode()).hexdigest()[:32]
+
+
+def lookup(kind: str, params: dict, cache_dir: str | None) -> dict | None:
+    """Return the cached result of a computation, or None on a cache miss.
+
+    Args:
+        kind: Name of the computation, used as file name prefix.
+        params: JSON-serialisable parameters the result depends on.
+        cache_dir: Cache directory. If None or empty, always a miss.
+
+    Returns:
+        Dictionary with the cached values, or None.
+    """
+    if not cache_dir:
+        return None
+    path = os.path.join(cache_dir, cache_key(kind, params) + ".npz")
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as data:
+        return {
+            key: value.item() if value.ndim == 0 else value
+            for key, value in data.items()
+        }
+
+
+def store(kind: str, params: dict, result: dict,
+          cache_dir: str | None) -> None:
+    """Store the result of a computation in the cache.
+
+    The file is written under a temporary name and renamed, so concurrent
+    jobs never read a partially written entry.
+
+    Args:
+        kind: Name of the computation, used as file name prefix.
+        params: JSON-serialisable parameters the result depends on.
+        result: Dictionary of scalars or arrays.
+        cache_dir: Cache directory. If None or empty, nothing is stored.
+    """
+    if not cache_dir:
+        return
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, cache_key(kind, params) + ".npz")
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix=".npz")
+    with os.fdopen(fd, "wb") as f:
+        np.savez(f, **result)
+    os.replace(tmp_path, path)
+
+
+def memoize(kind: str, params: dict, compute, cache_dir: str | None) -> dict:
+    """Return compute() from the cache, computing and storing it if needed.
+
+    Args:
+        kind: Name of the computation, used as file name prefix.
+        params: JSON-serialisable parameters the result depends on.
+        compute: Callable without arguments returning a dict of scalars or
+            arrays.
+        cache_dir: Cache directory. If None or empty, compute() is always
+            called.
+
+    Returns:
+        Dictionary with the computed values.
+    """
+    result = lookup(kind, params, cache_dir)
+    if result is None:
+        result = compute()
+        store(kind, params, result, cache_dir)
+    return result
+
+
+def cavity_fingerprint(cavity) -> dict:
+    """Return the parameters of a CavityResonator setting its phasors."""
+    return {
+        "m": cavity.m,
+        "Rs": cavity.Rs,
+        "Q": cavity.Q,
+        "QL": cavity.QL,
+        "detune": cavity.detune,
+        "Ncav": cavity.Ncav,
+        "Vc": cavity.Vc,
+        "theta": cavity.theta,
+        "n_bin": cavity.n_bin,
+    }
+
+
+def init_phasor_cached(cavity,
+                       beam,
+                       bunch_current: float,
+                       cache_dir: str | None = DEFAULT_CACHE_DIR,
+                       seed: int | None = None,
+                       mp_per_bunch=None,
+                       random_streams: bool = False) -> None:
+    """Initialise the beam phasor of a CavityResonator through the cache.
+
+    The cached phasor corresponds to the initial Gaussian distribution of the
+    current in each bucket of the beam, so the key includes the seed and
+    macroparticle numbers of the bunches. Without random streams, the
+    initial profiles also depend on the number of MPI ranks. On a cache hit,
+    only init_tracking is called and the stored beam phasor is restored.
+
+    With MPI, rank 0 looks the phasor up and shares the result, so that all
+    ranks call the collectives of cavity.init_phasor on a miss.
+
+    Args:
+        cavity: CavityResonator object.
+        beam: Beam object, as passed to cavity.init_phasor.
+        bunch_current: Bunch current in [A].
+        cache_dir: Cache directory. If None or empty, the cache is bypassed.
+        seed: Seed of the initial distributions.
+        mp_per_bunch: Macroparticle number of each bucket.
+        random_streams: True if the bunches were initialised from
+            RandomStreams.
+    """
+    params = {
+        "ring": ring_fingerprint(cavity.ring, RING_KEYS),
+        "cavity": cavity_fingerprint(cavity),
+        "filling_pattern": np.asarray(beam.bunch_current, dtype=float),
+        "bunch_current": bunch_current,
+        "seed": seed,
+        "mp_per_bunch": (None if mp_per_bunch is None
+                         else np.asarray(mp_per_bunch, dtype=int)),
+    }
+    if random_streams:
+        params["random_streams"] = True
+    elif beam.mpi_switch:
+        params["n_ranks"] = beam.mpi.size
+
+    rank = beam.mpi.rank if beam.mpi_switch else 0
+    # (hit, real, imaginary) of the phasor found by rank 0, shared with a sum
+    # as the shared-memory communicator has no bcast.
+    found = np.zeros(3)
+    if rank == 0:
+        result = lookup("beam_phasor", params, cache_dir)
+        if result is not None:
+            phasor = complex(result["beam_phasor"])
+            found[:] = (1, phasor.real, phasor.imag)
+    if beam.mpi_switch:
+        found = beam.mpi.comm.allreduce(found)
+    if found[0]:
+        beam_phasor = complex(found[1], found[2])
+    else:
+        cavity.init_phasor(beam)
+        beam_phasor = cavity.beam_phasor
+        if rank == 0:
+            store("beam_phasor", params, {"beam_phasor": beam_phasor},
+                  cache_dir)
+    if cavity.tracking is False:
+        cavity.init_tracking(beam)
+    cavity.beam_phasor = complex(beam_phasor)
+
+
+def precompute_active_cavity_grid(ring,
+                                  currents: list,
+                                  xis: list,
+                                  Vc: float = 1.7e6,
+                                  cache_dir: str = DEFAULT_CACHE_DIR) -> list:
+    """Solve and cache the active harmonic-cavity equilibria of a scan grid.
+
+    Run once before submitting a scan so that every job finds its
+    equilibrium in the cache.
+
+    Args:
+        ring: Synchrotron object.
+        currents: Total beam currents in [A].
+        xis: Harmonic cavity detuning ratios.
+        Vc: Main cavity voltage in [V].
+        cache_dir: Cache directory.
+
+    Returns:
+        List of the equilibrium dictionaries, in grid order.
+    """
+    from setup_tracking import (ACTIVE_HC, ACTIVE_MC,
+                                solve_active_cavity_equilibrium)
+
+    results = []
+    for I0 in currents:
+        for xi in xis:
+            params = active_cavity_params(ring, I0, xi, Vc, ACTIVE_MC,
+                                          ACTIVE_HC)
+            results.append(
+                memoize("active_cavity", params,
+                        lambda: solve_active_cavity_equilibrium(
+                            ring, I0, xi, Vc), cache_dir))
+    return results
+
+
+def active_cavity_params(ring, I0: float, xi: float, Vc: float,
+                         main_cavity: dict, harmonic_cavity: dict) -> dict:
+    """Return the cache parameters of an active harmonic-cavity equilibrium.
+
+    Args:
+        ring: Synchrotron object.
+        I0: Total beam current in [A].
+        xi: Harmonic cavity detuning ratio.
+        Vc: Main cavity voltage in [V].
+        main_cavity: CavityResonator parameters (m, Rs, Q, QL, Ncav) of the
+            main cavity.
+        harmonic_cavity: CavityResonator parameters of the harmonic cavity.
+    """
+    return {
+        "ring": ring_fingerprint(ring, RING_KEYS),
+        "I0": I0,
+        "xi": xi,
+        "Vc": Vc,
+        "main_cavity": dict(main_cavity),
+        "harmonic_cavity": dict(harmonic_cavity),
+    }
+
+
+def warmup_params(ring,
+                  bunch_current: float,
+                  n_macroparticles: int,
+                  include_Zlong: bool,
+                  harmonic_cavity: bool,
+                  seed: int,
+                  warmup_turns: int,
+                  chro,
+                  feedback,
+                  **extra) -> dict:
+    """Return the cache parameters of a warmed-up single bunch.
+
+    Chromaticity is part of the key, as chromatic phase mixing changes the
+    macroparticle distribution, and so is the feedback damping the centroid
+    during the warm-up.
+
+    Args:
+        ring: Synchrotron object.
+        bunch_current: Bunch current in [A].
+        n_macroparticles: Number of macroparticles.
+        include_Zlong: If True, the longitudinal wake is tracked.
+        harmonic_cavity: If True, the harmonic cavity is on.
+        seed: Seed of the initial distribution.
+        warmup_turns: Number of warm-up turns.
+        chro: Chromaticities (Qp_x, Qp_y).
+        feedback: JSON-serialisable settings of the transverse feedback
+            tracked during the warm-up, None if it is not tracked.
+        **extra: Other JSON-serialisable settings affecting the warm-up.
+
+    Returns:
+        Parameter dictionary for lookup() and store().
+    """
+    return {
+        "ring": ring_fingerprint(ring, RING_KEYS + ("emit",)),
+        "bunch_current": bunch_current,
+        "n_macroparticles": int(n_macroparticles),
+        "include_Zlong": bool(include_Zlong),
+        "harmonic_cavity": bool(harmonic_cavity),
+        "seed": seed,
+        "warmup_turns": int(warmup_turns),
+        "chro": [float(c) for c in chro],
+        "feedback": feedback,
+        **extra,
+    }
+
+
+def bunch_state(bunch) -> dict:
+    """Return the macroparticle coordinates and global RNG state to cache."""
+    name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    state = {key: np.asarray(value) for key, value in bunch.particles.items()}
+    state.update({
+        "alive": np.asarray(bunch.alive),
+        "rng_keys": keys,
+        "rng_pos": pos,
+        "rng_has_gauss": has_gauss,
+        "rng_cached_gaussian": cached_gaussian,
+    })
+    return state
+
+
+def restore_bunch_state(bunch, state: dict) -> None:
+    """Restore a bunch and the global RNG state returned by bunch_state."""
+    for key in bunch.particles:
+        bunch.particles[key] = np.array(state[key])
+    bunch.alive = np.array(state["alive"], dtype=bool)
+    np.random.set_state(("MT19937", np.asarray(state["rng_keys"]),
+                         int(state["rng_pos"]), int(state["rng_has_gauss"]),
+                         float(state["rng_cached_gaussian"])))
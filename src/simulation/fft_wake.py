@@ -0,0 +1,274 @@
+"""
+Short-range wake potentials computed with FFTs on an adaptive bin grid.
+
+mbtrack2 WakePotential bins each bunch on n_bin bins spanning its particles,
+pads the profile, interpolates it onto the sampling of every wake function
+and convolves profile and wake function once per wake type. The cost per
+turn thus grows with the number of wake components and with the ratio of
+the bunch length to the wake sampling.
+
+FFTWakePotential bins each bunch directly on a grid of width
+
+    dtau = dtau_ref 2^(k/LADDER),    dtau ~ 2 n_sigma sigma_tau / n_bin,
+
+chosen from the rms bunch length, with dtau_ref the wake function sampling.
+Bins are aligned on multiples of dtau and cover the particles only, so that
+the resolution follows the bunch length rather than the outermost particles.
+Quantising dtau on a geometric ladder lets the wake spectra be reused: the
+spectra of the wake functions, averaged over a bin and sampled at multiples
+of dtau, are kept per (wake set, dtau, FFT length) in an LRU cache shared by
+all instances and thread copies.
+
+Wake types kicking the same coordinate are summed in the frequency domain,
+so that a turn takes one forward FFT per source (charge, x and y dipole
+moments), one inverse FFT and one interpolation onto the particles per
+kicked coordinate (delta, xp, yp, and x xp, y yp for the quadrupolar wakes),
+whatever the number of wake types.
+
+Wake potentials per wake type are only computed for the bunches of
+state_bunches, for WakePotentialMonitor.
+
+Usage:
+    from fft_wake import FFTWakePotential
+
+    wakefield_tr = FFTWakePotential(ring, WakeField(wakemodels), n_bin=100)
+    wakefield_tr.state_bunches = [0]  # bunches saved by a monitor
+"""
+
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from mbtrack2.impedance.wakefield import WakeField
+from mbtrack2.tracking import WakePotential
+from mbtrack2.tracking.element import Element
+
+# Number of bin widths per octave.
+LADDER = 8
+# Maximum number of cached wake spectra.
+SPECTRA_CACHE_SIZE = 64
+
+# Kicked coordinate, particle coordinate multiplying the kick and source
+# of each wake type.
+WAKE_TERMS = {
+    "Wlong": ("delta", None, "charge"),
+    "Wxdip": ("xp", None, "x"),
+    "Wydip": ("yp", None, "y"),
+    "Wxquad": ("xp", "x", "charge"),
+    "Wyquad": ("yp", "y", "charge"),
+    "Wxcst": ("xp", None, "charge"),
+    "Wycst": ("yp", None, "charge"),
+}
+SOURCES = ("charge", "x", "y")
+
+_spectra = OrderedDict()
+_spectra_lock = threading.Lock()
+
+
+def clear_spectra_cache() -> None:
+    """Empty the wake spectra cache."""
+    with _spectra_lock:
+        _spectra.clear()
+
+
+def bin_averaged_wake(tau: np.ndarray, wake: np.ndarray, lags: np.ndarray,
+                      dtau: float) -> np.ndarray:
+    """Return a wake function averaged over bins of width dtau.
+
+    The wake function is zero outside of its table.
+
+    Args:
+        tau: Uniform time base of the wake function in [s].
+        wake: Wake function values.
+        lags: Centers of the bins in [s].
+        dtau: Bin width in [s].
+
+    Returns:
+        Mean of the wake function over each bin.
+    """
+    integral = np.concatenate(
+        [[0], np.cumsum((wake[1:] + wake[:-1]) / 2 * np.diff(tau))])
+    return (np.interp(lags + dtau/2, tau, integral) -
+            np.interp(lags - dtau/2, tau, integral)) / dtau
+
+
+class FFTWakePotential(WakePotential):
+    """WakePotential convolving on an adaptive grid with cached spectra.
+
+    Args:
+        ring: Synchrotron object.
+        wakefield: WakeField with uniformly sampled wake functions. Wcsr is
+            not supported.
+        n_bin: Number of bins over 2 n_sigma rms bunch lengths.
+        n_sigma: Half width of the binned core, in rms bunch lengths.
+        max_bins: Maximum number of bins of a bunch, 4 n_bin by default.
+            The bin width is doubled until the particles fit.
+        state_bunches: Bunch numbers for which the wake potential of each
+            type is kept for WakePotentialMonitor. All bunches if None, as
+            WakePotential.
+
+    Raises:
+        ValueError: If a wake type is not supported.
+    """
+
+    def __init__(self,
+                 ring,
+                 wakefield: WakeField,
+                 n_bin: int = 100,
+                 n_sigma: float = 4,
+                 max_bins: int | None = None,
+                 state_bunches: list | None = None):
+        super().__init__(ring, wakefield, n_bin=n_bin)
+        unknown = [t for t in self.types if t not in WAKE_TERMS]
+        if unknown:
+            raise ValueError(f"Wake types not supported: {unknown}.")
+        self.n_sigma = n_sigma
+        self.max_bins = 4 * n_bin if max_bins is None else int(max_bins)
+        self.state_bunches = state_bunches
+        self.dtau_ref = 0.5 / self.wakefunction_max_frequency
+        self.targets = sorted({WAKE_TERMS[t][:2] for t in self.types},
+                              key=str)
+        self.sources = [
+            s for s in SOURCES if any(WAKE_TERMS[t][2] == s
+                                      for t in self.types)
+        ]
+        digest = hashlib.sha256()
+        for wake_type in self.types:
+            data = getattr(self.wakefield, wake_type).data
+            digest.update(wake_type.encode())
+            digest.update(np.ascontiguousarray(data.index, dtype=float))
+            digest.update(np.ascontiguousarray(data["real"], dtype=float))
+        self.wake_key = digest.hexdigest()
+
+    def bin_width(self, tau: np.ndarray) -> tuple[int, float]:
+        """Return the ladder rung and width of the bins of a bunch."""
+        target = 2 * self.n_sigma * np.std(tau) / self.n_bin
+        rung = 0
+        if target > self.dtau_ref:
+            rung = int(np.round(LADDER * np.log2(target / self.dtau_ref)))
+        span = np.max(tau) - np.min(tau)
+        while span > (self.max_bins - 3) * self.dtau_ref * 2**(rung/LADDER):
+            rung += LADDER
+        return rung, self.dtau_ref * 2**(rung/LADDER)
+
+    def spectra(self, rung: int, n_fft: int) -> dict:
+        """Return the cached spectra for a bin width and FFT length.
+
+        Returns:
+            Dictionary with, for each target, an array of shape
+            (n_sources, n_fft//2 + 1), and for each wake type its spectrum.
+        """
+        key = (self.wake_key, rung, n_fft)
+        with _spectra_lock:
+            entry = _spectra.get(key)
+            if entry is not None:
+                _spectra.move_to_end(key)
+                return entry
+
+        dtau = self.dtau_ref * 2**(rung/LADDER)
+        lags = np.arange(n_fft)
+        lags = np.where(lags <= n_fft // 2, lags, lags - n_fft) * dtau
+        entry = {}
+        for target in self.targets:
+            entry[target] = np.zeros((len(self.sources), n_fft//2 + 1),
+                                     dtype=complex)
+        for wake_type in self.types:
+            data = getattr(self.wakefield, wake_type).data
+            wake = bin_averaged_wake(np.array(data.index),
+                                     np.array(data["real"]), lags, dtau)
+            if wake_type == "Wlong":
+                wake = -wake
+            spectrum = np.fft.rfft(wake)
+            target, source = WAKE_TERMS[wake_type][:2], WAKE_TERMS[wake_type][2]
+            entry[target][self.sources.index(source)] += spectrum
+            entry[wake_type] = spectrum
+
+        with _spectra_lock:
+            _spectra[key] = entry
+            _spectra.move_to_end(key)
+            while len(_spectra) > SPECTRA_CACHE_SIZE:
+                _spectra.popitem(last=False)
+        return entry
+
+    @Element.parallel
+    @Element.track_bunch_if_non_empty
+    def track(self, bunch):
+        """
+        Tracking method for the element.
+        No bunch to bunch interaction, so written for Bunch objects and
+        @Element.parallel is used to handle Beam objects.
+
+        Parameters
+        ----------
+        bunch : Bunch or Beam object.
+
+        """
+        tau = bunch["tau"]
+        rung, dtau = self.bin_width(tau)
+        self.dtau = dtau
+        # One empty bin on each side, so that the interpolation of the
+        # potential onto the particles never leaves the grid.
+        first = int(np.floor(np.min(tau) / dtau)) - 1
+        n = int(np.floor(np.max(tau) / dtau)) - first + 2
+        n_fft = 1 << int(np.ceil(np.log2(2*n - 1)))
+        position = tau/dtau - first
+        index = position.astype(int)
+        profile = np.bincount(index, minlength=n).astype(float)
+
+        sources = np.zeros((len(self.sources), n_fft))
+        for i, source in enumerate(self.sources):
+            if source == "charge":
+                sources[i, :n] = profile
+            else:
+                sources[i, :n] = np.bincount(index,
+                                             weights=bunch[source],
+                                             minlength=n)
+        sources *= bunch.charge_per_mp
+        sources_hat = np.fft.rfft(sources)
+        spectra = self.spectra(rung, n_fft)
+        potentials = np.fft.irfft(
+            [np.sum(sources_hat * spectra[t], axis=0) for t in self.targets],
+            n_fft)[:, :n]
+
+        # Linear interpolation from the bin centers onto the particles.
+        position -= 0.5
+        lower = position.astype(int)
+        weight = position - lower
+        for (coordinate, factor), potential in zip(self.targets, potentials):
+            potential /= self.ring.E0
+            slope = np.diff(potential)
+            kick = potential[lower] + weight * slope[lower]
+            if factor is not None:
+                kick *= bunch[factor]
+            bunch[coordinate] += kick
+
+        if (self.state_bunches is None
+                or bunch.bunch_number in self.state_bunches):
+            self._cache_fft_wake(bunch, index, n, first, profile, sources_hat,
+                                 spectra)
+
+    def _cache_fft_wake(self, bunch, index: np.ndarray, n: int, first: int,
+                        profile: np.ndarray, sources_hat: np.ndarray,
+                        spectra: dict):
+        """Cache the wake potential of each type, as WakePotential."""
+        dtau = self.dtau
+        tau0 = (first + np.arange(n) + 0.5) * dtau
+        self.tau_mean = np.mean(tau0)
+        tau0 = tau0 - self.tau_mean
+        charge = bunch.charge
+        rho = profile / (profile.sum() * dtau)
+        for wake_type in self.types:
+            source = self.sources.index(WAKE_TERMS[wake_type][2])
+            Wp = np.fft.irfft(sources_hat[source] * spectra[wake_type],
+                              2 * (sources_hat.shape[1] - 1))[:n] / charge
+            setattr(self, "tau0_" + wake_type, tau0)
+            setattr(self, "profile0_" + wake_type, rho)
+            setattr(self, wake_type, Wp)
+        for plane in ("x", "y"):
+            if "W" + plane + "dip" in self.types:
+                dipole = np.bincount(index, weights=bunch[plane], minlength=n)
+                setattr(self, "dipole_" + plane,
+                        np.divide(dipole, profile, where=profile != 0,
+                                  out=np.zeros_like(dipole)))
+        self._cache_wake(bunch)
@@ -0,0 +1,268 @@
+"""
+Arbitrary filling patterns and load-balanced MPI bunch distribution.
+
+mbtrack2 distributes the non-empty bunches of a Beam across MPI ranks in
+contiguous blocks with the same number of bunches per rank. With uneven
+fills (trains with gaps, camshaft bunches, macroparticle numbers scaled
+with the bunch current) this leaves some ranks with much more work than
+others. BalancedMpi keeps the contiguous-block layout expected by the Mpi
+collectives but chooses the block boundaries so that the largest number of
+macroparticles on a rank is minimal. Empty buckets are never assigned.
+
+Usage:
+    from filling import (init_balanced_beam, load_filling_pattern,
+                         macroparticles_per_bunch)
+
+    filling_pattern = load_filling_pattern(config.get('filling_pattern'),
+                                           ring.h, bunch_current)
+    mp_per_bunch = macroparticles_per_bunch(filling_pattern, n_macroparticles,
+                                            scaling="current")
+    init_balanced_beam(beam, filling_pattern, mp_per_bunch)
+"""
+
+import os
+
+import numpy as np
+from mbtrack2.tracking import Bunch
+from mbtrack2.tracking.parallel import Mpi
+
+from random_streams import bunch_stream
+
+
+def load_filling_pattern(spec, h: int, bunch_current: float) -> np.ndarray:
+    """Return the current in each bucket from a filling pattern description.
+
+    Args:
+        spec: One of
+            - None: uniform filling with bunch_current in every bucket,
+            - a list of h bunch currents in [A],
+            - a path to a .npy file or a text file with h currents,
+            - a dict with keys n_trains, train_length (bunches per train,
+              evenly spaced trains starting at bucket 0), current (per
+              bunch, defaults to bunch_current) and camshaft (list of
+              [bucket, current] pairs set after the trains).
+        h: Harmonic number.
+        bunch_current: Default bunch current in [A].
+
+    Returns:
+        Array of shape (h,) with the current in each bucket in [A].
+
+    Raises:
+        ValueError: If the pattern does not have h buckets or is empty.
+    """
+    if spec is None:
+        pattern = np.ones(h) * bunch_current
+    elif isinstance(spec, str):
+        if os.path.splitext(spec)[1] == ".npy":
+            pattern = np.load(spec)
+        else:
+            pattern = np.loadtxt(spec, delimiter="," if spec.endswith(".csv")
+                                 else None)
+    elif isinstance(spec, dict):
+        pattern = np.zeros(h)
+        n_trains = spec.get("n_trains", 1)
+        train_length = spec.get("train_length", h // n_trains)
+        current = spec.get("current", bunch_current)
+        spacing = h // n_trains
+        for train in range(n_trains):
+            start = train * spacing
+            pattern[start:start + train_length] = current
+        for bucket, camshaft_current in spec.get("camshaft", []):
+            pattern[int(bucket)] = camshaft_current
+    else:
+        pattern = np.asarray(spec)
+    pattern = np.asarray(pattern, dtype=float).ravel()
+    if pattern.size != h:
+        raise ValueError(
+            f"Filling pattern has {pattern.size} buckets, expected {h}.")
+    if not np.any(pattern):
+        raise ValueError("Filling pattern is empty.")
+    return pattern
+
+
+def macroparticles_per_bunch(filling_pattern: np.ndarray,
+                             n_macroparticles: int,
+                             scaling: str = "uniform") -> np.ndarray:
+    """Return the number of macroparticles of each bucket.
+
+    Args:
+        filling_pattern: Current in each bucket in [A].
+        n_macroparticles: Macroparticles of a bunch with the highest current.
+        scaling: "uniform" for n_macroparticles in every non-empty bunch, or
+            "current" for a number proportional to the bunch current, so
+            that all macroparticles carry the same charge.
+
+    Returns:
+        Integer array of shape (h,), zero for empty buckets.
+    """
+    filling_pattern = np.asarray(filling_pattern, dtype=float)
+    filled = filling_pattern != 0
+    if scaling == "uniform":
+        mp = np.full(filling_pattern.size, int(n_macroparticles))
+    elif scaling == "current":
+        ratio = np.abs(filling_pattern) / np.max(np.abs(filling_pattern))
+        mp = np.maximum(np.rint(ratio * n_macroparticles), 1).astype(int)
+    else:
+        raise ValueError(f"Unknown macroparticle scaling {scaling!r}.")
+    return np.where(filled, mp, 0)
+
+
+def balanced_counts(loads: np.ndarray, size: int) -> np.ndarray:
+    """Split loads into size contiguous blocks minimising the largest sum.
+
+    Every block holds at least one item. The optimal bottleneck is found by
+    bisection on the block capacity with a greedy feasibility check.
+
+    Args:
+        loads: Load of each item, in order.
+        size: Number of blocks.
+
+    Returns:
+        Integer array of shape (size,) with the number of items per block.
+    """
+    loads = np.asarray(loads, dtype=float)
+    n = loads.size
+    if size > n:
+        raise ValueError(
+            f"The number of processors ({size}) must not exceed the "
+            f"number of non-empty bunches ({n}).")
+
+    def split(capacity):
+        counts = []
+        count, total = 0, 0.0
+        for k, load in enumerate(loads):
+            # Keep enough items for the remaining blocks.
+            remaining_blocks = size - len(counts) - 1
+            if count and (total + load > capacity
+                          or n - k == remaining_blocks):
+                counts.append(count)
+                count, total = 0, 0.0
+            count += 1
+            total += load
+        counts.append(count)
+        return counts
+
+    low, high = loads.max(), loads.sum()
+    for _ in range(64):
+        if high - low <= 1e-9 * high:
+            break
+        capacity = (low + high) / 2
+        if len(split(capacity)) <= size:
+            high = capacity
+        else:
+            low = capacity
+    counts = split(high)
+    # Fewer blocks than ranks: split the largest blocks further.
+    while len(counts) < size:
+        k = int(np.argmax(counts))
+        counts[k:k + 1] = [counts[k] - counts[k] // 2, counts[k] // 2]
+    return np.array(counts, dtype=int)
+
+
+class BalancedMpi(Mpi):
+    """Mpi with contiguous blocks balanced by macroparticle number.
+
+    Args:
+        filling_pattern: Filling pattern of the beam, like
+            Beam.filling_pattern.
+        loads: Load of each bucket (e.g. macroparticle number), shape (h,).
+            Only the loads of non-empty buckets are used.
+        comm: Communicator replacing MPI.COMM_WORLD, e.g. a
+            shared_backend.SharedMemoryComm. It must provide the mpi4py
+            names it uses as comm.MPI.
+    """
+
+    def __init__(self,
+                 filling_pattern: np.ndarray,
+                 loads: np.ndarray,
+                 comm=None):
+        self.loads = np.asarray(loads, dtype=float)
+        if comm is None:
+            super().__init__(filling_pattern)
+            return
+        self.MPI = comm.MPI
+        self.comm = comm
+        self.rank = comm.Get_rank()
+        self.size = comm.Get_size()
+        self.write_table(filling_pattern)
+
+    def write_table(self, filling_pattern: np.ndarray):
+        """
+        Build the rank-bunch distribution tables.
+
+        Parameters
+        ----------
+        filling_pattern : bool array of shape (h,)
+            Filling pattern of the beam, like Beam.filling_pattern
+        """
+        bunch_index = np.where(filling_pattern)[0].astype(int)
+        counts = balanced_counts(self.loads[bunch_index], self.size)
+        displacements = np.concatenate(
+            ([0], np.cumsum(counts[:-1]))).astype(int)
+
+        bunch_to_rank_arr = np.repeat(np.arange(self.size), counts)
+        rank_to_bunches = {}
+        bunch_num_to_rank = {}
+        for r in range(self.size):
+            start = displacements[r]
+            stop = start + counts[r]
+            rank_to_bunches[r] = bunch_index[start:stop].copy()
+            for b in bunch_index[start:stop]:
+                bunch_num_to_rank[int(b)] = r
+
+        self.bunch_index = bunch_index
+        self.counts = counts
+        self.displacements = displacements
+        self.bunch_to_rank_arr = bunch_to_rank_arr
+        self.rank_to_bunches = rank_to_bunches
+        self.bunch_num_to_rank = bunch_num_to_rank
+
+        self.bunch_numbers = [int(b) for b in rank_to_bunches[self.rank]]
+        self.bunch_numbers_set = set(self.bunch_numbers)
+        self.local_count = int(counts[self.rank])
+        self.local_displacement = int(displacements[self.rank])
+
+
+def init_balanced_beam(beam,
+                       filling_pattern: np.ndarray,
+                       mp_per_bunch: np.ndarray,
+                       track_alive: bool = False,
+                       comm=None,
+                       streams=None) -> None:
+    """Initialise an MPI Beam with one or more bunches per rank.
+
+    Equivalent to beam.init_beam(..., mpi=True), with a BalancedMpi
+    distribution and a macroparticle number per bunch. Each rank fully
+    initialises the bunches it owns; the other bunches carry a single
+    macroparticle with the right current.
+
+    Args:
+        beam: Beam object.
+        filling_pattern: Current in each bucket in [A].
+        mp_per_bunch: Macroparticle number of each bucket.
+        track_alive: Passed to the Bunch objects.
+        comm: Communicator passed to BalancedMpi, MPI.COMM_WORLD if None.
+        streams: RandomStreams drawing each bunch from its "init" stream,
+            so that the beam does not depend on the number of ranks. The
+            global generator is used if None.
+    """
+    filling_pattern = np.asarray(filling_pattern, dtype=float)
+    bunch_list = []
+    for current in filling_pattern:
+        if current != 0:
+            bunch_list.append(Bunch(beam.ring, 1, current, track_alive))
+        else:
+            bunch_list.append(Bunch(beam.ring, alive=False))
+    beam.bunch_list = bunch_list
+    beam.update_bunch_numbers()
+    beam.update_filling_pattern()
+    beam.update_distance_between_bunches()
+
+    beam.mpi = BalancedMpi(beam.filling_pattern, mp_per_bunch, comm)
+    beam.mpi_switch = True
+    for bn in beam.mpi.bunch_numbers:
+        bunch = Bunch(beam.ring, int(mp_per_bunch[bn]), filling_pattern[bn],
+                      track_alive)
+        beam[bn] = bunch
+        with bunch_stream(streams, "init", bunch):
+            bunch.init_gaussian()
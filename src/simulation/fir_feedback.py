@@ -0,0 +1,148 @@
+"""
+Bunch-by-bunch FIR feedback acting on both transverse planes.
+
+mbtrack2 FIRDamper handles one plane: a multi-bunch run tracks one damper
+per plane, each looping over the bunches in Python to compute the filter
+output from a per-bunch history shifted with np.roll every turn.
+
+TransverseFIRFeedback keeps the position history of both planes and all
+tracked bunches in one ring buffer of shape (2, n_bunch, tap_number), and
+the kicks waiting for the turn delay in another of shape
+(2, n_bunch, turn_delay + 1). Each turn, the bunch means are read once per
+bunch, the filters of both planes are applied to all bunches as one batched
+matrix product, and the max_kick saturation is a single clip. Only the
+kicks themselves are applied bunch by bunch.
+
+The FIR coefficients are those of FIRDamper for the tune, phase and gain of
+each plane, and the kicks are the same as with two FIRDamper objects.
+
+Usage:
+    from fir_feedback import TransverseFIRFeedback
+
+    fb = TransverseFIRFeedback(ring, turn_delay=1, tap_number=7, gain=1,
+                               phase=90)
+    fb.track(beam)
+"""
+
+import numpy as np
+from mbtrack2.tracking import Beam, Bunch
+from mbtrack2.tracking.element import Element
+from mbtrack2.tracking.feedback import FIRDamper
+
+
+def _per_plane(value, dtype=float) -> np.ndarray:
+    """Return a (2,) array from a scalar or an (x, y) pair."""
+    return np.broadcast_to(np.asarray(value, dtype=dtype), (2,)).copy()
+
+
+class TransverseFIRFeedback(Element):
+    """FIR bunch-by-bunch damper for the x and y planes.
+
+    Args:
+        ring: Synchrotron object.
+        turn_delay: Number of turns before the kick is applied.
+        tap_number: Number of taps of the FIR filters.
+        gain: Gain of the filters, scalar or (x, y).
+        phase: Phase of the filters in [degree], scalar or (x, y).
+        tune: Reference tunes (x, y). The default is ring.tune.
+        bpm_error: RMS error of the measured positions in [m], scalar or
+            (x, y). The default is None.
+        max_kick: Maximum kick in [rad], scalar or (x, y). The default is
+            None.
+
+    Attributes:
+        coef: FIR coefficients, shape (2, tap_number).
+        pos: Ring buffer of the measured positions, shape
+            (2, n_bunch, tap_number).
+        kick: Ring buffer of the computed kicks, shape
+            (2, n_bunch, turn_delay + 1).
+        head: Number of turns tracked, which sets the ring buffer slots.
+        streams: RandomStreams drawing the BPM noise of each bunch from its
+            "bpm" stream. The global generator is used if None.
+    """
+
+    streams = None
+
+    def __init__(self,
+                 ring,
+                 turn_delay: int,
+                 tap_number: int,
+                 gain,
+                 phase,
+                 tune=None,
+                 bpm_error=None,
+                 max_kick=None):
+        self.ring = ring
+        self.turn_delay = int(turn_delay)
+        self.tap_number = int(tap_number)
+        self.tune = _per_plane(ring.tune[:2] if tune is None else tune)
+        self.gain = _per_plane(gain)
+        self.phase = _per_plane(phase)
+        self.bpm_error = (None if bpm_error is None
+                          else _per_plane(bpm_error)[:, None])
+        self.max_kick = (None if max_kick is None
+                         else _per_plane(max_kick)[:, None])
+        # FIRDamper.get_fir does not depend on the damper state.
+        self.coef = np.array([
+            FIRDamper.get_fir(self, self.tap_number, self.tune[p],
+                              -self.phase[p], self.turn_delay, self.gain[p])
+            for p in range(2)
+        ])
+        self.pos = np.zeros((2, 1, self.tap_number))
+        self.kick = np.zeros((2, 1, self.turn_delay + 1))
+        self.head = 0
+
+    def _bunches(self, beam_or_bunch) -> list:
+        if isinstance(beam_or_bunch, Bunch):
+            return [beam_or_bunch]
+        if isinstance(beam_or_bunch, Beam):
+            beam = beam_or_bunch
+            if beam.mpi_switch:
+                return [beam[bn] for bn in beam.mpi.bunch_numbers]
+            return list(beam.not_empty)
+        raise TypeError("beam_or_bunch must be a Beam or Bunch")
+
+    def track(self, beam_or_bunch):
+        """
+        Tracking method.
+
+        Parameters
+        ----------
+        beam_or_bunch : Beam or Bunch
+            Data to track.
+
+        """
+        bunches = self._bunches(beam_or_bunch)
+        n_bunch = len(bunches)
+        if self.pos.shape[1] != n_bunch:
+            self.pos = np.zeros((2, n_bunch, self.tap_number))
+            self.kick = np.zeros((2, n_bunch, self.turn_delay + 1))
+
+        means = np.array([bunch.mean[[0, 2]] for bunch in bunches]).T
+        if self.bpm_error is not None:
+            if self.streams is None:
+                noise = np.random.normal(size=means.shape)
+            else:
+                noise = np.array([
+                    self.streams.stream("bpm", bunch.bunch_number).normal(
+                        size=2) for bunch in bunches
+                ]).T
+            means += self.bpm_error * noise
+        slot = self.head % self.tap_number
+        self.pos[:, :, slot] = means
+        # Coefficient of each slot: the newest position has tap 0.
+        taps = (slot - np.arange(self.tap_number)) % self.tap_number
+        weights = np.empty_like(self.coef)
+        weights[:, taps] = self.coef
+        kicks = np.matmul(self.pos, weights[:, :, None])[:, :, 0]
+        if self.max_kick is not None:
+            kicks = np.clip(kicks, -self.max_kick, self.max_kick)
+
+        # The kick computed turn_delay turns ago sits in the next slot.
+        delay = self.turn_delay + 1
+        self.kick[:, :, self.head % delay] = kicks
+        applied = self.kick[:, :, (self.head+1) % delay]
+        for k, bunch in enumerate(bunches):
+            bunch["xp"] += applied[0, k]
+            bunch["yp"] += applied[1, k]
+        self.head += 1
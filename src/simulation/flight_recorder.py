@@ -0,0 +1,143 @@
+"""
+Pre-trigger ring buffer ("flight recorder") for wake potential data.
+
+WakePotentialMonitor data are only worth saving around the onset of an
+instability, which is only known once the centroid has grown. The
+FlightRecorder is tracked every turn after the wakes are switched on and
+keeps the last ``pre_trigger`` samples in memory, overwriting the oldest
+ones. When trigger() is called, the ring buffer is written to the file in
+chronological order, and the following ``post_trigger`` samples are saved
+as with a plain WakePotentialMonitor. Nothing is written before the trigger.
+
+The trigger is evaluated by the tracking loop from bunch statistics that
+were already computed in the turn (latest_bunch_mean), so no extra pass over
+the macroparticles is needed.
+
+Usage:
+    from flight_recorder import FlightRecorder, latest_bunch_mean
+
+    recorder = FlightRecorder(0, wake_types, n_bin, pre_trigger=600,
+                              post_trigger=1800)
+    ...
+    mean = latest_bunch_mean(bunch_monitor)
+    if not recorder.triggered and abs(mean[2]) > 0.1 * stdy:
+        recorder.trigger(turn)
+    recorder.track(bunch, wakefield)
+"""
+
+import numpy as np
+from mbtrack2.tracking.monitors import WakePotentialMonitor
+
+
+def latest_bunch_mean(monitor) -> np.ndarray:
+    """Return the bunch mean saved by a bunch monitor in its last call.
+
+    Args:
+        monitor: BunchMonitor saving every turn, or DecimatingBunchMonitor.
+
+    Returns:
+        Array of the 6 coordinate means.
+    """
+    if hasattr(monitor, "latest"):
+        return monitor.latest("mean")
+    return monitor.mean[:, (monitor.buffer_count - 1) % monitor.buffer_size]
+
+
+class FlightRecorder(WakePotentialMonitor):
+    """WakePotentialMonitor keeping a ring buffer until it is triggered.
+
+    The monitor buffer itself is the ring buffer, so its size is
+    pre_trigger. The dataset length is pre_trigger + post_trigger, rounded
+    up to a multiple of pre_trigger.
+
+    Args:
+        bunch_number: Bunch to monitor.
+        wake_types: Wake types to save, see WakePotentialMonitor.
+        n_bin: Number of bins of the WakePotential.
+        pre_trigger: Number of samples kept before the trigger.
+        post_trigger: Number of samples saved after the trigger.
+        file_name: Name of the HDF5 file, see mbtrack2 Monitor.
+        mpi_mode: Open the HDF5 file in parallel mode.
+    """
+
+    def __init__(self,
+                 bunch_number: int,
+                 wake_types: str | list[str],
+                 n_bin: int,
+                 pre_trigger: int = 600,
+                 post_trigger: int = 1800,
+                 file_name: str | None = None,
+                 mpi_mode: bool = False):
+        pre_trigger = int(pre_trigger)
+        total_size = -(-(pre_trigger + int(post_trigger)) //
+                       pre_trigger) * pre_trigger
+        super().__init__(bunch_number,
+                         wake_types,
+                         n_bin,
+                         save_every=1,
+                         buffer_size=pre_trigger,
+                         total_size=total_size,
+                         file_name=file_name,
+                         mpi_mode=mpi_mode)
+        self.pre_trigger = pre_trigger
+        self.triggered = False
+        self.wrapped = False
+
+    @property
+    def full(self) -> bool:
+        """True once all post-trigger samples have been saved."""
+        return (self.write_count * self.buffer_size + self.buffer_count >=
+                self.total_size)
+
+    def write(self):
+        """Write the buffer to the HDF5 file, or wrap around before trigger."""
+        if not self.triggered:
+            self.wrapped = True
+            return
+        super().write()
+
+    def trigger(self, turn: int | None = None) -> None:
+        """Write the ring buffer in chronological order and start saving.
+
+        Args:
+            turn: Tracking turn of the trigger, stored as a group attribute.
+        """
+        if self.triggered:
+            return
+        self.triggered = True
+        self.g.attrs["trigger_sample"] = self.track_count
+        if turn is not None:
+            self.g.attrs["trigger_turn"] = turn
+        if not self.wrapped:
+            return
+        shift = -self.buffer_count
+        self.time = np.roll(self.time, shift)
+        for key in self.dict_buffer:
+            setattr(self, key, np.roll(getattr(self, key), shift, axis=-1))
+        self.write()
+        self.buffer_count = 0
+
+    def restore_trigger(self, triggered: bool) -> None:
+        """Set the trigger state after restoring counters from a checkpoint.
+
+        The ring buffer is not part of checkpoints: before the trigger it
+        restarts empty.
+        """
+        self.triggered = bool(triggered)
+        if not self.triggered:
+            self.buffer_count = 0
+            self.write_count = 0
+            self.wrapped = False
+
+    def track(self, object_to_save, wake_potential_to_save):
+        """
+        Save data, until the post-trigger samples are complete.
+
+        Parameters
+        ----------
+        object_to_save : Bunch or Beam object
+        wake_potential_to_save : WakePotential object
+        """
+        if self.full:
+            return
+        super().track(object_to_save, wake_potential_to_save)
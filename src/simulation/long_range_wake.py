@@ -0,0 +1,356 @@
+"""
+Long-range resistive-wall wakes.
+
+mbtrack2's LongRangeResistiveWall keeps tables of the bunch centroids over
+the last nt turns and sums the wake of every bunch and turn for every
+tracked bunch, i.e. O(n_bunches * nt) Python-level operations per bunch and
+turn. RecursiveResistiveWall uses the same point-charge model and asymptotic
+wake functions, but expands the time dependence of the wakes in decaying
+exponentials ("poles"):
+
+    t**(-p) ~= sum_k a_k exp(-s_k t),   p = 1/2 (transverse), 3/2 (long.)
+
+The contribution of all past turns to a pole is then a single number
+propagated from turn to turn, and the contribution of the bunches ahead in
+the same turn is a first-order recursion over the buckets (scipy lfilter).
+The whole history is folded into an (n_types, n_poles) state, and the cost
+per turn is O(h * n_poles) vectorised operations independently of nt.
+
+The rates s_k are log-spaced and the amplitudes a_k are fitted by least
+squares on [T1/2, (nt + 1) T0]. The maximum relative error of the fit on
+this interval is stored in kernel_error. The slowest poles decay over
+several times nt turns, so the contribution of each turn to the state is
+kept in a ring buffer and subtracted once the turn leaves the window: as
+for LongRangeResistiveWall, a bunch sees the bunches ahead of it in the
+same turn and the nt - 1 previous turns, and nothing older.
+
+CombinedResistiveWall keeps the centroid tables of LongRangeResistiveWall
+but computes the kicks of all wake types of a bunch in one vectorised pass,
+sharing the time differences and the t**(-1/2) factor between the dipolar
+and quadrupolar wakes of both planes. One element with the types
+
+    ["Wxdip", "Wydip", "Wxquad", "Wyquad"]
+
+then replaces a dipolar and a quadrupolar element, with one history.
+
+Usage:
+    from long_range_wake import CombinedResistiveWall, RecursiveResistiveWall
+
+    long_wakefield = RecursiveResistiveWall(ring, beam, length=ring.L,
+                                            rho=2.135e-8, radius=8e-3,
+                                            types=["Wxdip", "Wydip"],
+                                            nt=50, x3=x3, y3=y3)
+"""
+
+import numpy as np
+from mbtrack2.tracking import LongRangeResistiveWall
+from scipy.constants import c
+from scipy.signal import lfilter
+
+
+def fit_power_law(exponent: float,
+                  t_min: float,
+                  t_max: float,
+                  pole_spacing: float = 0.5) -> tuple[np.ndarray, np.ndarray]:
+    """Expand t**(-exponent) in decaying exponentials on [t_min, t_max].
+
+    Args:
+        exponent: Power of the wake function, 1/2 or 3/2 for the resistive
+            wall.
+        t_min: Shortest time to fit in [s].
+        t_max: Longest time to fit in [s].
+        pole_spacing: Spacing of the rates in natural log units. The fit
+            error is about 1e-8 for 0.5 and 1e-10 for 0.4.
+
+    Returns:
+        Tuple (amplitudes, rates) such that
+        sum(amplitudes * exp(-rates * t)) ~= t**(-exponent).
+    """
+    rates = np.exp(
+        np.arange(np.log(1 / t_max) - 1.0,
+                  np.log(1 / t_min) + 3.0 + pole_spacing, pole_spacing))
+    t = np.geomspace(t_min, t_max, 20 * rates.size)
+    # Relative error weighting, with normalised columns for conditioning.
+    matrix = np.exp(-np.outer(t, rates)) * t[:, None]**exponent
+    norm = np.linalg.norm(matrix, axis=0)
+    amplitudes = np.linalg.lstsq(matrix / norm, np.ones_like(t),
+                                 rcond=None)[0] / norm
+    return amplitudes, rates
+
+
+class CombinedResistiveWall(LongRangeResistiveWall):
+    """LongRangeResistiveWall computing all wake types in a single pass.
+
+    Parameters are those of LongRangeResistiveWall. The dipolar types use
+    x3 and y3 and the quadrupolar types x3_quad and y3_quad.
+    """
+
+    def get_kicks(self, bunch_pos: int) -> dict:
+        """
+        Compute the kicks of all wake types on a bunch.
+
+        Parameters
+        ----------
+        bunch_pos : int
+            Non-empty bunch position, aligned with beam.bunch_index.
+
+        Returns
+        -------
+        dict
+            Sum of the kicks from the previous bunches, by wake type.
+        """
+        # Bunches at or after bunch_pos in the tracked turn have not passed.
+        passed = np.ones(self.tau.shape, dtype=bool)
+        passed[bunch_pos:, 0] = False
+        deltaT = self.tau[passed] - self.tau[bunch_pos, 0]
+        charge = self.charge[passed]
+        # Wdip(t, plane) * r3**3, common to the transverse types.
+        wake = (np.sqrt(self.Z0 * c * self.rho / (np.pi * deltaT)) *
+                self.length / np.pi * charge)
+        kicks = {}
+        for wake_type in self.types:
+            if wake_type == "Wlong":
+                kicks[wake_type] = np.sum(self.Wlong(deltaT) * charge)
+            elif wake_type == "Wxdip":
+                kicks[wake_type] = (np.sum(wake * self.x[passed]) /
+                                    self.x3**3)
+            elif wake_type == "Wydip":
+                kicks[wake_type] = (np.sum(wake * self.y[passed]) /
+                                    self.y3**3)
+            elif wake_type == "Wxquad":
+                kicks[wake_type] = self.x_sign * np.sum(wake) / self.x3_quad**3
+            elif wake_type == "Wyquad":
+                kicks[wake_type] = self.y_sign * np.sum(wake) / self.y3_quad**3
+            else:
+                raise ValueError("Incorrect wake_type. Must be [Wlong, Wxdip,"
+                                 " Wydip, Wxquad, Wyquad].")
+        return kicks
+
+    def get_kick(self, bunch_pos: int, wake_type: str) -> float:
+        """
+        Compute the wake kick to apply.
+
+        Parameters
+        ----------
+        bunch_pos : int
+            Non-empty bunch position.
+        wake_type : str
+            Type of the wake to compute.
+
+        Returns
+        -------
+        float
+            Sum of the kicks from the previous bunches.
+        """
+        return self.get_kicks(bunch_pos)[wake_type]
+
+    def track_bunch(self, bunch, bunch_pos: int):
+        """
+        Track a bunch.
+
+        Should only be used within the track method and not standalone.
+
+        Parameters
+        ----------
+        bunch : Bunch object
+        bunch_pos : int
+            Non-empty bunch position.
+        """
+        kicks = self.get_kicks(bunch_pos)
+        E0 = self.ring.E0
+        for wake_type, kick in kicks.items():
+            if wake_type == "Wlong":
+                bunch["delta"] -= kick / E0
+            elif wake_type == "Wxdip":
+                bunch["xp"] += kick / E0 * self.norm_x
+            elif wake_type == "Wydip":
+                bunch["yp"] += kick / E0 * self.norm_y
+            elif wake_type == "Wxquad":
+                bunch["xp"] += (bunch["x"] * kick / E0) * self.norm_x
+            elif wake_type == "Wyquad":
+                bunch["yp"] += (bunch["y"] * kick / E0) * self.norm_y
+
+
+class RecursiveResistiveWall(LongRangeResistiveWall):
+    """LongRangeResistiveWall with the wake history in a pole expansion.
+
+    Parameters are those of LongRangeResistiveWall, plus:
+
+    Args:
+        pole_spacing: Spacing of the pole rates, see fit_power_law.
+
+    Note:
+        All ranks compute the kicks of all bunches from the bunch means
+        shared by Mpi.share_means, so that the state stays identical on all
+        ranks. Only the kicks of the local bunches are applied.
+    """
+
+    def __init__(self,
+                 ring,
+                 beam,
+                 length: float,
+                 rho: float,
+                 radius: float,
+                 types: list[str] = ["Wlong", "Wxdip", "Wydip"],
+                 nt: int = 50,
+                 x3: float | None = None,
+                 y3: float | None = None,
+                 x3_quad: float | None = None,
+                 y3_quad: float | None = None,
+                 average_beta: np.ndarray | None = None,
+                 pole_spacing: float = 0.5):
+        # The centroid tables of the parent class are not used.
+        super().__init__(ring, beam, length, rho, radius, types, 1, x3, y3,
+                         x3_quad, y3_quad, average_beta)
+        self.nt = int(nt)
+        t_min = ring.T1 / 2
+        t_max = (self.nt + 1) * ring.T0
+        amplitudes = {}
+        self.kernel_error = 0.0
+        for exponent in (0.5, 1.5):
+            a, self.rates = fit_power_law(exponent, t_min, t_max,
+                                          pole_spacing)
+            amplitudes[exponent] = a
+            t = np.geomspace(t_min, t_max, 1000)
+            fit = np.exp(-np.outer(t, self.rates)) @ a * t**exponent
+            self.kernel_error = max(self.kernel_error,
+                                    float(np.max(np.abs(fit - 1))))
+
+        # Wake amplitude of each type per pole, with the sign of the kick.
+        coefficients = []
+        for wake_type in self.types:
+            if wake_type == "Wlong":
+                coefficients.append(self.Wlong(1.0) * amplitudes[1.5])
+            elif wake_type == "Wxdip":
+                coefficients.append(self.Wdip(1.0, "x") * amplitudes[0.5])
+            elif wake_type == "Wydip":
+                coefficients.append(self.Wdip(1.0, "y") * amplitudes[0.5])
+            elif wake_type == "Wxquad":
+                coefficients.append(self.x_sign * self.Wdip(1.0, "x_quad") *
+                                    amplitudes[0.5])
+            elif wake_type == "Wyquad":
+                coefficients.append(self.y_sign * self.Wdip(1.0, "y_quad") *
+                                    amplitudes[0.5])
+            else:
+                raise ValueError("Incorrect wake_type. Must be [Wlong, Wxdip,"
+                                 " Wydip, Wxquad, Wyquad].")
+        self.coefficients = np.array(coefficients)
+
+        # Decay of each pole over one bucket, from the start of the turn to
+        # each bucket and from each bucket to the start of the next turn.
+        buckets = np.arange(ring.h)
+        self._bucket_decay = np.exp(-self.rates * ring.T1)
+        self._from_turn_start = np.exp(-np.outer(self.rates,
+                                                 buckets * ring.T1))
+        self._to_next_turn = np.exp(-np.outer(self.rates,
+                                              (ring.h - buckets) * ring.T1))
+        self._turn_decay = np.exp(-self.rates * ring.T0)
+        # Previous turns kept in the state, and their decay once dropped.
+        self.window = self.nt - 1
+        self._window_decay = self._turn_decay**self.window
+        self.state = np.zeros((len(self.types), self.rates.size))
+        self.history = np.zeros((max(self.window, 1), len(self.types),
+                                 self.rates.size))
+        self.head = 0
+        self.kicks = np.zeros((len(self.types), 0))
+
+    def source_weights(self, charge: np.ndarray,
+                       means: np.ndarray) -> np.ndarray:
+        """Return the wake source weight of each bunch per wake type.
+
+        Args:
+            charge: Bunch charges in [C], shape (n,).
+            means: Bunch means, shape (6, n).
+
+        Returns:
+            Array of shape (n_types, n).
+        """
+        weights = np.empty((len(self.types), np.size(charge)))
+        for k, wake_type in enumerate(self.types):
+            if wake_type == "Wxdip":
+                weights[k] = charge * means[0]
+            elif wake_type == "Wydip":
+                weights[k] = charge * means[2]
+            else:
+                weights[k] = charge
+        return weights
+
+    def fold(self, tau: np.ndarray, weights: np.ndarray) -> np.ndarray:
+        """Return the kicks of one turn and fold the turn into the state.
+
+        The state holds, for each wake type and pole, the weights of the
+        bunches of the last nt - 1 turns propagated to the start of the
+        turn.
+
+        Args:
+            tau: Mean tau of each bucket in [s], shape (h,).
+            weights: Source weights of each bucket, zero for empty
+                buckets, shape (n_types, h).
+
+        Returns:
+            Kick of each wake type on each bucket, shape (n_types, h), to be
+            applied as in LongRangeResistiveWall.track_bunch.
+        """
+        # The passage time of bucket b is b*T1 - tau[b]. The tau part of the
+        # decay is small and applied separately so that nothing overflows.
+        phase = np.exp(np.outer(self.rates, tau))
+        sources = weights[:, None, :] / phase
+        ahead = np.empty_like(sources)
+        for k, decay in enumerate(self._bucket_decay):
+            ahead[:, k, :] = lfilter([0, decay], [1, -decay], sources[:, k, :],
+                                     axis=-1)
+        total = phase * (self.state[:, :, None] * self._from_turn_start +
+                         ahead)
+        kicks = np.einsum("tk,tkb->tb", self.coefficients, total)
+        contribution = np.sum(sources * self._to_next_turn, axis=-1)
+        if self.window == 0:
+            return kicks
+        # Drop the turn leaving the window, stored window turns ago.
+        slot = self.head % self.window
+        self.state = (self.state * self._turn_decay + contribution -
+                      self.history[slot] * self._window_decay)
+        self.history[slot] = contribution
+        self.head += 1
+        return kicks
+
+    def update_tables(self, beam):
+        """
+        Compute the kicks of this turn from the bunch means.
+
+        Parameters
+        ----------
+        beam : Beam object
+        """
+        if beam.mpi_switch:
+            beam.mpi.share_means(beam)
+            means = np.array(
+                [beam.mpi.mean_all[int(bn)] for bn in beam.bunch_index]).T
+            charge = np.array(
+                [beam.mpi.charge_all[int(bn)] for bn in beam.bunch_index])
+        else:
+            means = beam.bunch_mean[:, beam.filling_pattern]
+            charge = beam.bunch_charge[beam.filling_pattern]
+        index = np.asarray(beam.bunch_index, dtype=int)
+        tau = np.zeros(self.ring.h)
+        tau[index] = means[4]
+        weights = np.zeros((len(self.types), self.ring.h))
+        weights[:, index] = self.source_weights(charge, means)
+        self.kicks = self.fold(tau, weights)[:, index]
+
+    def get_kick(self, bunch_pos: int, wake_type: str) -> float:
+        """
+        Return the kick computed by update_tables.
+
+        Parameters
+        ----------
+        bunch_pos : int
+            Non-empty bunch position, aligned with beam.bunch_index.
+        wake_type : str
+            Type of the wake.
+
+        Returns
+        -------
+        float
+            Sum of the kicks from the previous bunches.
+        """
+        return self.kicks[self.types.index(wake_type), bunch_pos]
@@ -0,0 +1,269 @@
+"""
+Fused one-turn map for the single-particle part of the tracking.
+
+OneTurnMap applies, in a single pass with preallocated work arrays, the same
+physics as the element chain
+
+    TransverseMap -> LongitudinalMap -> SynchrotronRadiation -> RFCavity(s)
+
+built from the same ring object: betatron rotation with chromatic (and
+amplitude-dependent) detuning, synchrotron motion, radiation damping and
+quantum excitation, and RF kicks. Coordinates are updated in place, which
+avoids the temporaries allocated by the individual mbtrack2 elements over
+the macroparticle arrays every turn.
+
+The random numbers for quantum excitation are drawn from the global numpy
+generator in the same order as SynchrotronRadiation (delta, xp, yp), so the
+fused and unfused chains give the same result up to rounding. check() runs
+both chains on copies of a bunch and reports the largest deviation.
+
+Usage:
+    from one_turn_map import OneTurnMap
+
+    one_turn_map = OneTurnMap(ring, rf_cavities=[main_rf], radiation=True)
+    one_turn_map.check(bunch, [trans_map, long_map, sr, main_rf])
+    one_turn_map.track(bunch)
+"""
+
+import copy
+
+import numpy as np
+from mbtrack2.tracking import Bunch
+from mbtrack2.tracking.element import Element
+
+from random_streams import bunch_stream
+
+COORDINATES = ("x", "xp", "y", "yp", "tau", "delta")
+
+
+class OneTurnMap(Element):
+    """Fused transverse, longitudinal, radiation and RF one-turn map.
+
+    Args:
+        ring: Synchrotron object. Local optics are used, as in TransverseMap.
+        rf_cavities: RFCavity objects applied at the end of the turn.
+        radiation: If True, apply synchrotron radiation.
+        switch: Radiation switch per plane (long, x, y), as in
+            SynchrotronRadiation.
+        qexcitation: If False, quantum excitation is turned off.
+
+    Attributes:
+        streams: RandomStreams drawing the excitation of each bunch from its
+            "sr" stream. The global generator is used if None.
+    """
+
+    streams = None
+
+    def __init__(self,
+                 ring,
+                 rf_cavities: list = (),
+                 radiation: bool = True,
+                 switch: tuple = (1, 1, 1),
+                 qexcitation: bool = True):
+        self.ring = ring
+        self.rf_cavities = list(rf_cavities)
+        self.radiation = radiation
+        self.switch = switch
+        self.qexcitation = qexcitation
+
+        optics = ring.optics
+        self.alpha = np.asarray(optics.local_alpha, dtype=float)
+        self.beta = np.asarray(optics.local_beta, dtype=float)
+        self.gamma = (1 + self.alpha**2) / self.beta
+        self.dispersion = np.asarray(optics.local_dispersion, dtype=float)
+        self.tune = np.asarray(ring.tune, dtype=float)
+        chro = np.asarray(ring.chro, dtype=float)
+        # Taylor coefficients of the chromatic detuning per plane, highest
+        # order first, for Horner evaluation.
+        order = len(chro) // 2
+        factorials = np.cumprod(np.arange(1, order + 1))
+        self.chro_coefs = [chro[plane::2] / factorials for plane in (0, 1)]
+        if getattr(ring, "adts", None) is not None:
+            self.adts_poly = [np.poly1d(coefs) for coefs in ring.adts]
+        else:
+            self.adts_poly = None
+
+        mcf = np.atleast_1d(ring.mcf_order)
+        self.mcf_coefs = mcf
+        self.eta_constant = (ring.eta(0) if len(mcf) == 1 else None)
+        self.energy_loss = ring.U0 / ring.E0
+
+        T0 = ring.T0
+        tau = ring.tau
+        self.damping = [1 - 2*T0/tau[2], 1 - 2*T0/tau[0], 1 - 2*T0/tau[1]]
+        sigma = ring.sigma()
+        self.excitation = [
+            2 * ring.sigma_delta * (T0 / tau[2])**0.5,
+            2 * sigma[1] * (T0 / tau[0])**0.5,
+            2 * sigma[3] * (T0 / tau[1])**0.5,
+        ]
+        self._buffers = None
+
+    def _work_arrays(self, n: int) -> list:
+        if self._buffers is None or len(self._buffers[0]) != n:
+            self._buffers = [np.empty(n) for _ in range(6)]
+        return self._buffers
+
+    def _phase(self, out, delta, plane):
+        """Compute 2*pi*(tune + chromatic detuning) into out."""
+        coefs = self.chro_coefs[plane]
+        if coefs.any():
+            out.fill(coefs[-1])
+            for coef in coefs[-2::-1]:
+                out *= delta
+                out += coef
+            out *= delta
+            out += self.tune[plane]
+        else:
+            out.fill(self.tune[plane])
+
+    def _rotate(self, u, up, delta, phase, c, s, t1, t2, plane):
+        """In-place betatron rotation of one plane."""
+        alpha, beta, gamma = (self.alpha[plane], self.beta[plane],
+                              self.gamma[plane])
+        disp, disp_p = self.dispersion[2 * plane], self.dispersion[2*plane + 1]
+        if disp:
+            np.multiply(delta, disp, out=t1)
+            u -= t1
+        if disp_p:
+            np.multiply(delta, disp_p, out=t1)
+            up -= t1
+        phase *= 2 * np.pi
+        np.cos(phase, out=c)
+        np.sin(phase, out=s)
+        np.multiply(s, u, out=t1)
+        np.multiply(s, up, out=t2)
+        u *= c
+        up *= c
+        # u <- c*u + alpha*s*u + beta*s*up
+        # up <- c*up - gamma*s*u - alpha*s*up
+        t2 *= beta
+        u += t2
+        t1 *= gamma
+        up -= t1
+        if alpha:
+            t2 *= alpha / beta
+            up -= t2
+            t1 *= alpha / gamma
+            u += t1
+        if disp:
+            np.multiply(delta, disp, out=t1)
+            u += t1
+        if disp_p:
+            np.multiply(delta, disp_p, out=t1)
+            up += t1
+
+    @Element.parallel
+    def track(self, bunch: Bunch):
+        """
+        Tracking method for the element.
+
+        Parameters
+        ----------
+        bunch : Bunch or Beam object
+        """
+        coords = {key: bunch[key] for key in COORDINATES}
+        x, xp, y, yp = coords["x"], coords["xp"], coords["y"], coords["yp"]
+        tau, delta = coords["tau"], coords["delta"]
+        n = len(x)
+        phase_x, phase_y, c, s, t1, t2 = self._work_arrays(n)
+
+        # Transverse map: both tune advances use the coordinates at the
+        # start of the turn.
+        self._phase(phase_x, delta, 0)
+        self._phase(phase_y, delta, 1)
+        if self.adts_poly is not None:
+            Jx = (self.gamma[0] * x**2 + 2 * self.alpha[0] * x * xp +
+                  self.beta[0] * xp**2)
+            Jy = (self.gamma[1] * y**2 + 2 * self.alpha[1] * y * yp +
+                  self.beta[1] * yp**2)
+            phase_x += self.adts_poly[0](Jx) + self.adts_poly[2](Jy)
+            phase_y += self.adts_poly[1](Jx) + self.adts_poly[3](Jy)
+        self._rotate(x, xp, delta, phase_x, c, s, t1, t2, 0)
+        self._rotate(y, yp, delta, phase_y, c, s, t1, t2, 1)
+
+        # Longitudinal map
+        delta -= self.energy_loss
+        if self.eta_constant is not None:
+            np.multiply(delta, self.eta_constant * self.ring.T0, out=t1)
+        else:
+            t1.fill(self.mcf_coefs[0])
+            for coef in self.mcf_coefs[1:]:
+                t1 *= delta
+                t1 += coef
+            t1 -= 1 / self.ring.gamma**2
+            t1 *= delta
+            t1 *= self.ring.T0
+        tau += t1
+
+        # Synchrotron radiation, same random draw order and stream as
+        # SynchrotronRadiation.
+        if self.radiation:
+            with bunch_stream(self.streams, "sr", bunch):
+                for plane, u in enumerate((delta, xp, yp)):
+                    if not self.switch[plane]:
+                        continue
+                    u *= self.damping[plane]
+                    if self.qexcitation:
+                        rand = np.random.standard_normal(size=n)
+                        rand *= self.excitation[plane]
+                        u += rand
+
+        # RF cavities
+        for cavity in self.rf_cavities:
+            np.multiply(tau, cavity.m * self.ring.omega1, out=t1)
+            t1 += cavity.theta
+            np.cos(t1, out=t1)
+            t1 *= cavity.Vc / self.ring.E0
+            delta += t1
+
+        for key, value in coords.items():
+            bunch[key] = value
+
+    def check(self,
+              bunch: Bunch,
+              reference_elements: list,
+              n_turns: int = 1,
+              rtol: float = 1e-9) -> float:
+        """Compare the fused map with the unfused element chain.
+
+        Both chains are tracked on copies of bunch, starting from the same
+        global RNG state. The RNG state is restored afterwards, so the check
+        does not change the random stream of the simulation.
+
+        Args:
+            bunch: Bunch used as initial condition (not modified).
+            reference_elements: Equivalent unfused elements, in the order
+                TransverseMap, LongitudinalMap, SynchrotronRadiation,
+                RF cavities.
+            n_turns: Number of turns to compare.
+            rtol: Tolerance on the deviation, relative to the rms size of
+                each coordinate.
+
+        Returns:
+            Largest relative deviation over all coordinates.
+
+        Raises:
+            ValueError: If the deviation exceeds rtol.
+        """
+        state = np.random.get_state()
+        reference = copy.deepcopy(bunch)
+        fused = copy.deepcopy(bunch)
+        for _ in range(n_turns):
+            for element in reference_elements:
+                element.track(reference)
+        np.random.set_state(state)
+        for _ in range(n_turns):
+            self.track(fused)
+        np.random.set_state(state)
+
+        deviation = 0.0
+        for key in COORDINATES:
+            scale = np.std(reference[key]) or 1.0
+            deviation = max(deviation,
+                            np.max(np.abs(fused[key] - reference[key])) / scale)
+        if deviation > rtol:
+            raise ValueError(
+                f"Fused one-turn map deviates from the element chain by "
+                f"{deviation:.2e} (relative), above tolerance {rtol:.1e}.")
+        return deviation
@@ -0,0 +1,151 @@
+"""
+Opt-in timing instrumentation for the tracking loops.
+
+The TrackingProfiler accumulates the wall time spent in each tracking element
+and MPI collective, counts the tracked turns and reports throughput (turns/s)
+and the peak resident memory of the process. The summary is written to the
+monitor HDF5 file (group "Profiling") and to a JSON sidecar file.
+
+When disabled, section() returns a no-op context manager so the tracking loop
+does not need two code paths.
+
+Usage:
+    from profiling import TrackingProfiler
+
+    profiler = TrackingProfiler(enabled=config.get('profile', False))
+    for i in range(n_turns):
+        for el in tracking_elements:
+            with profiler.section(type(el).__name__):
+                el.track(bunch)
+        profiler.turn_done()
+    profiler.write(monitor.file, json_path)
+"""
+
+import contextlib
+import json
+import resource
+import time
+
+import h5py
+import numpy as np
+
+
+class TrackingProfiler:
+    """Accumulate per-section wall time, turn count and peak memory.
+
+    Args:
+        enabled: If False, nothing is measured or written.
+        comm: Optional MPI communicator. If given, times are reduced with
+            MPI.MAX across ranks before writing, so the summary reflects the
+            slowest rank.
+    """
+
+    def __init__(self, enabled: bool = False, comm=None):
+        self.enabled = enabled
+        self.comm = comm
+        self.times = {}
+        self.calls = {}
+        self.turns = 0
+        self._start = time.perf_counter()
+
+    @contextlib.contextmanager
+    def _timed(self, name: str):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.times[name] = self.times.get(name, 0.0) + time.perf_counter() - t0
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+    def section(self, name: str):
+        """Return a context manager timing the enclosed block under name."""
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return self._timed(name)
+
+    def turn_done(self) -> None:
+        """Count one tracked turn."""
+        self.turns += 1
+
+    @staticmethod
+    def peak_rss_mb() -> float:
+        """Return the peak resident set size of the process in MB."""
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    def summary(self) -> dict:
+        """Return the profiling summary as a dictionary.
+
+        With an MPI communicator, this is a collective call.
+        """
+        names = sorted(self.times)
+        times = np.array([self.times[name] for name in names])
+        calls = np.array([self.calls[name] for name in names], dtype=float)
+        scalars = np.array([time.perf_counter() - self._start,
+                            self.peak_rss_mb()])
+        if self.comm is not None:
+            # Communicators of the shared-memory backend carry their own
+            # MPI names.
+            MPI = getattr(self.comm, "MPI", None)
+            if MPI is None:
+                from mpi4py import MPI
+            for array in (times, calls, scalars):
+                self.comm.Allreduce(MPI.IN_PLACE, array, op=MPI.MAX)
+        total_time = float(scalars[0])
+        tracked = float(times.sum())
+        return {
+            "turns": self.turns,
+            "total_time": total_time,
+            "turns_per_second": self.turns / total_time if total_time else 0.0,
+            "peak_rss_mb": float(scalars[1]),
+            "sections": {
+                name: {
+                    "time": float(times[k]),
+                    "calls": int(calls[k]),
+                    "time_per_call": float(times[k] / calls[k]) if calls[k] else 0.0,
+                    "fraction": float(times[k]) / tracked if tracked else 0.0,
+                }
+                for k, name in enumerate(names)
+            },
+        }
+
+    def write(self, file: h5py.File | None, json_path: str | None = None) -> dict:
+        """Write the summary to an HDF5 file and optionally a JSON file.
+
+        With an MPI communicator, this is a collective call and only rank 0
+        writes the JSON file.
+
+        Args:
+            file: Open HDF5 file (typically the monitor file), or None on
+                processes which do not write it.
+            json_path: Path of the JSON sidecar file.
+
+        Returns:
+            The summary dictionary, or an empty one if profiling is disabled.
+        """
+        if not self.enabled:
+            return {}
+        summary = self.summary()
+        sections = summary["sections"]
+        names = list(sections)
+
+        if file is not None:
+            g = file.require_group("Profiling")
+            for key in ("turns", "total_time", "turns_per_second",
+                        "peak_rss_mb"):
+                g.attrs[key] = summary[key]
+            for key in ("section", "time", "calls", "time_per_call",
+                        "fraction"):
+                if key in g:
+                    del g[key]
+            g.create_dataset("section", data=np.array(names, dtype=object),
+                             dtype=h5py.string_dtype())
+            for key in ("time", "calls", "time_per_call", "fraction"):
+                g.create_dataset(key, data=np.array(
+                    [sections[name][key] for name in names], dtype=float))
+            file.flush()
+
+        if json_path is not None and (self.comm is None
+                                      or self.comm.Get_rank() == 0):
+            with open(json_path, "w") as f:
+                json.dump(summary, f, indent=2)
+        return summary
@@ -0,0 +1,139 @@
+"""
+Independent random streams per bunch and per element.
+
+The tracking scripts seed the global NumPy generator once, and all random
+draws (initial distributions, quantum excitation, IBS and BPM noise) are
+taken from it in execution order. The numbers seen by a bunch then depend
+on the number of MPI ranks and threads and on the bunches tracked before
+it, so the initialisation cannot be split across ranks reproducibly.
+
+RandomStreams derives one MT19937 stream per (name, index) key from a
+single seed with numpy SeedSequence:
+
+    - ("init", bunch_number): initial distribution of a bunch,
+    - ("sr", bunch_number), ("ibs", bunch_number), ("bpm", bunch_number):
+      draws of an element for a bunch.
+
+Keys depend on bunch numbers only: a bunch sees the same random numbers
+whatever the rank or thread tracking it, and a run gives the same result
+on any number of ranks. Streams are created on first use.
+
+mbtrack2 draws from the global generator, so a stream is used by swapping
+its state into the global generator for the duration of a call
+(RandomStreams.activate). Swaps are serialised by a lock: elements drawing
+from streams are reproducible, but their bunches are not tracked
+concurrently by a BunchThreadPool.
+
+The states of the streams are saved in checkpoints as the stream_states
+attribute, and record_streams writes the seed to the output file.
+
+Usage:
+    from random_streams import RandomStreams
+
+    streams = RandomStreams(seed=42)
+    with streams.activate("init", bunch.bunch_number):
+        bunch.init_gaussian()
+    sr.streams = streams
+"""
+
+import threading
+import zlib
+from contextlib import contextmanager, nullcontext
+
+import numpy as np
+
+# Length of the MT19937 key.
+KEY_SIZE = 624
+# Columns of a row of stream_states: name id, index, key, pos, has_gauss,
+# cached_gaussian.
+STATE_SIZE = 2 + KEY_SIZE + 3
+
+
+def stream_id(name: str) -> int:
+    """Return the integer identifying a stream name in SeedSequence keys."""
+    return zlib.crc32(name.encode())
+
+
+class RandomStreams:
+    """Independent random streams derived from one seed.
+
+    Args:
+        seed: Entropy of the root SeedSequence.
+
+    Attributes:
+        seed: Seed of the streams.
+        stream_states: States of the streams created so far, as an array of
+            shape (n_streams, STATE_SIZE). Setting it restores the streams.
+    """
+
+    def __init__(self, seed: int):
+        self.seed = int(seed)
+        self._streams = {}
+        self._lock = threading.RLock()
+
+    def stream(self, name: str, index: int | None = 0) -> np.random.RandomState:
+        """Return the generator of a key, created on first use.
+
+        Args:
+            name: Name of the stream, e.g. "init" or an element name.
+            index: Bunch number. None, as for a Bunch outside a Beam, is 0.
+        """
+        key = (stream_id(name), 0 if index is None else int(index))
+        with self._lock:
+            stream = self._streams.get(key)
+            if stream is None:
+                sequence = np.random.SeedSequence(self.seed, spawn_key=key)
+                stream = np.random.RandomState(np.random.MT19937(sequence))
+                self._streams[key] = stream
+        return stream
+
+    @contextmanager
+    def activate(self, name: str, index: int | None = 0):
+        """Draw from a stream through the global NumPy generator.
+
+        The global generator state is restored on exit, and the stream
+        continues from the numbers drawn inside the context.
+        """
+        with self._lock:
+            stream = self.stream(name, index)
+            saved = np.random.get_state()
+            np.random.set_state(stream.get_state())
+            try:
+                yield stream
+            finally:
+                stream.set_state(np.random.get_state())
+                np.random.set_state(saved)
+
+    @property
+    def stream_states(self) -> np.ndarray:
+        rows = []
+        with self._lock:
+            for key, stream in sorted(self._streams.items()):
+                _, keys, pos, has_gauss, cached_gaussian = stream.get_state()
+                rows.append(
+                    np.concatenate(
+                        [key, keys, [pos, has_gauss, cached_gaussian]]))
+        return np.array(rows, dtype=float).reshape(-1, STATE_SIZE)
+
+    @stream_states.setter
+    def stream_states(self, rows: np.ndarray):
+        with self._lock:
+            for row in np.asarray(rows, dtype=float).reshape(-1, STATE_SIZE):
+                stream = np.random.RandomState()
+                stream.set_state(
+                    ("MT19937", row[2:2 + KEY_SIZE].astype(np.uint32),
+                     int(row[-3]), int(row[-2]), float(row[-1])))
+                self._streams[(int(row[0]), int(row[1]))] = stream
+
+
+def bunch_stream(streams: RandomStreams | None, name: str, bunch):
+    """Context drawing from the stream of a bunch, if streams is not None."""
+    if streams is None:
+        return nullcontext()
+    return streams.activate(name, bunch.bunch_number)
+
+
+def record_streams(file, streams: RandomStreams) -> None:
+    """Store the seed of the random streams as attributes of an HDF5 file."""
+    file.attrs["random_seed"] = streams.seed
+    file.attrs["random_streams"] = "SeedSequence(seed, (crc32(name), index))"
@@ -0,0 +1,251 @@
+"""
+Rank-local BeamMonitor files merged into one file after the run.
+
+BeamMonitor in MPI mode writes every buffer through parallel HDF5, so each
+flush is a collective operation on the shared file. RankLocalBeamMonitor
+writes the bunches owned by a rank to a file of its own,
+
+    <file_name>.rank<rank>.hdf5,
+
+with datasets of shape (..., n_local, total_size) instead of
+(..., h, total_size). Buffers are copied and written by a background thread,
+so that tracking goes on during the write, and no rank waits for another.
+
+merge_rank_files then creates <file_name>.hdf5 with the layout of a
+BeamMonitor file: the "Beam" datasets are HDF5 virtual datasets mapping the
+rows of each rank file to its bunch numbers (or plain copies with
+copy=True), and the other groups and attributes (wake potential monitor,
+profiling, stop reason) are copied from the rank files. Postprocessing opens
+the merged file as any monitor file, as long as the rank files stay next to
+it.
+
+Usage:
+    from rank_monitor import RankLocalBeamMonitor, merge_rank_files
+
+    beam_monitor = RankLocalBeamMonitor(ring.h, beam.mpi.bunch_numbers,
+                                        beam.mpi.rank, save_every=10,
+                                        buffer_size=1000, total_size=10000,
+                                        file_name=monitor_filename)
+    ...
+    beam_monitor.close()
+    if beam.mpi.rank == 0:
+        merge_rank_files(monitor_filename)
+
+    # Or after the run:
+    python rank_monitor.py <file_name> [--copy]
+"""
+
+import argparse
+import glob
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import h5py
+import numpy as np
+from mbtrack2.tracking.monitors import BeamMonitor
+
+from stopping import trim_monitor
+
+
+def rank_file_name(file_name: str, rank: int) -> str:
+    """Return the name of the file of a rank, without the .hdf5 suffix."""
+    return f"{file_name}.rank{rank:05d}"
+
+
+def _runs(bunch_numbers: np.ndarray) -> list:
+    """Return (local slice, global slice) of the contiguous bunch runs."""
+    if bunch_numbers.size == 0:
+        return []
+    breaks = np.flatnonzero(np.diff(bunch_numbers) != 1) + 1
+    starts = np.concatenate([[0], breaks])
+    stops = np.concatenate([breaks, [bunch_numbers.size]])
+    return [(slice(start, stop),
+             slice(bunch_numbers[start], bunch_numbers[stop - 1] + 1))
+            for start, stop in zip(starts, stops)]
+
+
+class RankLocalBeamMonitor(BeamMonitor):
+    """BeamMonitor writing the bunches of one MPI rank to its own file.
+
+    Args:
+        h: Harmonic number.
+        bunch_numbers: Bunches owned by the rank, in increasing order.
+        rank: MPI rank.
+        save_every: See BeamMonitor.
+        buffer_size: See BeamMonitor.
+        total_size: See BeamMonitor.
+        file_name: Name of the merged file, without the .hdf5 suffix.
+    """
+
+    def __init__(self,
+                 h: int,
+                 bunch_numbers: list,
+                 rank: int,
+                 save_every: int,
+                 buffer_size: int,
+                 total_size: int,
+                 file_name: str):
+        self.h = int(h)
+        self.bunch_numbers = np.asarray(bunch_numbers, dtype=int)
+        n = self.bunch_numbers.size
+        dict_buffer = {
+            "mean": (6, n, buffer_size),
+            "std": (6, n, buffer_size),
+            "emit": (3, n, buffer_size),
+            "current": (n, buffer_size),
+            "cs_invariant": (3, n, buffer_size),
+        }
+        dict_file = {
+            "mean": (6, n, total_size),
+            "std": (6, n, total_size),
+            "emit": (3, n, total_size),
+            "current": (n, total_size),
+            "cs_invariant": (3, n, total_size),
+        }
+        self.monitor_init("Beam", save_every, buffer_size, total_size,
+                          dict_buffer, dict_file,
+                          rank_file_name(file_name, rank), mpi_mode=False)
+        self.dict_buffer = dict_buffer
+        self.dict_file = dict_file
+        self.g.attrs["h"] = self.h
+        self.g.attrs["rank"] = int(rank)
+        self.g.attrs["bunch_numbers"] = self.bunch_numbers
+        self._executor = ThreadPoolExecutor(1)
+        self._pending = None
+
+    def to_buffer(self, beam):
+        """
+        Save data for all locally-owned bunches to buffer.
+
+        Parameters
+        ----------
+        beam : Beam object
+        """
+        self.time[self.buffer_count] = self.track_count
+        for k, bunch_num in enumerate(self.bunch_numbers):
+            bunch = beam[bunch_num]
+            self.mean[:, k, self.buffer_count] = bunch.mean
+            self.std[:, k, self.buffer_count] = bunch.std
+            self.emit[:, k, self.buffer_count] = bunch.emit
+            self.current[k, self.buffer_count] = bunch.current
+            self.cs_invariant[:, k, self.buffer_count] = bunch.cs_invariant
+        self.buffer_count += 1
+        if self.buffer_count == self.buffer_size:
+            self.write()
+            self.buffer_count = 0
+
+    def _write(self, sl: slice, data: dict) -> None:
+        group = self.file[self.group_name]
+        for key, value in data.items():
+            group[key][..., sl] = value
+        self.file.flush()
+
+    def write(self, bunch_nums=None):
+        """
+        Write a copy of the buffer to the rank file in the background.
+
+        Parameters
+        ----------
+        bunch_nums : iterable of int, unused
+            All bunches of the rank are written.
+        """
+        self.wait()
+        sl = slice(self.write_count * self.buffer_size,
+                   (self.write_count + 1) * self.buffer_size)
+        data = {
+            key: getattr(self, key).copy()
+            for key in ["time"] + list(self.dict_buffer)
+        }
+        self._pending = self._executor.submit(self._write, sl, data)
+        self.write_count += 1
+
+    def wait(self) -> None:
+        """Wait for the background write to complete."""
+        if self._pending is not None:
+            pending, self._pending = self._pending, None
+            pending.result()
+
+    def trim(self) -> None:
+        """trim_monitor of the rank file, after the pending write."""
+        self.wait()
+        trim_monitor(self)
+
+    def close(self):
+        """Complete the pending write and close the rank file."""
+        try:
+            self.wait()
+        finally:
+            self._executor.shutdown()
+            super().close()
+
+
+def merge_rank_files(file_name: str, copy: bool = False) -> str:
+    """Present the rank files of a run as one BeamMonitor file.
+
+    Args:
+        file_name: File name given to RankLocalBeamMonitor, without the
+            .hdf5 suffix.
+        copy: If True, copy the data instead of creating virtual datasets,
+            so that the rank files can be deleted afterwards.
+
+    Returns:
+        Name of the merged file.
+
+    Raises:
+        FileNotFoundError: If there is no rank file for file_name.
+    """
+    paths = sorted(glob.glob(glob.escape(file_name) + ".rank*.hdf5"))
+    if not paths:
+        raise FileNotFoundError(f"No rank files for {file_name}.")
+    merged = file_name + ".hdf5"
+    files = [h5py.File(path, "r") for path in paths]
+    try:
+        first = files[0]["Beam"]
+        h = int(first.attrs["h"])
+        with h5py.File(merged, "w", libver="latest") as out:
+            group = out.create_group("Beam")
+            group.create_dataset("time", data=first["time"][:])
+            for key, dataset in first.items():
+                if key == "time":
+                    continue
+                shape = dataset.shape[:-2] + (h, dataset.shape[-1])
+                if copy:
+                    target = group.create_dataset(key, shape,
+                                                  dtype=dataset.dtype)
+                else:
+                    target = h5py.VirtualLayout(shape, dtype=dataset.dtype)
+                for f, path in zip(files, paths):
+                    source = f["Beam"][key]
+                    if not copy:
+                        # Relative to the merged file, which sits next to the
+                        # rank files.
+                        source = h5py.VirtualSource(os.path.basename(path),
+                                                    source.name,
+                                                    shape=source.shape)
+                    bunch_numbers = np.asarray(f["Beam"].attrs["bunch_numbers"])
+                    for local, rows in _runs(bunch_numbers):
+                        target[..., rows, :] = source[..., local, :]
+                if not copy:
+                    group.create_virtual_dataset(key, target, fillvalue=0)
+
+            for key, value in files[0].attrs.items():
+                out.attrs[key] = value
+            for f in files:
+                for name in f:
+                    if name != "Beam" and name not in out:
+                        f.copy(f[name], out, name=name)
+    finally:
+        for f in files:
+            f.close()
+    return merged
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Merge the rank-local monitor files of a run.")
+    parser.add_argument('file_name', type=str,
+                        help='Monitor file name, without .rank*.hdf5.')
+    parser.add_argument('--copy', action='store_true',
+                        help='Copy the data instead of virtual datasets.')
+    args = parser.parse_args()
+    print(merge_rank_files(args.file_name, copy=args.copy))
@@ -0,0 +1,348 @@
+"""
+Rigid-bunch reduced model for coupled-bunch growth-rate scans.
+
+The multi-bunch instabilities driven by the long-range resistive wall only
+need the motion of the bunch centroids. This model tracks each bunch as one
+rigid macroparticle, or as a few slices on a longitudinal "airbag" ring of
+radius sqrt(2) sigma so that the chromatic phase spread of the centroid is
+kept, through the same ring, exponential feedback and long-range wakes as
+track_mb:
+
+    - ring: v3633 with the tunes, chromaticities and emittances of track_mb,
+    - single-particle motion: OneTurnMap with the main RF cavity and
+      transverse radiation damping, without quantum excitation. The
+      longitudinal damping is off so that the airbag keeps its radius,
+    - feedback: the damper of setup_fbt, applied to the bunch means,
+    - long-range wake: setup_long_range_wakes with the long_range_wake
+      model of track_mb, dipolar and, if quad is on, quadrupolar.
+
+The short-range WakePotential, the beam-loaded and harmonic cavities, space
+charge and IBS are not modelled. The wakes are on from the first turn, so
+that the warm-up of track_mb is not tracked.
+
+The bunch centroids start at random offsets with the rms of the centroid
+noise of a full run with n_macroparticles per bunch. The bunch means are
+saved every save_every turns in the layout of BeamMonitor ("Beam/mean",
+"Beam/time"), so that the growth_rate functions below apply to both.
+
+Usage:
+    # Growth rates for a configuration:
+    python rigid_bunch.py --config config.toml
+
+    # Compare with a full-particle track_mb run of the same configuration:
+    python rigid_bunch.py --config config.toml --reference monitors.hdf5
+"""
+
+import argparse
+import os
+import sys
+
+import h5py
+import numpy as np
+from mbtrack2.tracking import Beam, Bunch, RFCavity
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from config import load_toml_config
+from filling import load_filling_pattern
+from long_range_wake import RecursiveResistiveWall
+from one_turn_map import OneTurnMap
+from setup_tracking import setup_fbt, setup_long_range_wakes
+from facilities_mbtrack2 import v3633
+
+
+class RigidBunchBeam:
+    """Bunches of a filling pattern as rigid macroparticles.
+
+    The slices of all bunches are stored in one Bunch, bunch after bunch,
+    so that single-particle elements are applied once per turn.
+
+    Args:
+        ring: Synchrotron object.
+        filling_pattern: Current in each bucket in [A], shape (h,).
+        n_slices: Number of slices per bunch.
+        n_macroparticles: Macroparticles per bunch of the full model, which
+            sets the rms of the initial centroid offsets.
+    """
+
+    def __init__(self, ring, filling_pattern: np.ndarray, n_slices: int = 1,
+                 n_macroparticles: int = int(1e5)):
+        self.ring = ring
+        self.bunch_index = np.flatnonzero(filling_pattern)
+        self.charge = filling_pattern[self.bunch_index] * ring.T0
+        self.n_slices = int(n_slices)
+        n_bunches = self.bunch_index.size
+        self.bunch = Bunch(ring,
+                           mp_number=n_bunches * self.n_slices,
+                           current=1e-3,
+                           track_alive=False)
+
+        sigma = ring.sigma()
+        sigma_centroid = np.array([sigma[0], sigma[1], sigma[2], sigma[3],
+                                   ring.sigma_0, ring.sigma_delta])
+        sigma_centroid /= np.sqrt(n_macroparticles)
+        offsets = np.random.standard_normal((6, n_bunches))
+        offsets *= sigma_centroid[:, None]
+        if self.n_slices > 1:
+            angle = 2 * np.pi * np.arange(self.n_slices) / self.n_slices
+            airbag = np.sqrt(2) * np.array([
+                ring.sigma_0 * np.cos(angle),
+                ring.sigma_delta * np.sin(angle),
+            ])
+        else:
+            airbag = np.zeros((2, 1))
+        for k, key in enumerate(["x", "xp", "y", "yp", "tau", "delta"]):
+            values = np.repeat(offsets[k], self.n_slices)
+            if k >= 4:
+                values += np.tile(airbag[k - 4], n_bunches)
+            self.bunch[key] = values
+
+    def means(self) -> np.ndarray:
+        """Return the bunch means, shape (6, n_bunches)."""
+        return np.array([
+            self.bunch[key].reshape(-1, self.n_slices).mean(axis=1)
+            for key in ["x", "xp", "y", "yp", "tau", "delta"]
+        ])
+
+    def kick(self, key: str, kicks: np.ndarray) -> None:
+        """Add a per-bunch kick to a coordinate of all slices."""
+        self.bunch[key] += np.repeat(kicks, self.n_slices)
+
+
+def track_damper(damper, beam: RigidBunchBeam) -> None:
+    """Apply a TransverseExponentialDamper to the bunch means at once."""
+    means = beam.means()
+    for plane, (u, up) in enumerate([(0, 1), (2, 3)]):
+        damping_time = damper.damping_time[plane]
+        if damping_time == 0:
+            continue
+        beta_bpm = damper.beta_bpm[plane]
+        beta_kicker = damper.beta_kicker[plane]
+        phase = damper.phase_diff[plane]
+        kick = ((2 / damping_time * np.sin(phase) * means[up]) *
+                np.sqrt(beta_bpm / beta_kicker) +
+                (2 / damping_time * np.cos(phase) * means[u]) /
+                np.sqrt(beta_bpm * beta_kicker))
+        beam.kick("xp" if plane == 0 else "yp", -kick)
+
+
+def table_kicks(wake, beam: RigidBunchBeam, means: np.ndarray) -> np.ndarray:
+    """Update the centroid tables of a CombinedResistiveWall.
+
+    Returns:
+        Kick of each wake type on each bunch, shape (n_types, n_bunches).
+    """
+    n_bunches = beam.bunch_index.size
+    if wake.tau.shape[0] != n_bunches:
+        # Tables sized for the Beam passed at construction.
+        wake.nb = n_bunches
+        wake.tau = np.ones((n_bunches, wake.nt)) * 1e100
+        wake.x = np.zeros((n_bunches, wake.nt))
+        wake.y = np.zeros((n_bunches, wake.nt))
+        wake.charge = np.zeros((n_bunches, wake.nt))
+    # Same update as LongRangeResistiveWall.update_tables.
+    wake.tau += wake.ring.T0
+    for name in ("tau", "x", "y", "charge"):
+        setattr(wake, name, np.roll(getattr(wake, name), shift=1, axis=1))
+    wake.tau[:, 0] = means[4] - beam.bunch_index * wake.ring.T1
+    wake.x[:, 0] = means[0]
+    wake.y[:, 0] = means[2]
+    wake.charge[:, 0] = beam.charge
+    kicks = [wake.get_kicks(k) for k in range(n_bunches)]
+    return np.array([[kick[t] for kick in kicks] for t in wake.types])
+
+
+def track_long_range(wake, beam: RigidBunchBeam) -> None:
+    """Apply a RecursiveResistiveWall or CombinedResistiveWall to the bunches.
+
+    The kicks are those of LongRangeResistiveWall.track_bunch.
+    """
+    means = beam.means()
+    if isinstance(wake, RecursiveResistiveWall):
+        tau = np.zeros(wake.ring.h)
+        tau[beam.bunch_index] = means[4]
+        weights = np.zeros((len(wake.types), wake.ring.h))
+        weights[:, beam.bunch_index] = wake.source_weights(beam.charge, means)
+        kicks = wake.fold(tau, weights)[:, beam.bunch_index]
+    else:
+        kicks = table_kicks(wake, beam, means)
+    kicks = kicks / wake.ring.E0
+    for k, wake_type in enumerate(wake.types):
+        if wake_type == "Wlong":
+            beam.kick("delta", -kicks[k])
+        elif wake_type == "Wxdip":
+            beam.kick("xp", kicks[k] * wake.norm_x)
+        elif wake_type == "Wydip":
+            beam.kick("yp", kicks[k] * wake.norm_y)
+        elif wake_type == "Wxquad":
+            beam.bunch["xp"] += (beam.bunch["x"] * wake.norm_x *
+                                 np.repeat(kicks[k], beam.n_slices))
+        elif wake_type == "Wyquad":
+            beam.bunch["yp"] += (beam.bunch["y"] * wake.norm_y *
+                                 np.repeat(kicks[k], beam.n_slices))
+
+
+def run_rigid_bunch(config: dict) -> str:
+    """Track the rigid-bunch model of a track_mb configuration.
+
+    Args:
+        config: Configuration dictionary of track_mb. Additional keys are
+            rigid_slices (default 1) and rigid_n_turns (default n_turns -
+            warmup_turns).
+
+    Returns:
+        Name of the HDF5 file with the bunch means.
+    """
+    folder = config['folder']
+    n_turns = config.get('n_turns', 100_000)
+    warmup_turns = config.get('warmup_turns', 25_000)
+    n_turns = config.get('rigid_n_turns', max(n_turns - warmup_turns, 1))
+    n_slices = config.get('rigid_slices', 1)
+    n_macroparticles = config.get('n_macroparticles', int(1e5))
+    bunch_current = config.get('bunch_current', 1.2e-3)
+    Qp_x = config.get('Qp_x', 1.6)
+    Qp_y = config.get('Qp_y', 1.6)
+    id_state = config.get('id_state', "open")
+    n_turns_wake = config.get('n_turns_wake', 1)
+    feedback_tau = config.get('feedback-tau', 1.e-2)
+    quad = config.get('quad', False)
+    filling_pattern = config.get('filling_pattern', None)
+    save_every = config.get('rigid_save_every', 10)
+    # Same long-range wake model as track_mb, so that the wake memory of a
+    # reference run is the same.
+    long_range_wake = config.get('long_range_wake', 'tables')
+    # Seed of the initial slices, as in track_mb.
+    seed = config.get('seed', 42)
+
+    Vc = 1.7e6
+    ring = v3633(IDs=id_state, V_RF=Vc, load_lattice=True)
+    ring.tune = np.array([54.23, 18.21])
+    ring.chro = [Qp_x, Qp_y]
+    ring.emit[1] = 0.3 * ring.emit[0]
+    np.random.seed(seed)
+    filling_pattern = load_filling_pattern(filling_pattern, ring.h,
+                                           bunch_current)
+    beam = RigidBunchBeam(ring, filling_pattern, n_slices, n_macroparticles)
+
+    main_rf = RFCavity(ring, m=1, Vc=Vc, theta=np.arccos(ring.U0 / Vc))
+    # Without quantum excitation, longitudinal damping would shrink the
+    # airbag slices to a point and remove their chromatic spread.
+    one_turn_map = OneTurnMap(ring, [main_rf], radiation=True,
+                              switch=(0, 1, 1), qexcitation=False)
+    fbtx, fbty = setup_fbt(ring, feedback_tau)
+    long_wakefield = setup_long_range_wakes(ring, Beam(ring), id_state,
+                                            n_turns_wake, long_range_wake,
+                                            quad == 'True')
+
+    n_saves = (n_turns - 1) // save_every + 1
+    mean = np.zeros((6, ring.h, n_saves))
+    time = np.zeros(n_saves, dtype=int)
+    for i in range(n_turns):
+        if i % save_every == 0:
+            mean[:, beam.bunch_index, i // save_every] = beam.means()
+            time[i // save_every] = i
+        one_turn_map.track(beam.bunch)
+        if feedback_tau != 0:
+            track_damper(fbtx, beam)
+            track_damper(fbty, beam)
+        track_long_range(long_wakefield, beam)
+
+    file_name = (folder + f"rigid(n_slices={n_slices}"
+                 f",n_turns={n_turns:.1e}"
+                 f",bunch_current={bunch_current:.1e}"
+                 f",Qp_x={Qp_x:.2f}"
+                 f",Qp_y={Qp_y:.2f}"
+                 f",ID_state={id_state}"
+                 f",n_turns_wake={n_turns_wake}"
+                 f",feedback_tau={feedback_tau:.1e}"
+                 f",quad={quad})")
+    with h5py.File(file_name + ".hdf5", "w") as f:
+        group = f.create_group("Beam")
+        group.create_dataset("mean", data=mean)
+        group.create_dataset("time", data=time)
+    return file_name + ".hdf5"
+
+
+def amplitude(mean: np.ndarray, ring, plane: str) -> np.ndarray:
+    """Return the rms Courant-Snyder amplitude of the bunch centroids.
+
+    Args:
+        mean: Bunch means, shape (6, h, n_samples).
+        ring: Synchrotron object.
+        plane: "x" or "y".
+
+    Returns:
+        sqrt(beta * J) averaged in quadrature over the buckets, shape
+        (n_samples,).
+    """
+    k = 0 if plane == "x" else 1
+    u, up = mean[2 * k], mean[2*k + 1]
+    alpha = ring.optics.local_alpha[k]
+    beta = ring.optics.local_beta[k]
+    invariant = (u**2 + (alpha*u + beta*up)**2) / beta
+    return np.sqrt(beta * np.mean(invariant, axis=0))
+
+
+def growth_rate(file_name: str, ring, plane: str,
+                start_turn: int = 0) -> float:
+    """Fit the growth rate of the centroid amplitude in a monitor file.
+
+    The log of the amplitude is fitted by a line over the second half of
+    the samples after start_turn.
+
+    Args:
+        file_name: HDF5 file with a "Beam" group from BeamMonitor or
+            run_rigid_bunch.
+        ring: Synchrotron object.
+        plane: "x" or "y".
+        start_turn: First turn with the wakes on.
+
+    Returns:
+        Growth rate in [1/s], negative for a damped beam.
+    """
+    with h5py.File(file_name, "r") as f:
+        time = f["Beam"]["time"][:]
+        mean = f["Beam"]["mean"][:]
+    # Samples of an unfinished or stopped run are left at zero.
+    n = np.argmax(np.append(np.diff(time) <= 0, True)) + 1
+    time, mean = time[:n], mean[..., :n]
+    selected = time >= start_turn
+    time, amp = time[selected], amplitude(mean[..., selected], ring, plane)
+    time, amp = time[time.size // 2:], amp[time.size // 2:]
+    valid = np.isfinite(amp) & (amp > 0)
+    slope = np.polyfit(time[valid], np.log(amp[valid]), 1)[0]
+    return slope / ring.T0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="""Rigid-bunch coupled-bunch growth rates.
+
+    Tracks the bunch centroids of a track_mb configuration and prints the
+    growth rates. With --reference, the growth rates of a full-particle
+    track_mb monitor file of the same configuration are printed as well.
+    """,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-c', '--config', metavar='CONFIG_FILE', type=str,
+                        required=True, help='Path to TOML configuration file.')
+    parser.add_argument('-r', '--reference', metavar='MONITOR_FILE', type=str,
+                        default=None,
+                        help='BeamMonitor file of a full-particle run.')
+    args = parser.parse_args()
+
+    full_config = load_toml_config(args.config)
+    config = full_config.get('script', full_config)
+    file_name = run_rigid_bunch(config)
+
+    id_state = config.get('id_state', "open")
+    ring = v3633(IDs=id_state, V_RF=1.7e6, load_lattice=True)
+    print(f"{'plane':>5} {'rigid [1/s]':>12} {'full [1/s]':>12} "
+          f"{'rel. diff':>10}")
+    for plane in ["x", "y"]:
+        rigid = growth_rate(file_name, ring, plane)
+        if args.reference is None:
+            print(f"{plane:>5} {rigid:12.4g}")
+            continue
+        full = growth_rate(args.reference, ring, plane,
+                           config.get('warmup_turns', 25_000))
+        print(f"{plane:>5} {rigid:12.4g} {full:12.4g} "
+              f"{(rigid - full) / abs(full):10.2%}")
@@ -0,0 +1,244 @@
+"""
+Tracking of slowly varying collective effects every few turns.
+
+Intrabeam scattering, space charge and synchrotron radiation change the
+beam on damping-time scales, but are tracked every turn like the maps. An
+ElementScheduler tracks such an element every N turns only, from a given
+turn or phase boundary on, and scales the element so that one call applies
+the effect of N turns:
+
+    - ScaledIntrabeamScattering multiplies the growth rates by N, so that
+      the random kicks have the variance of N turns,
+    - ScaledSynchrotronRadiation applies the damping and quantum excitation
+      of N turns of the linear radiation map,
+    - TransverseSpaceCharge is given an interaction length of N ring
+      lengths.
+
+The growth rates of IBS are computed once per N turns from the current
+bunch. Elements without a rule are tracked every turn.
+
+The rules are read from the configuration with the keys <name>_every and
+<name>_start, e.g. in the TOML file
+
+    ibs_every = 20
+    ibs_start = "warmup"    # or a turn number
+    sc_every = 5
+
+The start may be the name of a phase (see ElementScheduler.from_config):
+the element is then tracked from the end of that phase only.
+
+Usage:
+    from scheduling import ElementScheduler
+
+    scheduler = ElementScheduler.from_config(config, {"ibs": ibs, "sc": sc},
+                                             phases={"warmup": warmup_turns})
+    for el in scheduler.active(elements, turn):
+        el.track(bunch)
+"""
+
+import numpy as np
+from mbtrack2.tracking import SynchrotronRadiation
+from mbtrack2.tracking.element import Element
+from mbtrack2.tracking.ibs import IntrabeamScattering
+from mbtrack2.tracking.spacecharge import TransverseSpaceCharge
+
+from random_streams import bunch_stream
+
+
+class ScaledIntrabeamScattering(IntrabeamScattering):
+    """IntrabeamScattering applying the kicks of several turns at once.
+
+    Parameters are those of IntrabeamScattering.
+
+    Attributes:
+        turns: Number of turns applied by one call of track.
+        streams: RandomStreams drawing the kicks of each bunch from its
+            "ibs" stream. The global generator is used if None.
+    """
+
+    turns = 1
+    streams = None
+
+    @Element.parallel
+    def track(self, bunch):
+        """
+        Tracking method for the element.
+        No bunch to bunch interaction, so written for Bunch objects and
+        @Element.parallel is used to handle Beam objects.
+
+        Parameters
+        ----------
+        bunch : Bunch or Beam object
+        """
+        with bunch_stream(self.streams, "ibs", bunch):
+            super().track(bunch)
+
+    def kick(self, bunch, r_x, r_y, r_p):
+        """
+        Apply the kicks of self.turns turns.
+
+        See IntrabeamScattering.kick.
+        """
+        super().kick(bunch, self.turns * np.asarray(r_x),
+                     self.turns * np.asarray(r_y),
+                     self.turns * np.asarray(r_p))
+
+
+class ScaledSynchrotronRadiation(SynchrotronRadiation):
+    """SynchrotronRadiation applying the radiation of several turns at once.
+
+    Parameters are those of SynchrotronRadiation.
+
+    Attributes:
+        turns: Number of turns applied by one call of track.
+        streams: RandomStreams drawing the excitation of each bunch from its
+            "sr" stream. The global generator is used if None.
+    """
+
+    turns = 1
+    streams = None
+
+    @Element.parallel
+    def track(self, bunch):
+        """
+        Tracking method for the element.
+        No bunch to bunch interaction, so written for Bunch objects and
+        @Element.parallel is used to handle Beam objects.
+
+        Parameters
+        ----------
+        bunch : Bunch or Beam object
+        """
+        with bunch_stream(self.streams, "sr", bunch):
+            self._radiate(bunch)
+
+    def _radiate(self, bunch):
+        if self.turns == 1:
+            return super().track(bunch)
+        ring = self.ring
+        N = len(bunch)
+        sigma = ring.sigma()
+        # Coordinate, damping time and rms momentum of each plane.
+        planes = [("delta", ring.tau[2], ring.sigma_delta),
+                  ("xp", ring.tau[0], sigma[1]),
+                  ("yp", ring.tau[1], sigma[3])]
+        for switch, (coordinate, tau, sigma_p) in zip(self.switch, planes):
+            if not switch:
+                continue
+            damping = 1 - 2 * ring.T0 / tau
+            excitation = 0
+            if self.qexcitation:
+                # Sum of the variances of the excitations of each turn, as
+                # damped by the following turns.
+                variance = ((1 - damping**(2 * self.turns)) /
+                            (1 - damping**2) * 4 * sigma_p**2 * ring.T0 / tau)
+                rand = np.random.standard_normal(size=N)
+                excitation = np.sqrt(variance) * rand
+            bunch[coordinate] = (damping**self.turns * bunch[coordinate] +
+                                 excitation)
+
+
+def scale_element(element, turns: int) -> None:
+    """Make one call of element.track apply the effect of turns turns.
+
+    Raises:
+        TypeError: If the element cannot be scaled.
+    """
+    if turns == 1:
+        return
+    if isinstance(element,
+                  (ScaledIntrabeamScattering, ScaledSynchrotronRadiation)):
+        element.turns = int(turns)
+    elif isinstance(element, TransverseSpaceCharge):
+        element.interaction_length = element.ring.L * turns
+    else:
+        raise TypeError(
+            f"Cannot track {type(element).__name__} every {turns} turns.")
+
+
+class ElementScheduler:
+    """Track some elements every N turns or after a phase boundary.
+
+    Elements added to the scheduler are tracked on the turns
+    start, start + every, start + 2 every, ..., and scaled with
+    scale_element to apply every turns at once.
+
+    Attributes:
+        settings: [every, start] of each name scheduled by from_config,
+            e.g. for a cache key.
+    """
+
+    def __init__(self):
+        self.rules = {}
+        self.settings = {}
+
+    def add(self, element, every: int = 1, start: int = 0) -> None:
+        """Schedule an element.
+
+        Args:
+            element: Element to schedule.
+            every: Number of turns between two calls.
+            start: First turn on which the element is tracked.
+
+        Raises:
+            ValueError: If every is smaller than 1.
+            TypeError: If the element cannot be scaled.
+        """
+        every = int(every)
+        if every < 1:
+            raise ValueError("every must be >= 1.")
+        scale_element(element, every)
+        self.rules[id(element)] = (every, int(start))
+
+    def due(self, element, turn: int) -> bool:
+        """True if element is tracked on this turn."""
+        rule = self.rules.get(id(element))
+        if rule is None:
+            return True
+        every, start = rule
+        return turn >= start and (turn-start) % every == 0
+
+    def active(self, elements: list, turn: int) -> list:
+        """Return the elements tracked on this turn, in order."""
+        if not self.rules:
+            return elements
+        return [el for el in elements if self.due(el, turn)]
+
+    @classmethod
+    def from_config(cls,
+                    config: dict,
+                    elements: dict,
+                    phases: dict | None = None) -> "ElementScheduler":
+        """Build a scheduler from the <name>_every and <name>_start keys.
+
+        Args:
+            config: Configuration dictionary.
+            elements: Elements by name, e.g. {"ibs": ibs, "sc": besc}. A
+                value may be a list of elements sharing the rule.
+            phases: Turn at which each named phase ends, e.g.
+                {"warmup": warmup_turns}.
+
+        Returns:
+            ElementScheduler.
+
+        Raises:
+            ValueError: If a start refers to an unknown phase.
+        """
+        phases = phases or {}
+        scheduler = cls()
+        for name, members in elements.items():
+            every = config.get(f'{name}_every', 1)
+            start = config.get(f'{name}_start', 0)
+            if every == 1 and start == 0:
+                continue
+            if isinstance(start, str):
+                if start not in phases:
+                    raise ValueError(f"Unknown phase for {name}_start: "
+                                     f"{start}.")
+                start = phases[start]
+            scheduler.settings[name] = [every, start]
+            if not isinstance(members, (list, tuple)):
+                members = [members]
+            for element in members:
+                scheduler.add(element, every, start)
+        return scheduler
@@ -1,15 +1,42 @@
+from functools import partial
+
 import numpy as np
 from mbtrack2 import BeamLoadingEquilibrium, CavityResonator
 from mbtrack2.tracking.feedback import TransverseExponentialDamper
 from mbtrack2.tracking.feedback import FIRDamper
 from mbtrack2.impedance.wakefield import WakeField
-from mbtrack2.tracking import (RFCavity, WakePotential, DirectFeedback)
+from mbtrack2.tracking import (RFCavity, WakePotential)
 import os
 os.environ["PYTHONPATH"] += os.pathsep + "/home/dockeruser/facilities_mbtrack2"
 from facilities_mbtrack2.SOLEIL_II.IMPEDANCE_MODEL.load import load_soleil_ii_wf
+from wake_cache import DEFAULT_CACHE_DIR, cached_wakefield
+from composite_wake import CompositeWakePotential
+from fft_wake import FFTWakePotential
+from fir_feedback import TransverseFIRFeedback
+from long_range_wake import CombinedResistiveWall, RecursiveResistiveWall
+from beam_loading import VectorisedCavityResonator, VectorisedDirectFeedback
+from equilibrium_cache import (DEFAULT_CACHE_DIR as EQUILIBRIUM_CACHE_DIR,
+                               active_cavity_params, init_phasor_cached,
+                               memoize)
 
-def setup_wakes(ring, id_state, include_Zlong, n_bin, wake_types='Wydip'):
-    wakemodel = load_soleil_ii_wf(f'wf_CP1_IDgap_{id_state}_varyNEG_False', ring)
+def setup_wakes(ring, id_state, include_Zlong, n_bin, wake_types='Wydip',
+                cache_dir=DEFAULT_CACHE_DIR, engine='convolution'):
+    # engine: "convolution" for mbtrack2 WakePotential, "fft" for the adaptive
+    # grid and cached wake spectra of fft_wake, "composite" for the composite
+    # wake tables of composite_wake, cached next to the wake models.
+    if engine == 'fft':
+        WakeEngine = FFTWakePotential
+    elif engine == 'composite':
+        WakeEngine = partial(CompositeWakePotential, cache_dir=cache_dir)
+    else:
+        WakeEngine = WakePotential
+    if isinstance(wake_types, str):
+        wake_types = [wake_types]
+    wakemodel = cached_wakefield(f'wf_CP1_IDgap_{id_state}_varyNEG_False',
+                                 ring,
+                                 load_soleil_ii_wf,
+                                 components=list(wake_types) + ['Wlong'],
+                                 cache_dir=cache_dir)
     wakemodels = []
     for wake_type in wake_types:
         if wake_type == 'Wydip':
@@ -26,23 +53,71 @@ def setup_wakes(ring, id_state, include_Zlong, n_bin, wake_types='Wydip'):
     if include_Zlong:
         wakemodels.append(wakemodel.Wlong)
 
-    wakefield_tr = WakePotential(ring,
-                                 wakefield=WakeField(
-                                 wakemodels),
-                                 n_bin=n_bin)
+    wakefield_tr = WakeEngine(ring,
+                              wakefield=WakeField(
+                              wakemodels),
+                              n_bin=n_bin)
     
-    wakefield_long = WakePotential(ring,
-                                   wakefield=WakeField([wakemodel.Wlong]),
-                                   n_bin=n_bin)
+    wakefield_long = WakeEngine(ring,
+                                wakefield=WakeField([wakemodel.Wlong]),
+                                n_bin=n_bin)
     return wakefield_tr, wakefield_long, wakemodels
 
 
+def setup_long_range_wakes(ring, beam, id_state, n_turns_wake, model='tables',
+                           quad=False):
+    # model: "tables" for the centroid tables of LongRangeResistiveWall,
+    # "recursive" for the pole expansion of long_range_wake. With quad, one
+    # element applies the dipolar and quadrupolar wakes.
+    LongRangeWake = (RecursiveResistiveWall if model == 'recursive'
+                     else CombinedResistiveWall)
+    if id_state == "open":
+        x3 = 6.51e-3
+        y3 = 6.70e-3
+        x3_quad = -15.01e-3
+        y3_quad = 15.63e-3
+    else:
+        x3 = 5.78e-3
+        y3 = 5.61e-3
+        x3_quad = -7.90e-3
+        y3_quad = 8.87e-3
+    types = ["Wxdip", "Wydip"]
+    if quad:
+        types += ["Wxquad", "Wyquad"]
+    long_wakefield = LongRangeWake(
+        ring=ring,
+        beam=beam,
+        length=ring.L,
+        rho=2.135e-8,
+        radius=8e-3,
+        types=types,
+        nt=n_turns_wake,
+        x3=x3,
+        y3=y3,
+        x3_quad=x3_quad,
+        y3_quad=y3_quad,
+    )
+    return long_wakefield
+
+
 def setup_fbt(ring, feedback_tau, kind='exp'):
+    # kind: "exp" for the exponential damper, "fir" for one FIRDamper per
+    # plane, "fir2" for the two-plane FIR damper of fir_feedback. "exp" and
+    # "fir2" return the same element for both planes.
     if kind == 'exp':
         fbty = TransverseExponentialDamper(ring,
                                 damping_time=[ring.T0 * feedback_tau, ring.T0*feedback_tau],
                                 phase_diff=[np.pi / 2, np.pi/2])
         fbtx = fbty
+    elif kind == 'fir2':
+        fbty = TransverseFIRFeedback(ring,
+                                     turn_delay=1,
+                                     tap_number=7,
+                                     gain=1,
+                                     phase=90,
+                                     bpm_error=None,
+                                     max_kick=None)
+        fbtx = fbty
     else:
         fbty = FIRDamper(ring,
                         plane='y',
@@ -65,18 +140,14 @@ def setup_fbt(ring, feedback_tau, kind='exp'):
     return fbtx, fbty
 
 
-def get_active_cavity_params(ring):
-    I0 = 0.2
-    xi = 1.1
-    Vc = 1.7e6
+# Main and harmonic cavities of the active harmonic-cavity equilibrium, part
+# of its cache key.
+ACTIVE_MC = {'m': 1, 'Rs': 5e6, 'Q': 35.7e3, 'QL': 6e3, 'Ncav': 4}
+ACTIVE_HC = {'m': 4, 'Rs': 60 * 31e3, 'Q': 31e3, 'QL': 31e3, 'Ncav': 1}
+
 
-    HC = CavityResonator(ring,
-                         m=4,
-                         Rs=60 * 31e3,
-                         Q=31e3,
-                         QL=31e3,
-                         detune=1e6,
-                         Ncav=1)
+def solve_active_cavity_equilibrium(ring, I0=0.2, xi=1.1, Vc=1.7e6):
+    HC = CavityResonator(ring, detune=1e6, **ACTIVE_HC)
     HC.Vg = 0
     HC.theta_g = 0
 
@@ -85,13 +156,7 @@ def get_active_cavity_params(ring):
 
     delta = HC.Vb(I0) * np.cos(HC.psi)
 
-    MC = CavityResonator(ring,
-                         m=1,
-                         Rs=5e6,
-                         Q=35.7e3,
-                         QL=6e3,
-                         detune=1e6,
-                         Ncav=4)
+    MC = CavityResonator(ring, detune=1e6, **ACTIVE_MC)
     MC.Vc = Vc
     MC.theta = np.arccos((ring.U0 + delta) / MC.Vc)
     MC.set_optimal_detune(I0)
@@ -109,12 +174,26 @@ def get_active_cavity_params(ring):
         cavity.Vc = np.abs(Vc_phasor)
         cavity.theta = np.angle(Vc_phasor)
 
-    return MC.Vc, MC.theta, HC.Vc, HC.theta
+    return {'MC_Vc': MC.Vc, 'MC_theta': MC.theta,
+            'HC_Vc': HC.Vc, 'HC_theta': HC.theta,
+            'F': np.array(BLE.F), 'PHI': np.array(BLE.PHI)}
+
+
+def get_active_cavity_params(ring, I0=0.2, xi=1.1, Vc=1.7e6,
+                             cache_dir=EQUILIBRIUM_CACHE_DIR):
+    equilibrium = memoize('active_cavity',
+                          active_cavity_params(ring, I0, xi, Vc,
+                                               ACTIVE_MC, ACTIVE_HC),
+                          lambda: solve_active_cavity_equilibrium(ring, I0, xi, Vc),
+                          cache_dir)
+    return (equilibrium['MC_Vc'], equilibrium['MC_theta'],
+            equilibrium['HC_Vc'], equilibrium['HC_theta'])
 
 
-def setup_rf(ring, harmonic_cavity, Vc):
+def setup_rf(ring, harmonic_cavity, Vc, cache_dir=EQUILIBRIUM_CACHE_DIR):
     if harmonic_cavity:
-        V_main, theta_main, V_harmonic, theta_harmonic = get_active_cavity_params(ring)
+        V_main, theta_main, V_harmonic, theta_harmonic = get_active_cavity_params(
+            ring, cache_dir=cache_dir)
         main_rf = RFCavity(ring, m=1, Vc=V_main, theta=theta_main)
         harmonic_rf = RFCavity(ring,
                                m=4,
@@ -126,10 +205,15 @@ def setup_rf(ring, harmonic_cavity, Vc):
     return main_rf, harmonic_rf
 
 
-def setup_dual_rf(ring, beam, harmonic_cavity, bunch_current, wakemodel):
+def setup_dual_rf(ring, beam, harmonic_cavity, bunch_current, wakemodel,
+                  cache_dir=EQUILIBRIUM_CACHE_DIR, seed=None,
+                  mp_per_bunch=None, random_streams=False, n_bin=75):
+    # seed, mp_per_bunch and random_streams describe the initial bunches, on
+    # which the cached beam phasors depend. n_bin: number of bins of the
+    # cavity profiles, as shared by the collectives of the run.
     Vc = 1.7e6
     if harmonic_cavity:
-        Itot = ring.h * bunch_current  # Use for fixed detuning or CT
+        Itot = beam.current  # Use for fixed detuning or CT
         HC_det = 110e3  # Use for fixed detuning or CT
         HC_det_end = 3e3
         MC_det = -35e3
@@ -156,14 +240,16 @@ def setup_dual_rf(ring, beam, harmonic_cavity, bunch_current, wakemodel):
         QL = 6e3
         detune = MC_det
         Ncav = 4
-        rf = CavityResonator(ring, m, Rs, Q, QL, detune, Ncav=Ncav)
+        rf = VectorisedCavityResonator(ring, m, Rs, Q, QL, detune, Ncav=Ncav,
+                                       n_bin=n_bin)
     
         m = 4
         Rs = 2.358e6
         Q = 36e3
         QL = 36e3
         Ncav = 1
-        hrf = CavityResonator(ring, m, Rs, Q, QL, detune, Ncav=Ncav)
+        hrf = VectorisedCavityResonator(ring, m, Rs, Q, QL, detune, Ncav=Ncav,
+                                        n_bin=n_bin)
         hrf.Vg = 0
         hrf.theta_g = 0
         hrf.detune = HC_det
@@ -174,7 +260,8 @@ def setup_dual_rf(ring, beam, harmonic_cavity, bunch_current, wakemodel):
     
         delta = 0
         delta += hrf.Vb(Itot) * np.cos(hrf.psi)
-        delta += beam[0].charge * wakemodel.Wlong.loss_factor(
+        mean_charge = Itot * ring.T0 / len(beam.bunch_index)
+        delta += mean_charge * wakemodel.Wlong.loss_factor(
             estimated_bunch_length)
     
         rf.Vc = Vc
@@ -182,7 +269,7 @@ def setup_dual_rf(ring, beam, harmonic_cavity, bunch_current, wakemodel):
         # rf.set_optimal_detune(Itot)
         rf.set_generator(Itot)
     
-        dfb = DirectFeedback(
+        dfb = VectorisedDirectFeedback(
             ring=ring,
             cav_res=rf,
             gain=fb_gain,
@@ -193,8 +280,10 @@ def setup_dual_rf(ring, beam, harmonic_cavity, bunch_current, wakemodel):
             DFB_phase_shift=directFB_phaseShift,
         )
         rf.feedback.append(dfb)
-        rf.init_phasor(beam)
-        hrf.init_phasor(beam)
+        init_phasor_cached(rf, beam, bunch_current, cache_dir, seed,
+                           mp_per_bunch, random_streams)
+        init_phasor_cached(hrf, beam, bunch_current, cache_dir, seed,
+                           mp_per_bunch, random_streams)
     else:
         rf = RFCavity(ring, m=1, Vc=Vc, theta=np.arccos(ring.U0 / Vc))
         hrf = None
@@ -0,0 +1,291 @@
+"""
+Single-node shared-memory backend for multi-bunch tracking, without MPI.
+
+The multi-bunch loop is written for mbtrack2's Mpi: each rank owns a block
+of bunches and the per-turn bunch data (profiles, means) are exchanged with
+Allgatherv. This module runs the same loop in a pool of processes on one
+machine. SharedMemoryComm implements the part of the mpi4py communicator
+used by mbtrack2 and this package on top of multiprocessing.shared_memory:
+each process writes its block into a shared exchange array and reads the
+blocks of the others after a barrier. As the bunch distribution, the seeds
+and the arithmetic are those of the MPI path, the tracking is identical.
+
+The HDF5 monitor file is written by process 0 only, without parallel HDF5.
+SharedBeamMonitor keeps the BeamMonitor buffers in shared memory, so that
+every process fills the rows of its bunches and process 0 writes the whole
+buffer.
+
+Usage:
+    from shared_backend import run_shared_memory
+
+    # Calls run_mbtrack2(config, comm=comm) in 8 processes.
+    run_shared_memory(run_mbtrack2, config, n_processes=8)
+"""
+
+import multiprocessing
+import types
+import uuid
+from multiprocessing import resource_tracker, shared_memory
+from multiprocessing.connection import wait
+
+import numpy as np
+from mbtrack2.tracking.monitors import BeamMonitor
+
+from stopping import trim_monitor
+
+
+class _Request:
+    """Completed request returned by the non-blocking calls."""
+
+    @staticmethod
+    def Waitall(requests):
+        pass
+
+
+# Stand-in for the mpi4py names used with the communicator.
+MPI = types.SimpleNamespace(
+    DOUBLE=np.float64,
+    INT64_T=np.int64,
+    IN_PLACE=object(),
+    MIN=np.minimum,
+    MAX=np.maximum,
+    SUM=np.add,
+    Request=_Request,
+)
+
+
+class SharedMemoryComm:
+    """Communicator between the processes of run_shared_memory.
+
+    Collective calls must be made by all processes in the same order, as
+    with MPI. Non-blocking calls complete immediately.
+
+    Args:
+        rank: Index of this process.
+        size: Number of processes.
+        barrier: multiprocessing Barrier shared by the processes.
+        prefix: Unique prefix of the shared memory block names.
+    """
+
+    MPI = MPI
+
+    def __init__(self, rank: int, size: int, barrier, prefix: str):
+        self.rank = rank
+        self.size = size
+        self._barrier = barrier
+        self._prefix = prefix
+        self._count = 0
+        self._blocks = []
+        self._exchange = None
+
+    def Get_rank(self) -> int:
+        return self.rank
+
+    def Get_size(self) -> int:
+        return self.size
+
+    def Barrier(self) -> None:
+        self._barrier.wait()
+
+    def allocate(self, shape: tuple, dtype=np.float64) -> np.ndarray:
+        """Return a zeroed array in memory shared by all processes.
+
+        Collective call: process 0 creates the block, the others attach.
+        """
+        name = f"{self._prefix}_{self._count}"
+        self._count += 1
+        nbytes = max(int(np.prod(shape)) * np.dtype(dtype).itemsize, 1)
+        if self.rank == 0:
+            block = shared_memory.SharedMemory(name, create=True, size=nbytes)
+            np.ndarray((nbytes, ), dtype=np.uint8, buffer=block.buf)[:] = 0
+        self.Barrier()
+        if self.rank != 0:
+            block = shared_memory.SharedMemory(name)
+            # Only the creating process owns the block.
+            resource_tracker.unregister(block._name, "shared_memory")
+        self.Barrier()
+        if self.rank == 0:
+            # Mapped blocks stay valid; nothing is left behind on failure.
+            block.unlink()
+        self._blocks.append(block)
+        return np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+    def _exchange_buffer(self, nbytes: int) -> np.ndarray:
+        # Grown collectively: all processes request the same size.
+        if self._exchange is None or self._exchange.nbytes < nbytes:
+            self._exchange = self.allocate((max(nbytes, 1 << 16), ), np.uint8)
+        return self._exchange
+
+    def Allgatherv(self, sendbuf: list, recvbuf: list) -> None:
+        """Gather variable-size blocks into recvbuf on all processes.
+
+        Args:
+            sendbuf: [array, count, datatype] of the local block.
+            recvbuf: [array, counts, displacements, datatype].
+        """
+        local, count = sendbuf[0], int(sendbuf[1])
+        result, counts, displacements = recvbuf[:3]
+        dtype = result.dtype
+        total = int(np.sum(counts))
+        exchange = self._exchange_buffer(total * dtype.itemsize)
+        data = exchange[:total * dtype.itemsize].view(dtype)
+        start = int(displacements[self.rank])
+        data[start:start + count] = np.ravel(local)[:count]
+        self.Barrier()
+        result.reshape(-1)[:total] = data
+        self.Barrier()
+
+    def Iallgatherv(self, sendbuf: list, recvbuf: list) -> _Request:
+        """Allgatherv, returning a completed request."""
+        self.Allgatherv(sendbuf, recvbuf)
+        return _Request()
+
+    def allreduce(self, value, op=MPI.SUM):
+        """Reduce a scalar or an array over the processes."""
+        local = np.asarray(value, dtype=np.float64)
+        gathered = np.empty((self.size, local.size))
+        counts = np.full(self.size, local.size)
+        self.Allgatherv([local, local.size, MPI.DOUBLE],
+                        [gathered, counts, counts * np.arange(self.size),
+                         MPI.DOUBLE])
+        result = op.reduce(gathered, axis=0).reshape(local.shape)
+        return result.item() if np.ndim(value) == 0 else result
+
+    def Allreduce(self, sendbuf, recvbuf: np.ndarray, op=MPI.SUM) -> None:
+        """Reduce an array over the processes into recvbuf."""
+        local = recvbuf if sendbuf is MPI.IN_PLACE else sendbuf
+        recvbuf[...] = self.allreduce(local, op=op)
+
+    def close(self) -> None:
+        """Release the shared memory blocks of this process."""
+        self._exchange = None
+        for block in self._blocks:
+            block.close()
+        self._blocks = []
+
+
+class SharedBeamMonitor(BeamMonitor):
+    """BeamMonitor for a Beam distributed by SharedMemoryComm.
+
+    The buffers are shared by the processes, which fill the rows of their
+    bunches. Process 0 owns the HDF5 file and writes the full buffers, so
+    the file is the same as with BeamMonitor in MPI mode.
+
+    Args:
+        h: Harmonic number.
+        comm: SharedMemoryComm of the run.
+        save_every: See BeamMonitor.
+        buffer_size: See BeamMonitor.
+        total_size: See BeamMonitor.
+        file_name: See BeamMonitor.
+    """
+
+    def __init__(self,
+                 h: int,
+                 comm: SharedMemoryComm,
+                 save_every: int,
+                 buffer_size: int,
+                 total_size: int,
+                 file_name: str | None = None):
+        self.comm = comm
+        if comm.Get_rank() == 0:
+            super().__init__(h, save_every, buffer_size, total_size,
+                             file_name=file_name, mpi_mode=False)
+        else:
+            self.group_name = "Beam"
+            self.save_every = int(save_every)
+            self.buffer_size = int(buffer_size)
+            self.total_size = int(total_size)
+            self.buffer_count = 0
+            self.write_count = 0
+            self.track_count = 0
+            self.dict_buffer = {
+                "mean": (6, h, self.buffer_size),
+                "std": (6, h, self.buffer_size),
+                "emit": (3, h, self.buffer_size),
+                "current": (h, self.buffer_size),
+                "cs_invariant": (3, h, self.buffer_size),
+            }
+        self.time = comm.allocate((self.buffer_size, ), int)
+        for key, shape in self.dict_buffer.items():
+            setattr(self, key, comm.allocate(shape))
+
+    @property
+    def writer(self) -> bool:
+        """True on the process writing the HDF5 file."""
+        return self.comm.Get_rank() == 0
+
+    def write(self, bunch_nums=None):
+        """
+        Write the shared buffers to the HDF5 file from process 0.
+
+        Parameters
+        ----------
+        bunch_nums : iterable of int, unused
+            All rows of the shared buffer are written.
+        """
+        self.comm.Barrier()
+        if self.writer:
+            self.write_no_mpi()
+        else:
+            self.write_count += 1
+        self.comm.Barrier()
+
+    def trim(self) -> None:
+        """Collective trim_monitor of the shared buffers and datasets."""
+        self.comm.Barrier()
+        if self.writer:
+            trim_monitor(self)
+        self.comm.Barrier()
+
+    def close(self):
+        """Close the HDF5 file on process 0."""
+        self.comm.Barrier()
+        if self.writer:
+            super().close()
+
+
+def _worker(target, config: dict, comm: SharedMemoryComm) -> None:
+    try:
+        target(config, comm=comm)
+    finally:
+        comm.close()
+
+
+def run_shared_memory(target, config: dict, n_processes: int) -> None:
+    """Run target(config, comm=comm) in n_processes processes.
+
+    If a process fails, the barrier is broken so that the others stop.
+
+    Args:
+        target: Tracking function, e.g. track_mb.run_mbtrack2.
+        config: Configuration dictionary passed to target.
+        n_processes: Number of processes.
+
+    Raises:
+        RuntimeError: If a process exits with an error.
+    """
+    context = multiprocessing.get_context("fork")
+    barrier = context.Barrier(n_processes)
+    prefix = "ti_" + uuid.uuid4().hex[:12]
+    processes = [
+        context.Process(target=_worker,
+                        args=(target, config,
+                              SharedMemoryComm(rank, n_processes, barrier,
+                                               prefix)))
+        for rank in range(n_processes)
+    ]
+    for process in processes:
+        process.start()
+    running = {process.sentinel: process for process in processes}
+    failed = []
+    while running:
+        for sentinel in wait(list(running)):
+            process = running.pop(sentinel)
+            process.join()
+            if process.exitcode != 0:
+                failed.append(process.exitcode)
+                barrier.abort()
+    if failed:
+        raise RuntimeError(
+            f"{len(failed)} of {n_processes} tracking processes failed.")
@@ -0,0 +1,184 @@
+"""
+Early termination of tracking once an instability has been characterised.
+
+The StopPolicy is polled by the tracking loops every ``check_every`` turns
+with the current centroid amplitude (in units of the initial rms beam size)
+and the fraction of the beam still alive. Tracking stops when any of the
+enabled criteria is met:
+
+    - amplitude: the centroid exceeds ``amplitude_ceiling`` sigmas,
+    - beam_loss: the alive fraction drops below ``min_alive_fraction``
+      (a non-finite centroid is treated as a full loss),
+    - growth: an exponential fit of the amplitude over the last
+      ``growth_window`` samples has R^2 above ``growth_r2`` and spans at
+      least ``growth_efolds`` e-folds.
+
+After stopping, trim_monitor shrinks the monitor datasets to the turns
+actually tracked and record_stop stores the reason in the output file.
+
+Usage:
+    from stopping import StopPolicy, record_stop, trim_monitor
+
+    stop_policy = StopPolicy.from_config(config)
+    ...
+    if stop_policy.check(turn, amplitude, alive_fraction):
+        break
+"""
+
+from collections import deque
+
+import numpy as np
+
+from checkpoint import flush_monitor
+
+
+class StopPolicy:
+    """Decide when tracking can be stopped early.
+
+    All criteria are disabled by default, in which case check() never
+    requests a stop.
+
+    Args:
+        amplitude_ceiling: Centroid amplitude in initial rms sizes above
+            which tracking stops.
+        min_alive_fraction: Alive beam fraction below which tracking stops.
+        growth_r2: Minimum R^2 of the exponential growth fit.
+        growth_efolds: Minimum number of e-folds covered by the fit.
+        growth_window: Number of samples used for the growth fit.
+        check_every: Number of turns between two checks.
+    """
+
+    def __init__(self,
+                 amplitude_ceiling: float | None = None,
+                 min_alive_fraction: float | None = None,
+                 growth_r2: float | None = None,
+                 growth_efolds: float = 3.0,
+                 growth_window: int = 50,
+                 check_every: int = 100):
+        self.amplitude_ceiling = amplitude_ceiling
+        self.min_alive_fraction = min_alive_fraction
+        self.growth_r2 = growth_r2
+        self.growth_efolds = growth_efolds
+        self.check_every = int(check_every)
+        self.turns = deque(maxlen=int(growth_window))
+        self.log_amplitudes = deque(maxlen=int(growth_window))
+        self.reason = None
+        self.stop_turn = None
+        self.growth_rate = None
+
+    @classmethod
+    def from_config(cls, config: dict) -> "StopPolicy":
+        """Build a StopPolicy from the stop_* keys of a configuration."""
+        return cls(
+            amplitude_ceiling=config.get('stop_amplitude', None),
+            min_alive_fraction=config.get('stop_min_alive', None),
+            growth_r2=config.get('stop_growth_r2', None),
+            growth_efolds=config.get('stop_growth_efolds', 3.0),
+            growth_window=config.get('stop_growth_window', 50),
+            check_every=config.get('stop_check_every', 100),
+        )
+
+    @property
+    def enabled(self) -> bool:
+        """True if at least one stop criterion is active."""
+        return (self.amplitude_ceiling is not None
+                or self.min_alive_fraction is not None
+                or self.growth_r2 is not None)
+
+    def due(self, turn: int) -> bool:
+        """True if the policy should be evaluated at this turn."""
+        return self.enabled and turn % self.check_every == 0
+
+    def check(self, turn: int, amplitude: float,
+              alive_fraction: float = 1.0) -> bool:
+        """Evaluate the stop criteria.
+
+        Args:
+            turn: Current turn number.
+            amplitude: Centroid amplitude in units of the initial rms size.
+            alive_fraction: Fraction of the beam still alive.
+
+        Returns:
+            True if tracking should stop. The reason is stored in ``reason``.
+        """
+        if not np.isfinite(amplitude):
+            alive_fraction = 0.0
+        if (self.min_alive_fraction is not None
+                and alive_fraction < self.min_alive_fraction):
+            return self._stop(turn, "beam_loss")
+        if (self.amplitude_ceiling is not None
+                and amplitude > self.amplitude_ceiling):
+            return self._stop(turn, "amplitude")
+        if self.growth_r2 is not None and amplitude > 0:
+            self.turns.append(turn)
+            self.log_amplitudes.append(np.log(amplitude))
+            if self._growth_detected():
+                return self._stop(turn, "growth")
+        return False
+
+    def _growth_detected(self) -> bool:
+        if len(self.turns) < self.turns.maxlen:
+            return False
+        t = np.array(self.turns, dtype=float)
+        y = np.array(self.log_amplitudes)
+        slope, intercept = np.polyfit(t, y, 1)
+        residuals = y - (slope*t + intercept)
+        ss_tot = np.sum((y - y.mean())**2)
+        if ss_tot == 0:
+            return False
+        r2 = 1 - np.sum(residuals**2) / ss_tot
+        if r2 >= self.growth_r2 and slope * (t[-1] - t[0]) >= self.growth_efolds:
+            self.growth_rate = slope
+            return True
+        return False
+
+    def _stop(self, turn: int, reason: str) -> bool:
+        self.reason = reason
+        self.stop_turn = turn
+        return True
+
+
+def trim_monitor(monitor, bunch_numbers: list | None = None) -> None:
+    """Shrink the datasets of a monitor to the samples actually saved.
+
+    The partially filled buffer is flushed first. HDF5 datasets created by
+    mbtrack2 monitors have a fixed size, so they are recreated.
+
+    Args:
+        monitor: An mbtrack2 Monitor.
+        bunch_numbers: For a BeamMonitor in MPI mode, the bunches owned by
+            this rank. Each rank then only writes back its own rows.
+    """
+    flush_monitor(monitor, bunch_numbers)
+    n = monitor.write_count * monitor.buffer_size + monitor.buffer_count
+    group = monitor.file[monitor.group_name]
+    for key in ["time"] + list(monitor.dict_buffer):
+        old = group[key]
+        if bunch_numbers is None or key == "time":
+            rows = {Ellipsis: old[..., :n]}
+        else:
+            rows = {(Ellipsis, b, slice(None)): old[..., b, :n]
+                    for b in bunch_numbers}
+        shape, dtype = old.shape[:-1] + (n, ), old.dtype
+        # Keep the chunking and filters of compressed monitors.
+        filters = {}
+        if old.chunks is not None and n > 0:
+            filters = {
+                "chunks": tuple(min(c, s) for c, s in zip(old.chunks, shape)),
+                "compression": old.compression,
+                "compression_opts": old.compression_opts,
+                "shuffle": old.shuffle,
+            }
+        del group[key]
+        new = group.create_dataset(key, shape, dtype=dtype, **filters)
+        for index, data in rows.items():
+            new[index] = data
+    monitor.file.flush()
+
+
+def record_stop(file, stop_policy: StopPolicy) -> None:
+    """Store why and when tracking stopped as attributes of an HDF5 file."""
+    file.attrs["stop_reason"] = stop_policy.reason
+    file.attrs["stop_turn"] = stop_policy.stop_turn
+    if stop_policy.growth_rate is not None:
+        file.attrs["growth_rate"] = stop_policy.growth_rate
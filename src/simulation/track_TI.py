@@ -3,20 +3,36 @@ import os, sys
 os.environ["PYTHONPATH"] += os.pathsep + "/home/dockeruser/facilities_mbtrack2/"
 sys.path.append('/home/dockeruser/facilities_mbtrack2')
 from facilities_mbtrack2.SOLEIL_II import v3633
-from mbtrack2.tracking import (Bunch, LongitudinalMap, 
-                               SynchrotronRadiation, TransverseMap,
-                               )
-from mbtrack2.tracking.monitors import BunchMonitor, WakePotentialMonitor
+from mbtrack2.tracking import Bunch, LongitudinalMap, TransverseMap
+from mbtrack2.tracking.monitors import BunchMonitor
 from mbtrack2.tracking.spacecharge import TransverseSpaceCharge
-from mbtrack2.tracking.ibs import IntrabeamScattering
 from tqdm import tqdm
 import argparse
+import warnings
 
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from config import load_toml_config
 from setup_tracking import setup_fbt, setup_wakes, setup_rf
+from checkpoint import (CheckpointSignalHandler, default_checkpoint_file,
+                        element_state, load_checkpoint,
+                        restore_element_state, save_checkpoint, skip_monitor)
+from stopping import StopPolicy, record_stop, trim_monitor
+from profiling import TrackingProfiler
+from wake_cache import DEFAULT_CACHE_DIR
+from equilibrium_cache import DEFAULT_CACHE_DIR as EQUILIBRIUM_CACHE_DIR
+from equilibrium_cache import (bunch_state, lookup, restore_bunch_state,
+                               store, warmup_params)
+from ensemble import EnsembleBunch, EnsembleTransverseMap
+from one_turn_map import OneTurnMap
+from random_streams import RandomStreams, bunch_stream, record_streams
+from decimating_monitor import DecimatingBunchMonitor
+from flight_recorder import FlightRecorder, latest_bunch_mean
+from scheduling import (ElementScheduler, ScaledIntrabeamScattering,
+                        ScaledSynchrotronRadiation)
 
 def run_mbtrack2(config: dict) -> None:
+    if 'ensemble' in config:
+        return run_ensemble(config)
     folder = config['folder']
     n_turns = config.get('n_turns', 100_000)
     n_macroparticles = config.get('n_macroparticles', 100_000)
@@ -28,10 +44,47 @@ def run_mbtrack2(config: dict) -> None:
     include_Zlong = config.get('include_Zlong', False)
     harmonic_cavity = config.get('harmonic_cavity', False)
     feedback_tau = config.get('feedback_tau', 0.01)
+    # "exp", "fir" (one FIRDamper per plane) or "fir2" (two-plane FIR
+    # damper), see setup_fbt.
+    feedback_kind = config.get('feedback_kind', 'exp')
     sc = config.get('sc', False)
     ibs = config.get('ibs', False)
     quad = config.get('quad', False)
     wake_types = config.get('wake_types', ['Wydip'])
+    checkpoint_every = config.get('checkpoint_every', 10_000)
+    resume = config.get('resume', False)
+    profile = config.get('profile', False)
+    wake_cache_dir = config.get('wake_cache_dir', DEFAULT_CACHE_DIR)
+    # "convolution": mbtrack2 WakePotential, "fft": adaptive bins and cached
+    # wake spectra, "composite": composite wake tables.
+    wake_engine = config.get('wake_engine', 'convolution')
+    equilibrium_cache_dir = config.get('equilibrium_cache_dir',
+                                       EQUILIBRIUM_CACHE_DIR)
+    fused_map = config.get('fused_map', False)
+    seed = config.get('seed', 42)
+    # Independent random streams per bunch and element, derived from seed.
+    random_streams = config.get('random_streams', False)
+    warmup_turns = config.get('warmup_turns', 25_000)
+    # Wakes are switched on after turn warmup_turns.
+    wake_start = warmup_turns + 1
+    # Transverse feedback during the warm-up. If False, the warmed-up bunch
+    # does not depend on the feedback.
+    warmup_feedback = config.get('warmup_feedback', True)
+    # Cache of the warmed-up bunch, off unless a directory is given.
+    warmup_cache_dir = config.get('warmup_cache_dir', None)
+    monitor_decimation = config.get('monitor_decimation', 1)
+    monitor_windows = config.get('monitor_windows',
+                                 [[warmup_turns, warmup_turns + 10_000],
+                                  [n_turns - 10_000, n_turns]])
+    monitor_compression = config.get('monitor_compression', 'gzip')
+    wake_pre_trigger = config.get('wake_pre_trigger', 600)
+    wake_post_trigger = config.get('wake_post_trigger', 1800)
+    wake_trigger = config.get('wake_trigger', 0.1)
+    # Radiation is part of the fused map, tracked every turn.
+    if fused_map and (config.get('sr_every', 1) != 1
+                      or config.get('sr_start', 0) != 0):
+        raise ValueError("sr_every and sr_start are not supported with "
+                         "fused_map.")
 
     Vc = 1.7e6
     ring = v3633(IDs=id_state, HC_power=50e3, V_RF=Vc, load_lattice=True)
@@ -42,8 +95,10 @@ def run_mbtrack2(config: dict) -> None:
                     mp_number=n_macroparticles,
                     current=bunch_current,
                     track_alive=False)
-    np.random.seed(42)
-    mybunch.init_gaussian()
+    np.random.seed(seed)
+    streams = RandomStreams(seed) if random_streams else None
+    with bunch_stream(streams, "init", mybunch):
+        mybunch.init_gaussian()
     stdx, stdy = np.std(mybunch['x']), np.std(mybunch['y'])
     monitor_filename = folder + f"monitors(n_mp={n_macroparticles:.1e}," + \
         f"n_turns={n_turns:.1e}," +\
@@ -59,39 +114,77 @@ def run_mbtrack2(config: dict) -> None:
         f"ibs={ibs:}"+\
         f"wake_types={wake_types:}"\
         ")"
-    bunch_monitor = BunchMonitor(
-        0,
-        save_every=1,
-        buffer_size=1000,
-        total_size=n_turns,
-        file_name=monitor_filename,
-        mpi_mode=False,
-    )
+    checkpoint_file = config.get('checkpoint_file',
+                                 default_checkpoint_file(monitor_filename))
+    if monitor_decimation > 1:
+        bunch_monitor = DecimatingBunchMonitor(
+            0,
+            n_turns,
+            windows=monitor_windows,
+            decimation=monitor_decimation,
+            buffer_size=1000,
+            file_name=monitor_filename,
+            mpi_mode=False,
+            compression=monitor_compression or None,
+        )
+    else:
+        bunch_monitor = BunchMonitor(
+            0,
+            save_every=1,
+            buffer_size=1000,
+            total_size=n_turns,
+            file_name=monitor_filename,
+            mpi_mode=False,
+        )
     long_map = LongitudinalMap(ring)
-    main_rf, harmonic_rf = setup_rf(ring, harmonic_cavity, Vc)
-    sr = SynchrotronRadiation(ring, switch=[1, 1, 1])
+    main_rf, harmonic_rf = setup_rf(ring, harmonic_cavity, Vc,
+                                    equilibrium_cache_dir)
+    sr = ScaledSynchrotronRadiation(ring, switch=[1, 1, 1])
     trans_map = TransverseMap(ring)
     
     wakefield_tr, wakefield_long, _ = setup_wakes(ring, id_state,
                                                   include_Zlong, n_bin,
-                                                  wake_types)
-    wakepotential_monitor = WakePotentialMonitor(
+                                                  wake_types,
+                                                  wake_cache_dir,
+                                                  wake_engine)
+    if wake_engine == 'composite':
+        # Components on different time bases are resampled onto a common
+        # grid, which alone can give deviations of ~1e-2 from the separate
+        # wake functions: warn and record the deviation instead of aborting.
+        deviation = wakefield_tr.check(mybunch, rtol=np.inf)
+        bunch_monitor.file.attrs['composite_wake_deviation'] = deviation
+        print(f"Composite wake tables on, deviation {deviation:.1e}.")
+        if deviation > 1e-3:
+            warnings.warn(f"Composite wake tables deviate from the separate "
+                          f"wake functions by {deviation:.1e} (relative).")
+    wakepotential_monitor = FlightRecorder(
         bunch_number=0,
         wake_types=wake_types,
         n_bin=n_bin,
-        save_every=1,
-        buffer_size=600,
-        total_size=2400,
+        pre_trigger=wake_pre_trigger,
+        post_trigger=wake_post_trigger,
         file_name=None,
         mpi_mode=False,
     )
-    tracking_elements = [trans_map, long_map, bunch_monitor]
-    if include_Zlong:
+    rf_cavities = [main_rf, harmonic_rf] if harmonic_cavity else [main_rf]
+    if fused_map:
+        one_turn_map = OneTurnMap(ring, rf_cavities, radiation=include_Zlong)
+        reference_elements = [trans_map, long_map]
+        if include_Zlong:
+            reference_elements.append(sr)
+        deviation = one_turn_map.check(mybunch,
+                                       reference_elements + rf_cavities)
+        print(f"Fused one-turn map on, deviation {deviation:.1e}.")
+        tracking_elements = [one_turn_map, bunch_monitor]
+    else:
+        tracking_elements = [trans_map, long_map, bunch_monitor]
+    if include_Zlong and not fused_map:
         tracking_elements.append(sr)
     besc = TransverseSpaceCharge(ring=ring,
                                 interaction_length=ring.L,
                                 n_bins=100)
-    ibs_cimp = IntrabeamScattering(ring, model="CIMP", n_points=100, n_bin=100)
+    ibs_cimp = ScaledIntrabeamScattering(ring, model="CIMP", n_points=100,
+                                         n_bin=100)
     if ibs:
         print('IBS included')
         tracking_elements.append(ibs_cimp)
@@ -100,39 +193,311 @@ def run_mbtrack2(config: dict) -> None:
         tracking_elements.append(besc)
     if harmonic_cavity:
         print("Harmonic cavity is on.")
-        tracking_elements.append(main_rf)
-        tracking_elements.append(harmonic_rf)
     else:
         print("Harmonic cavity is off.")
-        tracking_elements.append(main_rf)
+    if not fused_map:
+        tracking_elements += rf_cavities
+    warmup_elements = list(tracking_elements)
+    stateful_elements = {}
     if feedback_tau != 0:
-        fbtx, fbty = setup_fbt(ring, feedback_tau)
-        tracking_elements.append(fbtx)
-        tracking_elements.append(fbty)
+        fbtx, fbty = setup_fbt(ring, feedback_tau, feedback_kind)
+        # The two-plane FIR damper is tracked once per turn.
+        feedback = [fbtx] if feedback_kind == 'fir2' else [fbtx, fbty]
+        tracking_elements += feedback
+        if warmup_feedback:
+            warmup_elements += feedback
+        stateful_elements.update({'fbtx': fbtx, 'fbty': fbty})
+    if streams is not None:
+        # Attached after the fused map check, which must not draw from them.
+        for el in tracking_elements:
+            if hasattr(el, 'streams'):
+                el.streams = streams
+        stateful_elements['random_streams'] = streams
+        record_streams(bunch_monitor.file, streams)
+    # IBS, space charge and radiation may be tracked every few turns only,
+    # with the <name>_every and <name>_start keys.
+    scheduler = ElementScheduler.from_config(
+        config, {'ibs': ibs_cimp, 'sc': besc, 'sr': sr},
+        phases={'warmup': wake_start})
 
-    monitor_count = 0
+    monitors = {'bunch_monitor': bunch_monitor,
+                'wakepotential_monitor': wakepotential_monitor}
+    start_turn = 0
     track_wake_monitor = False
     stdx, stdy = mybunch.std[0], mybunch.std[2]
+    if resume:
+        start_turn, loop_state = load_checkpoint(checkpoint_file, mybunch,
+                                                 monitors, stateful_elements)
+        track_wake_monitor = loop_state['track_wake_monitor']
+        wakepotential_monitor.restore_trigger(track_wake_monitor)
+        stdx, stdy = loop_state['stdx'], loop_state['stdy']
+        print(f"Resuming from checkpoint at turn {start_turn}.")
+    warmup_key = warmup_params(ring, bunch_current, n_macroparticles,
+                               include_Zlong, harmonic_cavity, seed,
+                               wake_start, [Qp_x, Qp_y],
+                               ([feedback_tau, feedback_kind]
+                                if warmup_feedback and feedback_tau != 0
+                                else None),
+                               id_state=id_state, n_bin=n_bin,
+                               sc=sc, ibs=ibs, fused_map=fused_map,
+                               **({'schedule': scheduler.settings}
+                                  if scheduler.settings else {}),
+                               **({'random_streams': True}
+                                  if streams is not None else {}))
+    if not resume and warmup_turns > 0:
+        warmup_state = lookup("warmup", warmup_key, warmup_cache_dir)
+        if warmup_state is not None:
+            restore_bunch_state(mybunch, warmup_state)
+            restore_element_state(stateful_elements, warmup_state)
+            skip_monitor(bunch_monitor, wake_start)
+            # The warm-up turns are not tracked: their rows of BunchData
+            # are left as zeros.
+            bunch_monitor.file.attrs['warmup_from_cache'] = True
+            start_turn = wake_start
+            print(f"Warm-up of {wake_start} turns read from cache.")
+    signal_handler = CheckpointSignalHandler()
+    stop_policy = StopPolicy.from_config(config)
+    profiler = TrackingProfiler(enabled=profile)
     try:
-        for i in tqdm(range(n_turns)):
-            for el in tracking_elements:
-                el.track(mybunch)
-            if i > 25_000:
-                wakefield_tr.track(mybunch)
-                if (np.mean(mybunch.mean[:][0]) > 0.1 * stdx
-                    or np.mean(mybunch.mean[:][2]) > 0.1 * stdy and monitor_count < 2500):
-                    track_wake_monitor=True
-                if ((i > (n_turns - 2500)
-                    or track_wake_monitor)
-                        and monitor_count < 2500):
+        for i in tqdm(range(start_turn, n_turns), initial=start_turn,
+                      total=n_turns):
+            elements = (tracking_elements
+                        if i >= wake_start else warmup_elements)
+            for el in scheduler.active(elements, i):
+                with profiler.section(type(el).__name__):
+                    el.track(mybunch)
+            if i >= wake_start:
+                with profiler.section('WakePotential'):
+                    wakefield_tr.track(mybunch)
+                if not track_wake_monitor:
+                    # Bunch mean saved by the bunch monitor this turn.
+                    mean = latest_bunch_mean(bunch_monitor)
+                    if (abs(mean[0]) > wake_trigger * stdx
+                            or abs(mean[2]) > wake_trigger * stdy
+                            or i >= n_turns - wake_post_trigger):
+                        wakepotential_monitor.trigger(i)
+                        track_wake_monitor = True
+                with profiler.section('WakePotentialMonitor'):
                     wakepotential_monitor.track(mybunch, wakefield_tr)
-                    monitor_count += 1
             elif include_Zlong:
-                wakefield_long.track(mybunch)
+                with profiler.section('WakePotential'):
+                    wakefield_long.track(mybunch)
+            profiler.turn_done()
+            if i + 1 == wake_start:
+                warmup_state = bunch_state(mybunch)
+                warmup_state.update(element_state(stateful_elements))
+                store("warmup", warmup_key, warmup_state, warmup_cache_dir)
+            if stop_policy.due(i):
+                mean = latest_bunch_mean(bunch_monitor)
+                amplitude = max(abs(mean[0]) / stdx, abs(mean[2]) / stdy)
+                if stop_policy.check(i, amplitude, np.mean(mybunch.alive)):
+                    print(f"Stopping at turn {i}: {stop_policy.reason}.")
+                    break
+            periodic = (checkpoint_every
+                        and (i + 1) % checkpoint_every == 0
+                        and i + 1 < n_turns)
+            if periodic or signal_handler.requested:
+                with profiler.section('checkpoint'):
+                    save_checkpoint(checkpoint_file, i + 1, mybunch, monitors,
+                                    stateful_elements,
+                                    {'track_wake_monitor': track_wake_monitor,
+                                     'stdx': stdx, 'stdy': stdy})
+            if signal_handler.requested:
+                print(f"Signal {signal_handler.signum} received, "
+                      f"checkpoint written at turn {i + 1}.")
+                break
+        if stop_policy.reason is not None:
+            # Keep the wake data preceding the stop.
+            wakepotential_monitor.trigger(i)
+            for monitor in monitors.values():
+                trim_monitor(monitor)
+            record_stop(bunch_monitor.file, stop_policy)
+        profiler.write(bunch_monitor.file, monitor_filename + ".profile.json")
     finally:
         bunch_monitor.close()
 
 
+def run_ensemble(config: dict) -> None:
+    """Track several single-bunch configurations in one process.
+
+    config['ensemble'] is a list of member configurations which may override
+    bunch_current, Qp_x, Qp_y and seed of the base configuration. Member k
+    is saved in the BunchData_k and WakePotentialData_k groups of a single
+    monitor file, with its configuration stored as group attributes.
+
+    Checkpoints, resume, stop policy, decimated monitors, random streams,
+    the fused map, quadrupolar wakes and the warm-up cache are not
+    available in ensemble mode, and enabling them raises a ValueError.
+    """
+    # Keys of the single-bunch run and the values disabling them.
+    unsupported = [key for key, disabled in [('checkpoint_every', 0),
+                                             ('resume', False),
+                                             ('monitor_decimation', 1),
+                                             ('random_streams', False),
+                                             ('fused_map', False),
+                                             ('quad', False),
+                                             ('warmup_cache_dir', None)]
+                   if config.get(key, disabled) not in (disabled, None)]
+    if StopPolicy.from_config(config).enabled:
+        unsupported.append('stop_*')
+    if unsupported:
+        raise ValueError("Not supported in ensemble mode: "
+                         + ", ".join(unsupported))
+    folder = config['folder']
+    n_turns = config.get('n_turns', 100_000)
+    n_macroparticles = config.get('n_macroparticles', 100_000)
+    n_bin = config.get('n_bin', 100)
+    id_state = config.get('id_state', "open")
+    include_Zlong = config.get('include_Zlong', False)
+    harmonic_cavity = config.get('harmonic_cavity', False)
+    feedback_tau = config.get('feedback_tau', 0.01)
+    # "exp", "fir" (one FIRDamper per plane) or "fir2" (two-plane FIR
+    # damper), see setup_fbt.
+    feedback_kind = config.get('feedback_kind', 'exp')
+    sc = config.get('sc', False)
+    ibs = config.get('ibs', False)
+    wake_types = config.get('wake_types', ['Wydip'])
+    profile = config.get('profile', False)
+    wake_cache_dir = config.get('wake_cache_dir', DEFAULT_CACHE_DIR)
+    # "convolution": mbtrack2 WakePotential, "fft": adaptive bins and cached
+    # wake spectra, "composite": composite wake tables.
+    wake_engine = config.get('wake_engine', 'convolution')
+    equilibrium_cache_dir = config.get('equilibrium_cache_dir',
+                                       EQUILIBRIUM_CACHE_DIR)
+    warmup_turns = config.get('warmup_turns', 25_000)
+    # Wakes are switched on after turn warmup_turns.
+    wake_start = warmup_turns + 1
+    # Transverse feedback during the warm-up.
+    warmup_feedback = config.get('warmup_feedback', True)
+    wake_pre_trigger = config.get('wake_pre_trigger', 600)
+    wake_post_trigger = config.get('wake_post_trigger', 1800)
+    wake_trigger = config.get('wake_trigger', 0.1)
+    base = {'bunch_current': config.get('bunch_current', 1e-3),
+            'Qp_x': config.get('Qp_x', 1.6),
+            'Qp_y': config.get('Qp_y', 1.6),
+            'seed': config.get('seed', 42)}
+    members = [{**base, **member} for member in config['ensemble']]
+
+    Vc = 1.7e6
+    ring = v3633(IDs=id_state, HC_power=50e3, V_RF=Vc, load_lattice=True)
+    ring.tune = np.array([54.23, 18.21])
+    ring.chro = np.array([base['Qp_x'], base['Qp_y']])
+    ring.emit[1] = 0.3 * ring.emit[0]
+    ensemble = EnsembleBunch(ring, members, n_macroparticles)
+    monitor_filename = folder + f"monitors_ensemble(n_mp={n_macroparticles:.1e}," + \
+        f"n_turns={n_turns:.1e}," +\
+        f"n_bin={n_bin:},"+\
+        f"n_members={len(members):},"+\
+        f"id_state={id_state:},"+\
+        f"Zlong={include_Zlong:},"+\
+        f"cavity={harmonic_cavity:},"+\
+        f"feedback_tau={feedback_tau:.1e},"+\
+        f"sc={sc:},"+\
+        f"ibs={ibs:}"+\
+        f"wake_types={wake_types:}"\
+        ")"
+
+    trans_map = EnsembleTransverseMap(ring, ensemble.member_values('Qp_x'),
+                                      ensemble.member_values('Qp_y'),
+                                      n_macroparticles)
+    long_map = LongitudinalMap(ring)
+    main_rf, harmonic_rf = setup_rf(ring, harmonic_cavity, Vc,
+                                    equilibrium_cache_dir)
+    sr = ScaledSynchrotronRadiation(ring, switch=[1, 1, 1])
+    wakefield_tr, wakefield_long, _ = setup_wakes(ring, id_state,
+                                                  include_Zlong, n_bin,
+                                                  wake_types,
+                                                  wake_cache_dir,
+                                                  wake_engine)
+
+    bunch_monitors, wakepotential_monitors = [], []
+    for k, member in enumerate(members):
+        bunch_monitor = BunchMonitor(
+            k,
+            save_every=1,
+            buffer_size=1000,
+            total_size=n_turns,
+            file_name=monitor_filename if k == 0 else None,
+            mpi_mode=False,
+        )
+        for key, value in member.items():
+            bunch_monitor.g.attrs[key] = value
+        bunch_monitors.append(bunch_monitor)
+        wakepotential_monitors.append(FlightRecorder(
+            bunch_number=k,
+            wake_types=wake_types,
+            n_bin=n_bin,
+            pre_trigger=wake_pre_trigger,
+            post_trigger=wake_post_trigger,
+            file_name=None,
+            mpi_mode=False,
+        ))
+
+    # Single-particle elements act on the stacked bunch (member None),
+    # collective elements and monitors on each member.
+    tracking_elements = [(trans_map, None), (long_map, None)]
+    tracking_elements += [(monitor, k) for k, monitor in enumerate(bunch_monitors)]
+    if include_Zlong:
+        tracking_elements.append((sr, None))
+    for k in range(len(members)):
+        if ibs:
+            tracking_elements.append((ScaledIntrabeamScattering(
+                ring, model="CIMP", n_points=100, n_bin=100), k))
+        if sc:
+            tracking_elements.append((TransverseSpaceCharge(
+                ring=ring, interaction_length=ring.L, n_bins=100), k))
+    tracking_elements.append((main_rf, None))
+    if harmonic_cavity:
+        tracking_elements.append((harmonic_rf, None))
+    warmup_elements = list(tracking_elements)
+    if feedback_tau != 0:
+        for k in range(len(members)):
+            fbtx, fbty = setup_fbt(ring, feedback_tau, feedback_kind)
+            feedback = [(fbtx, k)] if fbty is fbtx else [(fbtx, k), (fbty, k)]
+            tracking_elements += feedback
+            if warmup_feedback:
+                warmup_elements += feedback
+    scheduler = ElementScheduler.from_config(
+        config,
+        {name: [el for el, _ in tracking_elements if isinstance(el, kind)]
+         for name, kind in [('ibs', ScaledIntrabeamScattering),
+                            ('sc', TransverseSpaceCharge),
+                            ('sr', ScaledSynchrotronRadiation)]},
+        phases={'warmup': wake_start})
+
+    profiler = TrackingProfiler(enabled=profile)
+    std0 = [(bunch.std[0], bunch.std[2]) for bunch in ensemble]
+    try:
+        for i in tqdm(range(n_turns)):
+            elements = (tracking_elements
+                        if i >= wake_start else warmup_elements)
+            ensemble.track([(el, k) for el, k in elements
+                            if scheduler.due(el, i)], profiler)
+            if i >= wake_start or include_Zlong:
+                for k, bunch in enumerate(ensemble):
+                    stdx, stdy = std0[k]
+                    if i < wake_start:
+                        with profiler.section('WakePotential'):
+                            wakefield_long.track(bunch)
+                        continue
+                    with profiler.section('WakePotential'):
+                        wakefield_tr.track(bunch)
+                    recorder = wakepotential_monitors[k]
+                    if not recorder.triggered:
+                        mean = latest_bunch_mean(bunch_monitors[k])
+                        if (abs(mean[0]) > wake_trigger * stdx
+                                or abs(mean[2]) > wake_trigger * stdy
+                                or i >= n_turns - wake_post_trigger):
+                            recorder.trigger(i)
+                    with profiler.section('WakePotentialMonitor'):
+                        recorder.track(bunch, wakefield_tr)
+                ensemble.to_stacked()
+            profiler.turn_done()
+        profiler.write(bunch_monitors[0].file, monitor_filename + ".profile.json")
+    finally:
+        bunch_monitors[0].close()
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
     description="""Track beam-ion instability in a light source storage ring.
@@ -153,6 +518,8 @@ if __name__ == "__main__":
     parser.add_argument('-c', '--config', metavar='CONFIG_FILE', type=str,
                         default=None,
                         help='Path to TOML configuration file. CLI args override config values.')
+    parser.add_argument('--resume', action='store_true',
+                        help='Resume tracking from the checkpoint file and append to the existing monitor file.')
     args = parser.parse_args()
 
 
@@ -168,5 +535,7 @@ if __name__ == "__main__":
            config = full_config
     else:
         config = {}
+    if args.resume:
+        config['resume'] = True
 
     run_mbtrack2(config)
@@ -2,20 +2,41 @@ import os, sys
 import numpy as np
 os.environ["PYTHONPATH"] += os.pathsep + "/home/dockeruser/facilities_mbtrack2/"
 sys.path.append('/home/dockeruser/facilities_mbtrack2')
-from mbtrack2.tracking import (Beam, LongitudinalMap,
-                               LongRangeResistiveWall,
-                               SynchrotronRadiation, TransverseMap)
-from mbtrack2.tracking.monitors import BeamMonitor, WakePotentialMonitor
+from mbtrack2.tracking import Beam, LongitudinalMap, TransverseMap
+from mbtrack2.tracking.monitors import BeamMonitor
 import argparse
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from config import load_toml_config, merge_config_and_args
-from setup_tracking import setup_fbt, setup_wakes, setup_dual_rf
+from setup_tracking import (setup_fbt, setup_wakes, setup_dual_rf,
+                            setup_long_range_wakes)
+from stopping import StopPolicy, record_stop, trim_monitor
+from profiling import TrackingProfiler
+from shared_backend import SharedBeamMonitor, run_shared_memory
+from rank_monitor import RankLocalBeamMonitor, merge_rank_files
+from cb_mode_monitor import CoupledBunchModeMonitor
+from flight_recorder import FlightRecorder
+from bunch_threads import BunchThreadPool
+from random_streams import RandomStreams, record_streams
+from scheduling import (ElementScheduler, ScaledIntrabeamScattering,
+                        ScaledSynchrotronRadiation)
+from collectives import MEANS, CollectiveScheduler, required_collectives
+from filling import (init_balanced_beam, load_filling_pattern,
+                     macroparticles_per_bunch)
+from wake_cache import DEFAULT_CACHE_DIR
+from equilibrium_cache import DEFAULT_CACHE_DIR as EQUILIBRIUM_CACHE_DIR
+from equilibrium_cache import cache_key
 from mbtrack2.tracking.spacecharge import TransverseSpaceCharge
-from mbtrack2.tracking.ibs import IntrabeamScattering
 from facilities_mbtrack2 import v3633
 
 
-def run_mbtrack2(config: dict) -> None:
+def run_mbtrack2(config: dict, comm=None) -> None:
+    """Track the multi-bunch beam.
+
+    Args:
+        config: Configuration dictionary.
+        comm: SharedMemoryComm when run by the shared-memory backend, None
+            with MPI.
+    """
 
     folder = config['folder']
     n_turns = config.get('n_turns', 100_000)
@@ -29,25 +50,64 @@ def run_mbtrack2(config: dict) -> None:
     harmonic_cavity = config.get('harmonic_cavity', False)
     n_turns_wake = config.get('n_turns_wake', 1)
     feedback_tau = config.get('feedback-tau', 1.e-2)
+    # "exp", "fir" (one FIRDamper per plane) or "fir2" (two-plane FIR
+    # damper), see setup_fbt.
+    feedback_kind = config.get('feedback_kind', 'exp')
     sc = config.get('sc', False)
     ibs = config.get('ibs', False)
     quad = config.get('quad', False)
+    profile = config.get('profile', False)
+    # "parallel": one file written with parallel HDF5, "rank_local": one file
+    # per rank, merged after the run (MPI backend only).
+    monitor_mode = config.get('monitor_mode', 'parallel')
+    # Coupled-bunch mode spectrum saved every cb_modes_every turns; the bunch
+    # data can then be decimated with beam_monitor_every.
+    cb_modes = config.get('cb_modes', False)
+    cb_modes_every = config.get('cb_modes_every', 10)
+    monitor_every = config.get('beam_monitor_every', 10)
+    n_threads = config.get('n_threads', 1)
+    # "tables": centroid tables of LongRangeResistiveWall, "recursive": pole
+    # expansion with a cost independent of n_turns_wake.
+    long_range_wake = config.get('long_range_wake', 'tables')
+    # "convolution": mbtrack2 WakePotential, "fft": adaptive bins and cached
+    # wake spectra, "composite": composite wake tables.
+    wake_engine = config.get('wake_engine', 'convolution')
+    warmup_turns = config.get('warmup_turns', 25_000)
+    # Wakes are switched on after turn warmup_turns.
+    wake_start = warmup_turns + 1
+    # Transverse feedback during the warm-up.
+    warmup_feedback = config.get('warmup_feedback', True)
+    wake_pre_trigger = config.get('wake_pre_trigger', 600)
+    wake_post_trigger = config.get('wake_post_trigger', 1800)
+    wake_trigger = config.get('wake_trigger', 0.1)
+    filling_pattern = config.get('filling_pattern', None)
+    mp_scaling = config.get('mp_scaling', 'uniform')
+    wake_cache_dir = config.get('wake_cache_dir', DEFAULT_CACHE_DIR)
+    equilibrium_cache_dir = config.get('equilibrium_cache_dir',
+                                       EQUILIBRIUM_CACHE_DIR)
+    seed = config.get('seed', 42)
+    # Independent random streams per bunch and element, derived from seed:
+    # the beam then does not depend on the number of ranks.
+    random_streams = config.get('random_streams', False)
 
     Vc = 1.7e6
     ring = v3633(IDs=id_state, V_RF=Vc, load_lattice=True)
     ring.tune = np.array([54.23, 18.21])
     ring.chro = [Qp_x, Qp_y]
     ring.emit[1] = 0.3 * ring.emit[0]
-    np.random.seed(42)
+    np.random.seed(seed)
+    streams = RandomStreams(seed) if random_streams else None
     beam = Beam(ring)
     is_mpi = True
-    filling_pattern = np.ones(ring.h) * bunch_current
-    beam.init_beam(
-        filling_pattern,
-        mp_per_bunch=n_macroparticles,
-        track_alive=False,
-        mpi=is_mpi,
-    )
+    filling_pattern = load_filling_pattern(filling_pattern, ring.h,
+                                           bunch_current)
+    mp_per_bunch = macroparticles_per_bunch(filling_pattern, n_macroparticles,
+                                            mp_scaling)
+    init_balanced_beam(beam, filling_pattern, mp_per_bunch, track_alive=False,
+                       comm=comm, streams=streams)
+    # Only rank 0 opens the monitor file with the shared-memory backend.
+    writes_file = comm is None or comm.Get_rank() == 0
+    rank_local = comm is None and monitor_mode == 'rank_local'
     monitor_filename = (
         folder +
         f"monitors(n_mp={n_macroparticles:.1e}"+
@@ -65,73 +125,91 @@ def run_mbtrack2(config: dict) -> None:
         f",ibs={ibs:}"+
         f"quad={quad:}"+
         ")")
-    beam_monitor = BeamMonitor(
-        ring.h,
-        save_every=10,
-        buffer_size=1000,
-        file_name=monitor_filename,
-        total_size=n_turns//10,
-        mpi_mode=is_mpi,
-    )
-    wakepotential_monitor = WakePotentialMonitor(
-        bunch_number=0,
-        wake_types="Wydip",
-        n_bin=n_bin,
-        save_every=1,
-        buffer_size=600,
-        total_size=2400,
-        file_name=None,
-        mpi_mode=is_mpi,
-    )
-    long_map = LongitudinalMap(ring)
-    sr = SynchrotronRadiation(ring, switch=[1, 1, 1])
-    trans_map = TransverseMap(ring)
-    wakefield_tr, wakefield_long, wakemodel = setup_wakes(ring, id_state, include_Zlong, n_bin)
-
-    if id_state == "open":
-        x3 = 6.51e-3
-        y3 = 6.70e-3
-    else:
-        x3 = 5.78e-3
-        y3 = 5.61e-3
-    long_wakefield = LongRangeResistiveWall(
-        ring=ring,
-        beam=beam,
-        length=ring.L,
-        rho=2.135e-8,
-        radius=8e-3,
-        types=["Wxdip", "Wydip"],
-        nt=n_turns_wake,
-        x3=x3,
-        y3=y3,
-    )
-    
-    if id_state == "open":
-        x3 = -15.01e-3
-        y3 = 15.63e-3
+    if config.get('filling_pattern') is not None:
+        # Distinguish runs with different non-uniform fills.
+        monitor_filename = (monitor_filename[:-1] + ",filling=" +
+                            cache_key("filling", {"pattern": filling_pattern})[-8:] +
+                            ")")
+    monitor_size = n_turns // monitor_every
+    monitor_buffer = min(1000, monitor_size)
+    if rank_local:
+        beam_monitor = RankLocalBeamMonitor(
+            ring.h,
+            beam.mpi.bunch_numbers,
+            beam.mpi.rank,
+            save_every=monitor_every,
+            buffer_size=monitor_buffer,
+            file_name=monitor_filename,
+            total_size=monitor_size,
+        )
+    elif comm is None:
+        beam_monitor = BeamMonitor(
+            ring.h,
+            save_every=monitor_every,
+            buffer_size=monitor_buffer,
+            file_name=monitor_filename,
+            total_size=monitor_size,
+            mpi_mode=is_mpi,
+        )
     else:
-        x3 = -7.90e-3
-        y3 = 8.87e-3
-    long_wakefield_quad = LongRangeResistiveWall(
-        ring=ring,
-        beam=beam,
-        length=ring.L,
-        rho=2.135e-8,
-        radius=8e-3,
-        types=["Wxdip", "Wydip"],
-        nt=n_turns_wake,
-        x3=x3,
-        y3=y3,
+        beam_monitor = SharedBeamMonitor(
+            ring.h,
+            comm,
+            save_every=monitor_every,
+            buffer_size=monitor_buffer,
+            file_name=monitor_filename,
+            total_size=monitor_size,
+        )
+    wakepotential_monitor = None
+    # With rank-local files, bunch 0 is recorded in the file of its rank.
+    if writes_file and (not rank_local
+                        or 0 in beam.mpi.bunch_numbers_set):
+        wakepotential_monitor = FlightRecorder(
+            bunch_number=0,
+            wake_types="Wydip",
+            n_bin=n_bin,
+            pre_trigger=wake_pre_trigger,
+            post_trigger=wake_post_trigger,
+            file_name=None,
+            mpi_mode=comm is None and not rank_local,
         )
+    cb_monitor = None
+    if cb_modes and writes_file:
+        cb_size = n_turns // cb_modes_every
+        cb_monitor = CoupledBunchModeMonitor(
+            ring,
+            save_every=cb_modes_every,
+            buffer_size=min(1000, cb_size),
+            total_size=cb_size,
+            file_name=None,
+            mpi_mode=comm is None and not rank_local,
+            write_data=beam.mpi.rank == 0,
+        )
+    long_map = LongitudinalMap(ring)
+    sr = ScaledSynchrotronRadiation(ring, switch=[1, 1, 1])
+    trans_map = TransverseMap(ring)
+    wakefield_tr, wakefield_long, wakemodel = setup_wakes(ring, id_state, include_Zlong, n_bin,
+                                                          cache_dir=wake_cache_dir,
+                                                          engine=wake_engine)
+    if wake_engine == 'fft':
+        # Wake potentials per type are only needed for the recorded bunch.
+        wakefield_tr.state_bunches = ([0] if wakepotential_monitor is not None
+                                      else [])
+        wakefield_long.state_bunches = []
 
+    long_wakefield = setup_long_range_wakes(ring, beam, id_state, n_turns_wake,
+                                            long_range_wake, quad == 'True')
 
-    rf, hrf = setup_dual_rf(ring, beam, harmonic_cavity, bunch_current,  wakemodel)
-    fbtx, fbty = setup_fbt(ring, feedback_tau)
+    rf, hrf = setup_dual_rf(ring, beam, harmonic_cavity, bunch_current,  wakemodel,
+                            equilibrium_cache_dir, seed, mp_per_bunch,
+                            random_streams, n_bin)
+    fbtx, fbty = setup_fbt(ring, feedback_tau, feedback_kind)
     tracking_elements = [trans_map, long_map, sr, beam_monitor, rf]
     besc = TransverseSpaceCharge(ring=ring,
                                 interaction_length=ring.L,
                                 n_bins=n_bin)
-    ibs_cimp = IntrabeamScattering(ring, model="CIMP", n_points=100, n_bin=100)
+    ibs_cimp = ScaledIntrabeamScattering(ring, model="CIMP", n_points=100,
+                                         n_bin=100)
     if ibs == 'True':
         print('IBS included')
         tracking_elements.append(ibs_cimp)
@@ -141,13 +219,36 @@ def run_mbtrack2(config: dict) -> None:
         tracking_elements.append(besc)
     if harmonic_cavity == 'True':
         tracking_elements.append(hrf)
+    warmup_elements = list(tracking_elements)
     if feedback_tau != 0:
-        tracking_elements.append(fbtx)
-        tracking_elements.append(fbty)
+        # The two-plane FIR damper is tracked once per turn.
+        feedback = [fbtx] if feedback_kind == 'fir2' else [fbtx, fbty]
+        tracking_elements += feedback
+        if warmup_feedback:
+            warmup_elements += feedback
+    if streams is not None:
+        for el in tracking_elements:
+            if hasattr(el, 'streams'):
+                el.streams = streams
+        if writes_file:
+            record_streams(beam_monitor.file, streams)
+    # IBS, space charge and radiation may be tracked every few turns only,
+    # with the <name>_every and <name>_start keys.
+    scheduler = ElementScheduler.from_config(
+        config, {'ibs': ibs_cimp, 'sc': besc, 'sr': sr},
+        phases={'warmup': wake_start})
 
     stdx, stdy = np.mean(beam.bunch_std[:][0]), np.mean(beam.bunch_std[:][2])
-    track_wake_monitor = False
-    monitor_count = 0
+    stop_policy = StopPolicy.from_config(config)
+    profiler = TrackingProfiler(enabled=profile,
+                                comm=beam.mpi.comm if is_mpi else None)
+    # Collective data needed by the elements before and after the warm-up.
+    # Bunch means are shared by LongRangeResistiveWall once the wakes are on.
+    collectives = CollectiveScheduler(beam, n_bin, profiler)
+    needs = {False: required_collectives(warmup_elements),
+             True: required_collectives(tracking_elements)}
+    # Bunches owned by this rank are tracked by n_threads threads.
+    pool = BunchThreadPool(beam, n_threads)
     try:
         for i in range(n_turns):
             if i % 1000 == 0:
@@ -155,29 +256,82 @@ def run_mbtrack2(config: dict) -> None:
                     print(f"mpi Turn {i:}")
                 elif not is_mpi:
                     print(f"Turn {i:}")
+            wakes_on = i >= wake_start
+            elements = tracking_elements if wakes_on else warmup_elements
+            # The mode monitor reads the bunch means, which are shared by
+            # LongRangeResistiveWall once the wakes are on.
+            samples_modes = cb_modes and i % cb_modes_every == 0
+            if is_mpi:
+                turn_needs = set(needs[wakes_on])
+                if (stop_policy.due(i) or samples_modes) and not wakes_on:
+                    turn_needs.add(MEANS)
+                collectives.start(turn_needs)
+            for el in scheduler.active(elements, i):
+                if is_mpi and collectives.consumes(el):
+                    collectives.wait()
+                with profiler.section(type(el).__name__):
+                    pool.track(el, beam)
             if is_mpi:
-                beam.mpi.share_distributions(beam, n_bin=n_bin)
-                beam.mpi.share_means(beam)
-                beam.mpi.share_stds(beam)
-            for el in tracking_elements:
-                el.track(beam)
-
-            if i > 25_000:
-                wakefield_tr.track(beam)
-                long_wakefield.track(beam)
-                if quad == 'True':
-                    long_wakefield_quad.track(beam)
+                collectives.wait()
+
+            if wakes_on:
+                with profiler.section('WakePotential'):
+                    pool.track(wakefield_tr, beam)
+                with profiler.section('LongRangeResistiveWall'):
+                    long_wakefield.track(beam)
+                if (wakepotential_monitor is not None
+                        and not wakepotential_monitor.triggered):
+                    # Bunch means shared by LongRangeResistiveWall in this
+                    # turn, identical on all ranks.
+                    means = np.array(list(beam.mpi.mean_all.values()))
+                    if (np.abs(np.mean(means[:, 0])) > wake_trigger * stdx
+                            or np.abs(np.mean(means[:, 2])) > wake_trigger * stdy
+                            or i >= n_turns - wake_post_trigger):
+                        wakepotential_monitor.trigger(i)
+                with profiler.section('WakePotentialMonitor'):
+                    if wakepotential_monitor is not None:
+                        wakepotential_monitor.track(beam, wakefield_tr)
             elif include_Zlong == 'True':
-                wakefield_long.track(beam)
-                
-            if (monitor_count < 2500 and (np.mean(beam.bunch_mean[:][0]) > 0.1 * stdx or np.mean(beam.bunch_mean[:][2]) > 0.1 * stdy)):
-                track_wake_monitor=True
-            if monitor_count < 2500 and (i > (n_turns - 2500) or track_wake_monitor):
-                wakepotential_monitor.track(beam, wakefield_tr)
-                monitor_count += 1
-        
+                with profiler.section('WakePotential'):
+                    pool.track(wakefield_long, beam)
+            if cb_modes:
+                with profiler.section('CoupledBunchModeMonitor'):
+                    if cb_monitor is not None:
+                        cb_monitor.track(beam)
+            profiler.turn_done()
+
+            if stop_policy.due(i):
+                means = np.array(list(beam.mpi.mean_all.values()))
+                amplitude = np.max(np.maximum(np.abs(means[:, 0]) / stdx,
+                                              np.abs(means[:, 2]) / stdy))
+                alive_fraction = beam.mpi.comm.allreduce(
+                    np.mean([np.mean(bunch.alive) for bunch in beam]),
+                    op=beam.mpi.MPI.MIN)
+                if stop_policy.check(i, amplitude, alive_fraction):
+                    if beam.mpi.rank == 0:
+                        print(f"Stopping at turn {i}: {stop_policy.reason}.")
+                    break
+
+        if stop_policy.reason is not None:
+            if wakepotential_monitor is not None:
+                wakepotential_monitor.trigger(i)
+            if comm is None and not rank_local:
+                trim_monitor(beam_monitor, beam.mpi.bunch_numbers)
+            else:
+                beam_monitor.trim()
+            if cb_monitor is not None:
+                trim_monitor(cb_monitor)
+            if writes_file:
+                record_stop(beam_monitor.file, stop_policy)
+        profiler.write(beam_monitor.file if writes_file else None,
+                       monitor_filename + ".profile.json")
     finally:
+        pool.close()
         beam_monitor.close()
+    if rank_local:
+        beam.mpi.comm.Barrier()
+        if beam.mpi.rank == 0:
+            merge_rank_files(monitor_filename)
 
 
 if __name__ == "__main__":
@@ -216,4 +370,10 @@ if __name__ == "__main__":
     else:
         config = {}
 
-    run_mbtrack2(config)
+    # "mpi": one process per rank started by mpirun; "shared": n_processes
+    # processes on this machine, without MPI.
+    if config.get('backend', 'mpi') == 'shared':
+        run_shared_memory(run_mbtrack2, config,
+                          config.get('n_processes', os.cpu_count()))
+    else:
+        run_mbtrack2(config)
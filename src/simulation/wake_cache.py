@@ -0,0 +1,205 @@
+"""
+Persistent on-disk cache for loaded wake models.
+
+Loading and resampling the SOLEIL II wake tables from the shared filesystem
+takes seconds to minutes, and it is repeated identically by every job of a
+parameter scan. This module stores the resulting WakeFunction arrays as
+``.npy`` files, one directory per cache entry, which are memory-mapped when
+read back so that concurrent jobs on a node share the page cache.
+
+An entry is keyed by a hash of the wake model name, the ring parameters the
+loader depends on, the requested components and a fingerprint (path, mtime,
+size) of the loader source and data files. Any change of the sources
+therefore produces a new key. The cache size is bounded: least recently used
+entries are evicted once ``max_size`` bytes are exceeded.
+
+Usage:
+    from wake_cache import cached_wakefield
+
+    wakemodel = cached_wakefield(name, ring, load_soleil_ii_wf,
+                                 components=["Wydip", "Wlong"])
+"""
+
+import glob
+import hashlib
+import inspect
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+from mbtrack2.impedance.wakefield import WakeField, WakeFunction
+
+DEFAULT_CACHE_DIR = os.environ.get(
+    "TI_WAKE_CACHE_DIR",
+    os.path.join(os.path.expanduser("~"), ".cache", "transverse_instabilities",
+                 "wakes"))
+DEFAULT_MAX_SIZE = 2 * 1024**3
+
+
+RING_KEYS = ("h", "L", "E0", "ac", "U0", "sigma_0", "tune")
+
+
+def ring_fingerprint(ring, keys: tuple = RING_KEYS) -> dict:
+    """Return the ring parameters that may affect a cached result."""
+    fingerprint = {
+        key: np.asarray(getattr(ring, key)).tolist()
+        for key in keys if hasattr(ring, key)
+    }
+    fingerprint["local_beta"] = np.asarray(ring.optics.local_beta).tolist()
+    return fingerprint
+
+
+def source_fingerprint(name: str, loader) -> list:
+    """Return (path, mtime, size) of the loader module and its data files.
+
+    Data files are the files below the loader module directory whose name
+    contains the wake model name.
+
+    Args:
+        name: Wake model name passed to the loader.
+        loader: Function loading the wake model.
+
+    Returns:
+        Sorted list of [path, mtime_ns, size] entries.
+    """
+    try:
+        module_file = inspect.getsourcefile(loader)
+    except TypeError:
+        return []
+    if module_file is None:
+        return []
+    directory = os.path.dirname(os.path.abspath(module_file))
+    paths = [module_file] + glob.glob(
+        os.path.join(directory, "**", f"*{name}*"), recursive=True)
+    fingerprint = []
+    for path in sorted(set(paths)):
+        stat = os.stat(path)
+        fingerprint.append([path, stat.st_mtime_ns, stat.st_size])
+    return fingerprint
+
+
+class WakeCache:
+    """Directory of cached wake models with size-bounded LRU eviction.
+
+    Args:
+        cache_dir: Cache directory, created if needed.
+        max_size: Maximum total size of the cache in bytes.
+    """
+
+    def __init__(self,
+                 cache_dir: str = DEFAULT_CACHE_DIR,
+                 max_size: int = DEFAULT_MAX_SIZE):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(name: str, ring, components: list, sources: list) -> str:
+        """Return the cache key of a wake model."""
+        description = {
+            "name": name,
+            "ring": ring_fingerprint(ring),
+            "components": sorted(components),
+            "sources": sources,
+        }
+        text = json.dumps(description, sort_keys=True)
+        return hashlib.sha256(text.encode()).hexdigest()[:32]
+
+    def load(self, key: str) -> WakeField | None:
+        """Return the cached WakeField for key, or None on a cache miss.
+
+        The data of each WakeFunction is a read-only view of the
+        memory-mapped table: the WakeFunction constructor, which copies its
+        arrays, is only used for the component type.
+        """
+        path = os.path.join(self.cache_dir, key)
+        if not os.path.isdir(path):
+            return None
+        wakefunctions = []
+        for file in sorted(glob.glob(os.path.join(path, "*.npy"))):
+            component = os.path.basename(file)[:-len(".npy")]
+            table = np.load(file, mmap_mode="r")
+            wake = WakeFunction(component_type=component[1:])
+            wake.data = pd.DataFrame(table[1:].T,
+                                     index=pd.Index(table[0],
+                                                    copy=False,
+                                                    name="time [s]"),
+                                     columns=["real", "imag"],
+                                     copy=False)
+            wakefunctions.append(wake)
+        os.utime(path)
+        return WakeField(wakefunctions)
+
+    def store(self, key: str, wakefield, components: list) -> None:
+        """Store the requested components of a wake model.
+
+        The entry is written to a temporary directory and renamed, so
+        concurrent jobs never see a partially written entry.
+        """
+        path = os.path.join(self.cache_dir, key)
+        if os.path.isdir(path):
+            return
+        tmp_path = tempfile.mkdtemp(dir=self.cache_dir, prefix=".tmp_")
+        for component in components:
+            wake = getattr(wakefield, component)
+            table = np.array([
+                wake.data.index.to_numpy(dtype=float),
+                wake.data["real"].to_numpy(),
+                wake.data["imag"].to_numpy(),
+            ])
+            np.save(os.path.join(tmp_path, component + ".npy"), table)
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # Another job stored the same entry in the meantime.
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        self.evict()
+
+    def evict(self) -> None:
+        """Remove least recently used entries until the size bound holds."""
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if not entry.is_dir() or entry.name.startswith("."):
+                continue
+            size = sum(f.stat().st_size for f in os.scandir(entry.path))
+            entries.append((entry.stat().st_mtime, size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+
+def cached_wakefield(name: str,
+                     ring,
+                     loader,
+                     components: list,
+                     cache_dir: str | None = DEFAULT_CACHE_DIR,
+                     max_size: int = DEFAULT_MAX_SIZE) -> WakeField:
+    """Load a wake model through the on-disk cache.
+
+    Args:
+        name: Wake model name passed to the loader.
+        ring: Synchrotron object passed to the loader.
+        loader: Function called as loader(name, ring) on a cache miss.
+        components: WakeField components to keep, e.g. ["Wydip", "Wlong"].
+        cache_dir: Cache directory. If None or empty (e.g. false in a TOML
+            config), the cache is bypassed.
+        max_size: Maximum total size of the cache in bytes.
+
+    Returns:
+        WakeField holding the requested components.
+    """
+    if not cache_dir:
+        return loader(name, ring)
+    cache = WakeCache(cache_dir, max_size)
+    key = cache.key(name, ring, components, source_fingerprint(name, loader))
+    wakefield = cache.load(key)
+    if wakefield is None:
+        wakefield = loader(name, ring)
+        cache.store(key, wakefield, components)
+    return wakefield